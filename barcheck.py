@@ -0,0 +1,186 @@
+from collections import Counter, OrderedDict
+from fractions import Fraction
+
+import ly.document
+import ly.music
+import ly.music.event
+import ly.music.items
+
+from songselection import DurationIndex, music_length, music_units
+
+
+def describe_length(length):
+    """
+    :param length: length in whole notes
+    :return: e.g. "3/8" or "1"
+    """
+    return str(Fraction(length))
+
+
+def describe_position(position, bar_length):
+    """
+    :param position: position in the song (in whole notes)
+    :param bar_length: length of a bar (in whole notes)
+    :return: e.g. "bar 5" or "bar 5 + 1/8" (bars count from 1)
+    """
+    bar, offset = divmod(Fraction(position), bar_length)
+    text = "bar {0}".format(int(bar) + 1)
+    return text + " + {0}".format(describe_length(offset)) if offset else text
+
+
+def describe_bars(length, bar_length):
+    """
+    :param length: length in whole notes
+    :param bar_length: length of a bar (in whole notes)
+    :return: e.g. "8 bars" or "7 bars + 1/2"
+    """
+    bars, rest = divmod(Fraction(length), bar_length)
+    text = "{0} bar{1}".format(int(bars), "" if bars == 1 else "s")
+    return text + " + {0}".format(describe_length(rest)) if rest else text
+
+
+def fills_bars(length, bar_length):
+    """
+    :return: True if music of the given length fills a whole number of bars, or if a whole number of it fills a bar
+    """
+    return (length / bar_length).denominator == 1 or (bar_length / length).denominator == 1
+
+
+class _BarChecks(ly.music.event.Events):
+    """
+    collects the positions of the bar checks in a python-ly music tree
+    """
+    def __init__(self):
+        self.positions = []
+
+    def traverse(self, node, time, scaling):
+        if isinstance(node, ly.music.items.PipeSymbol):
+            self.positions.append(time)
+        return node.events(self, time, scaling)
+
+
+def bar_check_positions(lycode):
+    """
+    :param lycode: lilypond code without variables
+    :return: list of the positions (in whole notes from the start of lycode) of the bar checks in it
+    """
+    document = ly.document.Document("{ " + lycode + " }", mode="lilypond")
+    checks = _BarChecks()
+    time = Fraction(0)
+    for node in ly.music.document(document):
+        time = checks.read(node, time)
+    return checks.positions
+
+
+class BarChecker(object):
+    """
+    checks the lengths of the fragments of a style and of the voices of a song without running lilypond: every
+    fragment and voice is measured with python-ly (tuplets, ties, chords and simultaneous music included), and only
+    once per distinct lilypond code
+    """
+    def __init__(self, bar_length, time="4/4"):
+        """
+        holds
+         - bar_length = length of a bar (in whole notes)
+         - time = time signature the bars are in, for the reports
+         - lengths = map of lilypond code to the length of its music (in whole notes)
+        """
+        self.bar_length = bar_length
+        self.time = time
+        self.lengths = {}
+
+    def length(self, lycode):
+        if lycode not in self.lengths:
+            self.lengths[lycode] = music_length(lycode)
+        return self.lengths[lycode]
+
+    def fragment_problems(self, kind, fragments):
+        """
+        :param kind: "chord" or "pattern", for the reports
+        :param fragments: list of (track, staff, name, lilypond code) of the chords or patterns as written in a style
+        :return: list of problems found (strings): fragments without music, fragments that don't fit the bars of
+                 the time signature, and fragments that are longer or shorter than the fragment with the same name
+                 in the other staves
+        """
+        problems = []
+        byname = OrderedDict()
+        for track, staff, name, lycode in fragments:
+            length = self.length(lycode)
+            where = "{0} {1} in track {2}, staff {3}".format(kind, name, track, staff)
+            if not length:
+                problems.append("{0} has no music".format(where))
+                continue
+            if not fills_bars(length, self.bar_length):
+                problems.append("{0} is {1} long, which doesn't fit in {2} bars".format(where, describe_length(length),
+                                                                                       self.time))
+            byname.setdefault(name, []).append((track, staff, length))
+        for name, played in byname.items():
+            usual, count = Counter(length for (track, staff, length) in played).most_common(1)[0]
+            if count == len(played):
+                continue
+            if count == 1:
+                problems.append("{0} {1} has a different length in every staff: {2}".format(
+                        kind, name, ", ".join("{0}/{1} {2}".format(track, staff, describe_length(length))
+                                              for (track, staff, length) in played)))
+                continue
+            for track, staff, length in played:
+                if length != usual:
+                    problems.append("{0} {1} in track {2}, staff {3} is {4} long, but {5} in the other staves".format(
+                            kind, name, track, staff, describe_length(length), describe_length(usual)))
+        return problems
+
+    def voice_problems(self, voices, fragments, origins):
+        """
+        :param voices: list of (track, staff, music elements, transposition) of the voices of a song
+        :param fragments: map of lilypond variable name to the lilypond code it is defined as
+        :param origins: map of lilypond variable name to (chord or pattern name, True if derived)
+        :return: list of problems found (strings): bar checks in the music that don't fall on a bar line, and voices
+                 that are longer or shorter than most voices (with the first element that doesn't fit the bars, if
+                 any)
+        """
+        index = DurationIndex(fragments)
+        for name in fragments:
+            if fragments[name] in self.lengths:
+                index.lengths[name] = self.lengths[fragments[name]]  # measured by fragment_problems
+        problems = []
+        totals = []
+        for track, staff, musicelements, transposition in voices:
+            position = Fraction(0)
+            failed = None
+            misfit = None
+            for elements, length in music_units(musicelements, index):
+                lycode = "\n".join(elements)
+                if failed is None and "|" in lycode and not index.references(lycode):
+                    for check in bar_check_positions(lycode):
+                        if (position + check) % self.bar_length:
+                            failed = position + check
+                            break
+                if misfit is None and length and not fills_bars(length, self.bar_length):
+                    misfit = (position, length, lycode)
+                position += length
+            if failed is not None:
+                problems.append("bar check failed in track {0}, staff {1} at {2}".format(
+                        track, staff, describe_position(failed, self.bar_length)))
+            totals.append((track, staff, position, misfit))
+
+        if not totals:
+            return problems
+        usual = Counter(position for (track, staff, position, misfit) in totals).most_common(1)[0][0]
+        for track, staff, position, misfit in totals:
+            if position == usual:
+                continue
+            problem = "track {0}, staff {1} lasts {2}, but most staves last {3}".format(
+                    track, staff, describe_bars(position, self.bar_length), describe_bars(usual, self.bar_length))
+            if misfit is not None:
+                start, length, lycode = misfit
+                names = index.referenced(lycode)
+                if not names:
+                    what = " ".join(lycode.split())[:40]
+                elif names[0] in origins:
+                    what = "\\{0} ({1})".format(names[0], origins[names[0]][0])
+                else:
+                    what = "\\" + names[0]
+                problem += "; it first drifts off the bar lines at {0}, where {1} is {2} long".format(
+                        describe_position(start, self.bar_length), what, describe_length(length))
+            problems.append(problem)
+        return problems
@@ -1,7 +1,18 @@
 import argparse
+import compileserver
+import difftest
+import eventexport
+import lilypondrunner
+import liveengine
 import stylecompiler
 import sys
+import vltable
 import os
+import reharmonize
+import songkeys
+import songselection
+import variants
+import vlbench
 
 
 def get_own_path():
@@ -14,16 +25,164 @@ def setup_argument_parser():
     parser = argparse.ArgumentParser(
         description="Arrange compiler for lilypond.",
         epilog="Thank you for smoking bluegrass.")
+    parser.add_argument("command", nargs="?", default="compile", choices=["compile", "precompile-style", "serve", "live", "precompute-vl-table", "benchmark-vl", "reharmonize", "difftest"],
+                        help="compile a song (default), precompile all derivable chords of a style into a style "
+                             "pack, serve compile requests over localhost http, play chords read from stdin live "
+                             "as midi events, precompute the voice leadings between small pitch class sets, "
+                             "compare the speed and quality of the voice leading engines on the chords of the "
+                             "styles (or only of --style), search substitute chord progressions for the song that "
+                             "voice lead smoothly in its style (written as e.g. output/song-reharmonized1.yaml), or "
+                             "check that the fast paths of chord derivation give the same notes as the reference "
+                             "pipeline on the sample songs and on random fragments")
     parser.add_argument("-i", "--inputfile", dest="inputfile", default=["samples/test_muteunmute_melody_lyrics.yaml"], nargs=1)
     parser.add_argument("-o", "--outputfile", dest="outputfile", default=["output/cowboy.ly"], nargs=1)
+    parser.add_argument("--style", dest="style", default=[None], nargs=1,
+                        help="style (in styles/instrumental) to precompile or play live")
+    parser.add_argument("--pack-file", dest="packfile", default=[None], nargs=1,
+                        help="where to write the style pack (default: next to the style file)")
+    parser.add_argument("--port", dest="port", default=[8765], type=int, nargs=1,
+                        help="port on which to serve compile requests")
+    parser.add_argument("--workers", dest="workers", default=[None], type=int, nargs=1,
+                        help="number of compiler worker processes when serving")
+    parser.add_argument("--max-concurrent", dest="maxconcurrent", default=[None], type=int, nargs=1,
+                        help="maximum number of compile requests handled at the same time when serving")
+    parser.add_argument("--timeout", dest="timeout", default=[60], type=int, nargs=1,
+                        help="maximum number of seconds a compile request may take when serving")
+    parser.add_argument("--events-file", dest="eventsfile", default=["-"], nargs=1,
+                        help="where to write the midi events (json lines) when playing live (default: stdout; "
+                             "all messages then go to stderr)")
+    parser.add_argument("--tempo", dest="tempo", default=[None], type=int, nargs=1,
+                        help="tempo (quarter notes per minute) when playing live (default: from the style)")
+    parser.add_argument("--live-key", dest="livekey", default=[None], nargs=1,
+                        help="key (lilypond note name) to transpose to when playing live")
+    parser.add_argument("--keys", dest="keys", default=[None], nargs=1,
+                        help="comma separated keys (lilypond note names, e.g. c,d,bes) or \"all\" to render the song "
+                             "in; writes one output file per key (e.g. output/song-bes.ly) in a single compile")
+    parser.add_argument("--variants", dest="variants", default=[1], type=int, nargs=1,
+                        help="render the song this many times with consecutive seeds (in parallel worker processes), "
+                             "rank the variants by how smooth their voice leading is and keep the best ones")
+    parser.add_argument("--keep", dest="keep", default=[variants.DEFAULT_KEEP], type=int, nargs=1,
+                        help="number of best variants to write (e.g. output/song-seed3.ly) when using --variants")
+    parser.add_argument("--top", dest="top", default=[reharmonize.DEFAULT_TOP], type=int, nargs=1,
+                        help="number of best reharmonizations to write when reharmonizing")
+    parser.add_argument("--max-substitutions", dest="maxsubstitutions",
+                        default=[reharmonize.DEFAULT_MAX_SUBSTITUTIONS], type=int, nargs=1,
+                        help="maximum number of chords a reharmonization may substitute")
+    parser.add_argument("--fast-paths", dest="fastpaths", default=[None], nargs=1,
+                        help="comma separated names of the fast paths to check with difftest (default: all of "
+                             "them), e.g. pitch-vector,engine:kvoice")
+    parser.add_argument("--fuzz-cases", dest="fuzzcases", default=[difftest.DEFAULT_FUZZ_CASES], type=int, nargs=1,
+                        help="number of random fragments to check the fast paths on with difftest")
+    parser.add_argument("--cases-file", dest="casesfile", default=[None], nargs=1,
+                        help="where difftest writes the outcome and speedup of every case (tab separated values)")
+    parser.add_argument("--only-tracks", dest="onlytracks", default=[None], nargs=1,
+                        help="comma separated names of the tracks to compile (default: all)")
+    parser.add_argument("--only-staves", dest="onlystaves", default=[None], nargs=1,
+                        help="comma separated names of the staves to compile (default: all)")
+    parser.add_argument("--bars", dest="bars", default=[None], nargs=1,
+                        help="range of bars to compile, e.g. 9-16 (or 9- for bar 9 up to the end)")
+    parser.add_argument("--export-events", dest="exportevents", default=[None], nargs=1,
+                        choices=eventexport.EVENT_FORMATS,
+                        help="also write every note of the arrangement as numpy arrays next to the output file: "
+                             "npz (e.g. output/song.npz) or npy (one memory-mappable file per column in "
+                             "e.g. output/song.events)")
+    parser.add_argument("-M", "--depfile", dest="depfile", default=[None], nargs=1,
+                        help="also write a Makefile style dependency file (e.g. output/song.d) that lists every file "
+                             "the compilation read; output files whose contents don't change are left untouched")
+    parser.add_argument("--no-bar-check", dest="barcheck", action="store_false", default=True,
+                        help="don't check that the chords, patterns and voices fit the bars of the time signature")
+    parser.add_argument("--no-rhythm-skeletons", dest="rhythmskeletons", action="store_false", default=True,
+                        help="write every chord with its own rhythm, instead of defining the rhythms that chords share "
+                             "once")
     parser.add_argument("-f", "--force", dest="force", action="store_true", default=False)
+    parser.add_argument("-s", "--seed", dest="seed", default=[None], type=int, nargs=1,
+                        help="seed for the random choices made during voice leading (overrides the seed in the song)")
+    parser.add_argument("--beam-width", dest="beamwidth", default=[8], type=int, nargs=1,
+                        help="beam width of the search for the best voicings in staves with voiceLeadingMethod 4")
+    parser.add_argument("--vl-cache-size", dest="vlcachesize", default=[4096], type=int, nargs=1,
+                        help="number of voice leading problems to remember (up to transposition); 0 disables the cache")
+    parser.add_argument("--vl-table", dest="vltable", default=[vltable.default_vltable_filename()], nargs=1,
+                        help="file with precomputed voice leadings between pitch class sets; used if it exists")
+    parser.add_argument("--max-cardinality", dest="maxcardinality", default=[vltable.DEFAULT_MAX_CARDINALITY],
+                        type=int, nargs=1, help="largest pitch class set to put in the voice leading table")
+    parser.add_argument("--shard-workers", dest="shardworkers", default=[1], type=int, nargs=1,
+                        help="number of worker processes that derive the chords of the sections of a long song in "
+                             "parallel (the song is split at section markers and transpositions)")
+    parser.add_argument("-n", "--dry-run", dest="dryrun", action="store_true", default=False,
+                        help="only plan which chords need to be derived, print the plan and stop")
+    parser.add_argument("-r", "--render", dest="render", action="store_true", default=False,
+                        help="run lilypond on the output file after compiling it")
+    parser.add_argument("--render-files", dest="renderfiles", default=[], nargs="+",
+                        help="skip compilation and only run lilypond on the given (e.g. per-part) files")
+    parser.add_argument("--lilypond", dest="lilypond", default=["lilypond"], nargs=1,
+                        help="path to the lilypond executable")
+    parser.add_argument("-j", "--jobs", dest="jobs", default=[None], type=int, nargs=1,
+                        help="maximum number of lilypond processes to run in parallel")
+    parser.add_argument("--cache-dir", dest="cachedir", default=[lilypondrunner.default_cachedir()], nargs=1,
+                        help="folder in which rendered pdf/midi files are cached")
     return parser
 
 
+def render(options, filenames):
+    runner = lilypondrunner.LilypondRunner(options.lilypond[0], options.cachedir[0], options.jobs[0])
+    jobs = runner.render(filenames)
+    if not runner.report(jobs):
+        sys.exit(5)
+
+
 if __name__ == "__main__":
     p = setup_argument_parser()
     options = p.parse_args()
     rootpath = get_own_path()
-    print("*** rootpath = ", rootpath)
-    s = stylecompiler.StyleCompiler(rootpath, options)
-    s.compile()
+    # when playing live, stdout may carry the event stream, so keep it clean
+    print("*** rootpath = ", rootpath, file=sys.stderr if options.command == "live" else sys.stdout)
+    if options.command == "precompile-style":
+        if not options.style[0]:
+            p.error("precompile-style needs --style")
+        stylecompiler.StyleCompiler(rootpath, options).precompile_style(options.style[0])
+    elif options.command == "precompute-vl-table":
+        vltable.generate(options.vltable[0], options.maxcardinality[0])
+    elif options.command == "benchmark-vl":
+        vlbench.benchmark(rootpath, [options.style[0]] if options.style[0] else None, options.seed[0] or 0)
+    elif options.command == "reharmonize":
+        if options.top[0] < 1 or options.maxsubstitutions[0] < 1:
+            p.error("reharmonize needs --top and --max-substitutions of at least 1")
+        reharmonize.reharmonize(stylecompiler.StyleCompiler(rootpath, options), options.top[0],
+                                options.maxsubstitutions[0])
+    elif options.command == "difftest":
+        if options.fuzzcases[0] < 0:
+            p.error("--fuzz-cases can't be negative")
+        names = [name.strip() for name in options.fastpaths[0].split(",")] if options.fastpaths[0] else None
+        if not difftest.difftest(stylecompiler.StyleCompiler(rootpath, options), rootpath, names,
+                                 options.fuzzcases[0], options.seed[0] or 0, options.casesfile[0]):
+            sys.exit(6)
+    elif options.command == "serve":
+        if options.dryrun:
+            p.error("serve can't do a dry run: it answers every request with the compiled song")
+        server = compileserver.CompileServer(rootpath, options, options.workers[0], options.maxconcurrent[0],
+                                             options.timeout[0])
+        server.serve(options.port[0])
+    elif options.command == "live":
+        if not options.style[0]:
+            p.error("live needs --style")
+        liveengine.play(stylecompiler.StyleCompiler(rootpath, options), options.style[0], sys.stdin,
+                        options.eventsfile[0], options.tempo[0], options.livekey[0])
+    elif options.renderfiles:
+        render(options, options.renderfiles)
+    else:
+        try:
+            songkeys.parse_keys(options.keys[0])
+            songselection.parse_bars(options.bars[0])
+        except ValueError as e:
+            p.error(str(e))
+        if options.variants[0] > 1 and options.keys[0] is not None:
+            p.error("--variants can't be combined with --keys")
+        if options.variants[0] > 1 and options.exportevents[0] is not None:
+            p.error("--variants can't be combined with --export-events")
+        s = stylecompiler.StyleCompiler(rootpath, options)
+        if options.variants[0] > 1 and not options.dryrun:
+            outputfiles = variants.compile_variants(s, options.variants[0], options.keep[0])
+        else:
+            outputfiles = s.compile()
+        if options.render and outputfiles:
+            render(options, outputfiles)
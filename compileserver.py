@@ -0,0 +1,178 @@
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import signal
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import stylecompiler
+
+_compiler = None  # warm StyleCompiler, one per worker process
+
+
+class CompileTimeout(Exception):
+    pass
+
+
+def _on_alarm(signum, frame):
+    raise CompileTimeout()
+
+
+def preload_styles(compiler):
+    """
+    parse all style files up front, so that forked workers start with warm caches
+    """
+    for subfolder in ["instrumental", "percussion"]:
+        folder = os.path.join(compiler.rootpath, "styles", subfolder)
+        if os.path.isdir(folder):
+            for fname in sorted(os.listdir(folder)):
+                if fname.endswith(".yaml"):
+                    compiler.init_from_file(subfolder, fname[:-len(".yaml")])
+
+
+def init_worker(rootpath, options):
+    global _compiler
+    if _compiler is None:  # not inherited from the parent process
+        _compiler = stylecompiler.StyleCompiler(rootpath, options)
+        preload_styles(_compiler)
+
+
+def compile_in_worker(songtext, timeout):
+    """
+    compile a song in a worker process
+    :param songtext: contents of a song file (yaml)
+    :param timeout: maximum number of seconds the compilation may take
+    :return: tuple of http status code and response text (lilypond code, or error description)
+    """
+    log = io.StringIO()
+    signal.signal(signal.SIGALRM, _on_alarm)
+    signal.alarm(timeout)
+    try:
+        with contextlib.redirect_stdout(log):
+            song = _compiler.parse_song(songtext)
+            lycode = _compiler.render(song)
+        if lycode is None:
+            # a dry run only prints the derivation plan
+            return 400, log.getvalue()
+        return 200, lycode
+    except CompileTimeout:
+        return 504, "*** ERROR: compilation took longer than {0}s.\n{1}".format(timeout, log.getvalue())
+    except SystemExit:
+        # the compiler bails out with sys.exit on errors in song or style
+        return 400, log.getvalue()
+    except Exception:
+        return 400, log.getvalue() + traceback.format_exc()
+    finally:
+        signal.alarm(0)
+
+
+class CompileServer(object):
+    """
+    class that keeps a pool of warm StyleCompiler worker processes and serves compile requests over localhost http:
+
+      POST /compile  with a song file (yaml) as body, returns the lilypond code
+      GET  /status   returns some statistics (json)
+    """
+    def __init__(self, rootpath, options, workers=None, max_concurrent=None, timeout=60):
+        """
+        :param rootpath: folder containing styles and ly-templates
+        :param options: compiler options (only seed is relevant)
+        :param workers: number of worker processes (default: number of cpus)
+        :param max_concurrent: maximum number of different requests handled at the same time (default: 2 * workers);
+                               requests beyond that are refused
+        :param timeout: maximum number of seconds a single compilation may take
+        """
+        global _compiler
+        self.rootpath = rootpath
+        self.options = options
+        self.workers = workers if workers else (os.cpu_count() or 1)
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_concurrent if max_concurrent else 2 * self.workers)
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "compiled": 0, "deduplicated": 0, "refused": 0, "failed": 0}
+        # warm up before forking, so every worker inherits the imported modules and parsed styles
+        _compiler = stylecompiler.StyleCompiler(rootpath, options)
+        preload_styles(_compiler)
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        else:
+            context = multiprocessing.get_context()
+        self.pool = context.Pool(self.workers, initializer=init_worker, initargs=(rootpath, options))
+
+    def compile(self, songtext):
+        """
+        compile a song in one of the workers; identical requests that arrive while one is being compiled
+        share its result
+        :param songtext: contents of a song file (yaml)
+        :return: tuple of http status code and response text
+        """
+        key = hashlib.sha1(songtext.encode("utf-8")).hexdigest()
+        with self.lock:
+            self.stats["requests"] += 1
+            pending = self.inflight.get(key)
+            if pending is not None:
+                self.stats["deduplicated"] += 1
+            else:
+                if not self.slots.acquire(blocking=False):
+                    self.stats["refused"] += 1
+                    return 503, "*** ERROR: too many concurrent requests, try again later."
+                pending = self.pool.apply_async(compile_in_worker, (songtext, self.timeout))
+                self.inflight[key] = pending
+        try:
+            # the worker enforces the timeout itself; only wait a bit longer here in case it got stuck
+            status, text = pending.get(self.timeout + 5)
+        except multiprocessing.TimeoutError:
+            status, text = 504, "*** ERROR: compilation took longer than {0}s.".format(self.timeout)
+        finally:
+            with self.lock:
+                if self.inflight.get(key) is pending:
+                    del self.inflight[key]
+                    self.slots.release()
+        with self.lock:
+            self.stats["compiled" if status == 200 else "failed"] += 1
+        return status, text
+
+    def serve(self, port=8765, host="127.0.0.1"):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path.rstrip("/") != "/compile":
+                    self.reply(404, "unknown path {0}".format(self.path))
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                songtext = self.rfile.read(length).decode("utf-8")
+                status, text = server.compile(songtext)
+                self.reply(status, text)
+
+            def do_GET(self):
+                if self.path.rstrip("/") != "/status":
+                    self.reply(404, "unknown path {0}".format(self.path))
+                    return
+                with server.lock:
+                    stats = dict(server.stats, inflight=len(server.inflight), workers=server.workers)
+                self.reply(200, json.dumps(stats), "application/json")
+
+            def reply(self, status, text, contenttype="text/plain; charset=utf-8"):
+                body = text.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", contenttype)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        print("*** Serving compile requests on http://{0}:{1}/compile with {2} workers".format(host, port,
+                                                                                            self.workers))
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+            self.pool.terminate()
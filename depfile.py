@@ -0,0 +1,63 @@
+import os
+
+DEPFILE_LINE_LENGTH = 100
+
+
+def same_content(filename, text):
+    """
+    :return: True if filename exists and contains exactly text
+    """
+    if not os.path.isfile(filename):
+        return False
+    try:
+        with open(filename, "r") as f:
+            return f.read() == text
+    except (IOError, UnicodeDecodeError):
+        return False
+
+
+def write_if_changed(filename, text):
+    """
+    write text to filename, unless the file already contains exactly that text: then the file and its modification
+    time are left untouched, so that build tools don't consider it changed
+    :return: True if the file was written, False if it was already up to date
+    """
+    if same_content(filename, text):
+        return False
+    with open(filename, "w") as f:
+        f.write(text)
+    return True
+
+
+def make_path(filename):
+    """
+    :return: filename as make expects it in a rule: relative to the current folder if it is in there (else absolute),
+             with spaces and special characters escaped
+    """
+    path = os.path.abspath(filename)
+    if path.startswith(os.path.join(os.getcwd(), "")):
+        path = os.path.relpath(path)
+    return path.replace(" ", "\\ ").replace("#", "\\#").replace("$", "$$").replace(":", "\\:")
+
+
+def dependency_rules(targets, prerequisites):
+    """
+    :param targets: files that are made from the prerequisites, e.g. the lilypond files written
+    :param prerequisites: every file that was read to make them
+    :return: contents of a Makefile style dependency file (as written by gcc -MD -MP): one rule that makes the targets
+             depend on the prerequisites, and an empty rule per prerequisite so that make doesn't stop when one of them
+             is removed
+    """
+    lines = []
+    line = " ".join(make_path(t) for t in targets) + ":"
+    paths = [make_path(p) for p in prerequisites]
+    for path in paths:
+        if len(line) + len(path) > DEPFILE_LINE_LENGTH:
+            lines.append(line + " \\")
+            line = " "
+        line += " " + path
+    lines.append(line)
+    for path in paths:
+        lines.append("")
+        lines.append(path + ":")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,240 @@
+import re
+from collections import OrderedDict, defaultdict
+
+from numberutils import split_roman_prefix, starts_with_one_of
+
+SPLITREGEX = " |\||\n|\t"
+
+DIRECT = "direct"
+DERIVE_FROM_I_AS_MINOR = "derive-from-I-as-minor"
+DERIVE_FROM_MODIFIER = "derive-from-I<modifier>"
+PASSTHROUGH = "passthrough"
+ERROR = "error"
+
+
+def split_elements(text):
+    """
+    split a string of chords or patterns into its individual tokens
+    :param text: e.g. "I IV | V I"
+    :return: list of tokens, e.g. ["I", "IV", "V", "I"]
+    """
+    return [el for el in re.split(SPLITREGEX, text) if el]  # cut out empty entries
+
+
+def is_derivable(c):
+    """
+    :param c: chord token (string)
+    :return: true if the token looks like a roman numeral chord that can be calculated from an I chord
+    """
+    return starts_with_one_of(c.upper(), ["III", "II", "IV", "I", "VII", "VI", "V"])
+
+
+def split_modifier(modifier):
+    """
+    split the modifier of a chord token like VIm7_a into the part without suffix and the part without prefix
+    :param modifier: e.g. "m7_a"
+    :return: (modifier_without_suffix, modifier_without_prefix), e.g. ("a", "m7")
+    """
+    if "_" in modifier:
+        msplit = modifier.split("_")
+        return msplit[1], msplit[0]
+    return modifier, modifier
+
+
+def estimate_pitches(fragment):
+    """
+    cheaply estimate how many pitches a lilypond fragment contains (without parsing it with music21)
+    :param fragment: lilypond fragment, e.g. "{ r8 <g' c'' e''>4 }"
+    :return: approximate number of pitches
+    """
+    text = re.sub(r"\\[A-Za-z]+", " ", fragment)
+    return len(re.findall(r"(?<![A-Za-z])[a-g](?:isis|eses|is|es)?(?![A-Za-z])", text))
+
+
+class DerivationJob(object):
+    """
+    describes how a single chord token in a given track and staff is resolved
+    """
+    def __init__(self, track, staff, chord, kind, source=None, degree=None, minor=False, error=None):
+        """
+        holds
+         - track, staff = where the chord is used
+         - chord = chord token as written in the song (e.g. "VIm7_a")
+         - kind = one of DIRECT, DERIVE_FROM_I_AS_MINOR, DERIVE_FROM_MODIFIER, PASSTHROUGH, ERROR
+         - source = name of the style chord the derivation starts from (e.g. "Im7_a" or "I")
+         - degree = roman scale degree with accidental to derive (e.g. "VIb")
+         - minor = true if the chord is to be derived in a minor target scale
+         - error = description of the problem if kind == ERROR
+        """
+        self.track = track
+        self.staff = staff
+        self.chord = chord
+        self.kind = kind
+        self.source = source
+        self.degree = degree
+        self.minor = minor
+        self.error = error
+        self.occurrences = 0
+
+    def key(self):
+        return self.track, self.staff, self.chord
+
+    def derivation_key(self):
+        """
+        :return: string that identifies the calculation behind a derived chord within its staff; different chord
+                 tokens (e.g. VIm_a and VIm7_a) can denote the same derivation
+        """
+        return "{0}|{1}|{2}".format(self.source, self.degree, "minor" if self.minor else "major")
+
+    def is_derivation(self):
+        return self.kind in (DERIVE_FROM_I_AS_MINOR, DERIVE_FROM_MODIFIER)
+
+
+class DerivationPlan(object):
+    """
+    result of planning: for every (track, staff, chord) the way it will be resolved
+    """
+    def __init__(self):
+        """
+        holds
+         - entries = ordered map of (track, staff, chord) to DerivationJob, in order of first use
+         - errors = list of error messages (strings), in order of discovery
+         - sequences = ordered map of (track, staff) to the list of chords that is played in it (muted chords excluded)
+        """
+        self.entries = OrderedDict()
+        self.errors = []
+        self.sequences = OrderedDict()
+
+    def lookup(self, track, staff, chord):
+        return self.entries.get((track, staff, chord))
+
+    def jobs(self):
+        """
+        :return: deduplicated list of derivations that need to be calculated, in order of first use
+        """
+        return [j for j in self.entries.values() if j.is_derivation()]
+
+    def report(self, style):
+        """
+        print the plan as a dry-run cost estimate
+        :param style: style the plan was made for (used to estimate the size of the source fragments)
+        """
+        kinds = defaultdict(int)
+        occurrences = 0
+        for j in self.entries.values():
+            kinds[j.kind] += 1
+            occurrences += j.occurrences
+        print("*** Derivation plan")
+        pitches = 0
+        for j in self.jobs():
+            fragment = style["tracks"][j.track]["staves"][j.staff]["chords"][j.source]
+            n = estimate_pitches(fragment)
+            pitches += n
+            print("    {0}/{1}: {2} <- {3} ({4}, {5} minor scale, ~{6} pitches, used {7} times)".format(
+                    j.track, j.staff, j.chord, j.source, j.kind, "in" if j.minor else "not in", n, j.occurrences))
+        for e in self.errors:
+            print("    ERROR! {0}".format(e))
+        print("*** {0} chord occurrences, {1} distinct chords: {2} direct, {3} derivations (~{4} pitches to "
+              "voice-lead), {5} passthrough, {6} errors".format(occurrences, len(self.entries), kinds[DIRECT],
+                                                               len(self.jobs()), pitches, kinds[PASSTHROUGH],
+                                                               len(self.errors)))
+
+
+class DerivationPlanner(object):
+    """
+    class that resolves every chord token used in a song before any derivation is done,
+    so that all problems are found (and reported) at once
+    """
+    def __init__(self, song, style):
+        self.song = song
+        self.style = style
+
+    def plan(self):
+        """
+        :return: DerivationPlan for all harmony tracks in the style
+        """
+        p = DerivationPlan()
+        if "tracks" not in self.style or "harmony" not in self.song:
+            return p
+        for name in self.style["tracks"]:
+            if "staves" not in self.style["tracks"][name]:
+                continue
+            for staff in self.style["tracks"][name]["staves"]:
+                if "chords" in self.style["tracks"][name]["staves"][staff]:
+                    self.plan_staff(name, staff, p)
+        return p
+
+    def plan_staff(self, name, staff, p):
+        stylechords = self.style["tracks"][name]["staves"][staff]["chords"]
+        sequence = p.sequences.setdefault((name, staff), [])
+        muted_staves = set([])
+        muted_tracks = set([])
+        for harmonyelement in self.song["harmony"]:
+            if "chords" in harmonyelement:
+                if name in muted_tracks or staff in muted_staves:
+                    continue
+                for c in split_elements(harmonyelement["chords"]):
+                    job = p.lookup(name, staff, c)
+                    if job is None:
+                        job = self.resolve(name, staff, c, stylechords)
+                        p.entries[job.key()] = job
+                        if job.kind == ERROR:
+                            p.errors.append(job.error)
+                    job.occurrences += 1
+                    sequence.append(c)
+            elif "mute-staff" in harmonyelement:
+                muted_staves.add(harmonyelement["mute-staff"]["staff"].strip())
+            elif "mute-track" in harmonyelement:
+                muted_tracks.add(harmonyelement["mute-track"]["track"].strip())
+            elif "unmute-staff" in harmonyelement:
+                staffname = harmonyelement["unmute-staff"]["staff"].strip()
+                if staffname not in muted_staves:
+                    self.unmute_error(p, "staff", staffname, name, staff)
+                muted_staves.discard(staffname)
+            elif "unmute-track" in harmonyelement:
+                trackname = harmonyelement["unmute-track"]["track"].strip()
+                if trackname not in muted_tracks:
+                    self.unmute_error(p, "track", trackname, name, staff)
+                muted_tracks.discard(trackname)
+
+    @staticmethod
+    def unmute_error(p, what, muted, name, staff):
+        msg = "Cannot unmute {0} {1} which is not muted (found while planning track {2}, staff {3}).".format(
+                what, muted, name, staff)
+        if msg not in p.errors:
+            p.errors.append(msg)
+
+    def resolve(self, name, staff, c, stylechords):
+        """
+        decide how chord c in track name, staff staff is to be resolved
+        :return: DerivationJob
+        """
+        if c in stylechords:
+            return DerivationJob(name, staff, c, DIRECT)
+        if not is_derivable(c):
+            return DerivationJob(name, staff, c, PASSTHROUGH)
+
+        number, accidental, modifier = split_roman_prefix(c)
+        if number is None:
+            return DerivationJob(name, staff, c, ERROR,
+                                 error="Cannot understand chord {0} in track {1}, staff {2}.".format(c, name, staff))
+        modifier_without_suffix, modifier_without_prefix = split_modifier(modifier)
+        one_chord = "I" + modifier_without_suffix
+        if one_chord in stylechords:
+            # e.g. you try to find VIm7 and Im7 exists in the style file
+            return DerivationJob(name, staff, c, DERIVE_FROM_MODIFIER, source=one_chord,
+                                 degree=number + accidental, minor="m" in modifier_without_prefix)
+        if modifier_without_prefix.startswith("m"):
+            # e.g. you try to calculate VIm but Im doesn't exist in the style file
+            # in that case: calculate VIm from I.
+            if "I" not in stylechords:
+                return DerivationJob(name, staff, c, ERROR,
+                                     error="Cannot find chord {0} or I in style file. Need one of them to calculate "
+                                           "chord {1} in track {2}, staff {3}.".format(one_chord, c, name, staff))
+            return DerivationJob(name, staff, c, DERIVE_FROM_I_AS_MINOR, source="I",
+                                 degree=number + accidental, minor=True)
+        # minor can be calculated from major if needed;
+        # other types require explicit hints
+        return DerivationJob(name, staff, c, ERROR,
+                             error="Cannot find chord {0} in style file. Need it to calculate chord {1} in track {2}, "
+                                   "staff {3}.".format(one_chord, c, name, staff))
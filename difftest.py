@@ -0,0 +1,473 @@
+import glob
+import os
+import random
+import sys
+import time
+from collections import OrderedDict
+from fractions import Fraction
+
+from derivationplanner import DERIVE_FROM_MODIFIER, DerivationJob
+from lily2stream import Lily2Stream
+from songselection import music_length
+from vlbench import TARGET_DEGREES
+from vlcache import VoiceLeadingCache
+from voiceleading import engines, find_engine
+
+DEFAULT_FUZZ_CASES = 200
+MISMATCHES_SHOWN = 5  # per fast path, in the summary
+
+FUZZ_LENGTHS = [("1", 4), ("2.", 3), ("2", 2), ("4.", 1.5), ("4", 1), ("8.", 0.75), ("8", 0.5), ("16", 0.25)]
+FUZZ_NOTES = ["c", "d", "e", "f", "g", "a", "b", "cis", "ees", "fis", "aes", "bes"]
+FUZZ_OCTAVES = [",", "", "'", "''"]
+
+
+class FastPath(object):
+    """
+    an alternative way of deriving a chord that is meant to give the same notes as the reference pipeline (music21
+    streams voice led by VoiceLeader without any caches), only faster
+    """
+    def __init__(self, name, derive, description=""):
+        """
+        holds
+         - name = name to select the fast path with
+         - derive = function(DiffTest, case) that returns the derived chord as a lilypond fragment or a music21
+           stream, or None if the fast path doesn't apply to the case
+         - description = one line description, for the report
+        """
+        self.name = name
+        self.derive = derive
+        self.description = description
+
+
+class DiffCase(object):
+    """
+    one derivation to run through the reference pipeline and the fast paths
+    """
+    def __init__(self, label, style, job, seed, stylepack=None):
+        """
+        holds
+         - label = where the case comes from, e.g. "samples/test_waltz.yaml:guitar/guitar/VIm_a" or "fuzz17"
+         - style = resolved style that contains the source chord
+         - job = DerivationJob to derive
+         - seed = seed of the random choices in voice leading
+         - stylepack = StylePack of the style, if it has one
+        """
+        self.label = label
+        self.style = style
+        self.job = job
+        self.seed = seed
+        self.stylepack = stylepack
+
+
+class DiffResult(object):
+    """
+    outcome of one case on one fast path
+    """
+    def __init__(self, case, reference_time, fast_time=None, mismatch=None, error=None):
+        """
+        holds
+         - case = DiffCase
+         - reference_time, fast_time = seconds taken by the reference pipeline and by the fast path (None if the
+           fast path doesn't apply)
+         - mismatch = description of the first note that differs (None if all notes are the same)
+         - error = description of the exception the fast path raised (None if it ran)
+        """
+        self.case = case
+        self.reference_time = reference_time
+        self.fast_time = fast_time
+        self.mismatch = mismatch
+        self.error = error
+
+    def speedup(self):
+        return self.reference_time / self.fast_time if self.fast_time else None
+
+
+def resolved_notes(music):
+    """
+    :param music: lilypond fragment or music21 stream
+    :return: list of (offset, length, sorted midi numbers) of the notes, chords and rests (no midi numbers) in it,
+             with offset and length in quarter notes
+    """
+    s = Lily2Stream().parse(music) if isinstance(music, str) else music
+    notes = []
+    for n in s.flat.notesAndRests:
+        midis = tuple(sorted(p.midi for p in n.pitches)) if not n.isRest else ()
+        notes.append((Fraction(n.offset).limit_denominator(256), Fraction(n.quarterLength).limit_denominator(256),
+                      midis))
+    return notes
+
+
+def misread(fragment, notes):
+    """
+    the musicxml import that the reference pipeline parses fragments with misreads some of them: it splits a chord
+    that ends a bar (or after a triplet, one near the end of the bar) into its first note and a chord after it, and
+    gives a rest in a tuplet its full length. Cases built on such fragments say nothing about the fast paths.
+    :param fragment: lilypond fragment
+    :param notes: resolved notes of the fragment, or of a chord derived from it (see resolved_notes)
+    :return: description of the problem if the notes are not as long as the fragment, else None
+    """
+    expected = 4 * music_length(fragment)
+    length = max([offset + duration for offset, duration, midis in notes] or [Fraction(0)])
+    if length != expected:
+        return "misread the source fragment as {0} quarter notes instead of {1}".format(length, expected)
+    return None
+
+
+def readable(fragment):
+    """
+    :return: True if the reference pipeline reads fragment correctly (see misread)
+    """
+    try:
+        return misread(fragment, resolved_notes(fragment)) is None
+    except Exception:
+        return False
+
+
+def describe_note(note):
+    offset, length, midis = note
+    return "at {0} length {1} {2}".format(offset, length, "midi " + " ".join(str(m) for m in midis) if midis else
+                                          "rest")
+
+
+def first_mismatch(reference, fast):
+    """
+    :param reference: resolved notes of the reference pipeline (see resolved_notes)
+    :param fast: resolved notes of the fast path
+    :return: description of the first note that differs, or None if they are the same
+    """
+    for i, (r, f) in enumerate(zip(reference, fast)):
+        if r != f:
+            return "note {0}: reference {1}, fast path {2}".format(i + 1, describe_note(r), describe_note(f))
+    if len(reference) != len(fast):
+        return "reference has {0} notes, fast path {1}".format(len(reference), len(fast))
+    return None
+
+
+def with_engine(style, job, engine):
+    """
+    :return: copy of style (only as deep as needed) in which the staff of job uses the given voice leading engine
+    """
+    staff = dict(style["tracks"][job.track]["staves"][job.staff])
+    staff["voiceLeadingMethod"] = engine.key
+    staves = dict(style["tracks"][job.track]["staves"])
+    staves[job.staff] = staff
+    track = dict(style["tracks"][job.track])
+    track["staves"] = staves
+    tracks = dict(style["tracks"])
+    tracks[job.track] = track
+    result = dict(style)
+    result["tracks"] = tracks
+    return result
+
+
+def _pitch_vector(difftest, case):
+    derived = difftest.compiler.derive_chord_pitches(case.style, case.job)
+    return derived[0] if derived is not None else None
+
+
+def _vl_cache(difftest, case):
+    difftest.compiler.vlcache = difftest.vlcache
+    try:
+        return difftest.compiler.derive_chord_stream(case.style, case.job)
+    finally:
+        difftest.compiler.vlcache = None
+
+
+def _style_pack(difftest, case):
+    return case.stylepack.lookup(case.job, case.seed) if case.stylepack is not None else None
+
+
+def engine_fast_path(engine):
+    """
+    :return: FastPath that derives with the given voice leading engine instead of the one the staff asks for
+    """
+    def derive(difftest, case):
+        return difftest.compiler.derive_chord_stream(with_engine(case.style, case.job, engine), case.job)
+    return FastPath("engine:" + engine.name, derive, "voice leading engine {0} instead of the staff's "
+                                                     "engine".format(engine.name))
+
+
+_FAST_PATHS = OrderedDict()
+
+
+def register_fast_path(fast_path):
+    """
+    make a FastPath available to the differential test (a fast path that is registered again replaces the old one)
+    """
+    _FAST_PATHS[fast_path.name] = fast_path
+
+
+def fast_paths(names=None):
+    """
+    :param names: names of the fast paths to test, e.g. ["pitch-vector", "engine:kvoice"] (None: every registered
+                  fast path); "engine:<name>" selects a voice leading engine
+    :return: list of FastPath
+    """
+    if names is None:
+        return list(_FAST_PATHS.values())
+    result = []
+    for name in names:
+        if name in _FAST_PATHS:
+            result.append(_FAST_PATHS[name])
+        elif name.startswith("engine:") and find_engine(name[len("engine:"):]) is not None:
+            result.append(engine_fast_path(find_engine(name[len("engine:"):])))
+        else:
+            known = list(_FAST_PATHS) + ["engine:" + e.name for e in engines()]
+            print("*** Error: unknown fast path {0} (known: {1})".format(name, ", ".join(known)))
+            sys.exit(3)
+    return result
+
+
+register_fast_path(FastPath("pitch-vector", _pitch_vector,
+                            "voice lead the pitch vector and fill it into the rhythm skeleton of the source chord"))
+register_fast_path(FastPath("vl-cache", _vl_cache,
+                            "voice leading cache (shared by all cases, transposition invariant)"))
+register_fast_path(FastPath("style-pack", _style_pack, "precompiled derivations from the style pack"))
+
+
+def song_cases(compiler, rootpath):
+    """
+    :return: list of DiffCase for every chord derivation of every song in the samples folder (whose style exists)
+    """
+    cases = []
+    fnames = sorted(glob.glob(os.path.join(rootpath, "samples", "**", "*.yaml"), recursive=True))
+    for fname in fnames:
+        song = compiler.load_song(fname)
+        if "style" not in song or not song["style"] or "harmony" not in song:
+            continue
+        if not os.path.isfile(compiler.style_filename(os.path.join("styles", "instrumental"), song["style"])):
+            print("*** WARNING: skipping song {0}: its style {1} doesn't exist".format(fname, song["style"]))
+            continue
+        style = compiler.init_style(song["style"])
+        seed = compiler.song_seed(song)
+        plan = compiler.plan_derivations(song, style)
+        label = os.path.relpath(fname, rootpath)
+        for job in plan.jobs():
+            cases.append(DiffCase("{0}:{1}/{2}/{3}".format(label, job.track, job.staff, job.chord), style, job, seed,
+                                  compiler.stylepack))
+    return cases
+
+
+def fuzz_fragment(rng):
+    """
+    :param rng: random.Random
+    :return: random lilypond chord fragment of one 4/4 bar: notes, chords, rests, ties and triplets
+    """
+    elements = []
+    left = 4.0
+    while left > 0:
+        if left >= 1 and rng.random() < 0.15:
+            elements.append("\\times 2/3 {{ {0} }}".format(" ".join(fuzz_event(rng, "8") for i in range(3))))
+            left -= 1
+            continue
+        lengths = [(name, length) for (name, length) in FUZZ_LENGTHS if length <= left]
+        name, length = rng.choice(lengths)
+        event = fuzz_event(rng, name)
+        if not event.startswith("r") and rng.random() < 0.1:
+            event += " ~"
+        elements.append(event)
+        left -= length
+    if elements[-1].endswith(" ~"):
+        elements[-1] = elements[-1][:-2]
+    return "{ " + " ".join(elements) + " }"
+
+
+def fuzz_event(rng, length):
+    """
+    :return: random rest, note or chord of the given lilypond length
+    """
+    kind = rng.random()
+    if kind < 0.1:
+        return "r" + length
+    pitches = ["{0}{1}".format(rng.choice(FUZZ_NOTES), rng.choice(FUZZ_OCTAVES))
+               for i in range(1 if kind < 0.5 else rng.randint(2, 4))]
+    if len(pitches) == 1:
+        return pitches[0] + length
+    return "<" + " ".join(pitches) + ">" + length
+
+
+def fuzz_cases(count, seed=0):
+    """
+    :return: list of count DiffCase, each deriving a random fragment to a random degree with one of the registered
+             voice leading engines; fragments that the reference pipeline misreads are replaced by new ones
+    """
+    rng = random.Random(seed)
+    available = engines()
+    cases = []
+    for i in range(count):
+        fragment = fuzz_fragment(rng)
+        while not readable(fragment):
+            fragment = fuzz_fragment(rng)
+        engine = available[i % len(available)]
+        degree, distance, minor = rng.choice(TARGET_DEGREES)
+        key = rng.choice(["c", "g", "d", "f", "bes"])
+        name = "fuzz{0}".format(i + 1)
+        style = {"specified-relative-to": {"key": key, "mode": rng.choice(["major", "minor"])},
+                 "tracks": {name: {"staves": {name: {"voiceLeadingMethod": engine.key, "chords": {"I": fragment}}}}}}
+        job = DerivationJob(name, name, degree + ("m" if minor else ""), DERIVE_FROM_MODIFIER, source="I",
+                            degree=degree, minor=minor)
+        cases.append(DiffCase("{0} ({1}, {2} in {3}): {4}".format(name, engine.name, job.chord, key, fragment),
+                              style, job, seed))
+    return cases
+
+
+class DiffTest(object):
+    """
+    differential test of the fast paths of chord derivation against the reference pipeline: every case is derived
+    by both, with the same seeds, and the resolved notes (offset, length and midi numbers) are compared one by one
+    """
+    def __init__(self, compiler):
+        """
+        holds
+         - compiler = StyleCompiler used to derive the chords
+         - vlcache = voice leading cache for the vl-cache fast path
+         - results = ordered map of fast path name to list of DiffResult
+         - failed = list of (DiffCase, description of the problem) for the cases the reference pipeline can't
+           derive or misreads (see misread); those aren't run on the fast paths
+        """
+        self.compiler = compiler
+        self.vlcache = VoiceLeadingCache()
+        self.results = OrderedDict()
+        self.failed = []
+
+    def reference(self, case):
+        """
+        :return: (resolved notes of the reference pipeline for case, seconds it took)
+        """
+        self.compiler.vlcache = None
+        self.compiler.seed = case.seed
+        start = time.perf_counter()
+        s = self.compiler.derive_chord_stream(case.style, case.job)
+        elapsed = time.perf_counter() - start
+        return resolved_notes(s), elapsed
+
+    @staticmethod
+    def source(case):
+        """
+        :return: lilypond fragment of the chord that case derives from
+        """
+        return case.style["tracks"][case.job.track]["staves"][case.job.staff]["chords"][case.job.source]
+
+    def run(self, cases, paths):
+        """
+        run every case through the reference pipeline and every fast path
+        """
+        for path in paths:
+            self.results.setdefault(path.name, [])
+        saved = self.compiler.vlcache
+        try:
+            for case in cases:
+                try:
+                    notes, reference_time = self.reference(case)
+                except Exception as e:
+                    self.failed.append((case, "{0}: {1}".format(type(e).__name__, e)))
+                    continue
+                problem = misread(self.source(case), notes)
+                if problem is not None:
+                    self.failed.append((case, problem))
+                    continue
+                for path in paths:
+                    self.results[path.name].append(self.run_path(path, case, notes, reference_time))
+        finally:
+            self.compiler.vlcache = saved
+
+    def run_path(self, path, case, notes, reference_time):
+        """
+        :return: DiffResult of case on path
+        """
+        self.compiler.seed = case.seed
+        start = time.perf_counter()
+        try:
+            music = path.derive(self, case)
+        except Exception as e:
+            return DiffResult(case, reference_time, error="{0}: {1}".format(type(e).__name__, e))
+        fast_time = time.perf_counter() - start
+        if music is None:
+            return DiffResult(case, reference_time)
+        try:
+            fast_notes = resolved_notes(music)
+        except Exception as e:
+            return DiffResult(case, reference_time, fast_time, error="unreadable result {0}: {1}".format(music, e))
+        return DiffResult(case, reference_time, fast_time, mismatch=first_mismatch(notes, fast_notes))
+
+    def safe(self, name):
+        """
+        :return: True if the fast path gave the same notes as the reference on every case it applies to, without
+                 errors (also True if it applies to none of them: see tested)
+        """
+        return not any(r.mismatch is not None or r.error is not None for r in self.results[name])
+
+    def tested(self, name):
+        """
+        :return: True if the fast path applies to at least one case
+        """
+        return any(r.fast_time is not None or r.error is not None for r in self.results[name])
+
+    def report(self, paths):
+        """
+        print a summary per fast path: on how many cases it applies, how many of those differ from the reference or
+        fail, its speedup (over all cases, and the median of the cases), and whether it is safe to enable
+        """
+        print("fast path      cases  applied  differ  errors   speedup    median  verdict")
+        for path in paths:
+            results = self.results[path.name]
+            applied = [r for r in results if r.fast_time is not None]
+            speedups = sorted(r.speedup() for r in applied if r.speedup() is not None)
+            total = sum(r.reference_time for r in applied) / sum(r.fast_time for r in applied) if applied else None
+            print("{0:<13}  {1:>5}  {2:>7}  {3:>6}  {4:>6}  {5:>8}  {6:>8}  {7}".format(
+                    path.name, len(results), len(applied), sum(1 for r in results if r.mismatch is not None),
+                    sum(1 for r in results if r.error is not None),
+                    "{0:.1f}x".format(total) if total else "-",
+                    "{0:.1f}x".format(speedups[len(speedups) // 2]) if speedups else "-",
+                    "UNTESTED" if not self.tested(path.name) else "SAFE" if self.safe(path.name) else "NOT SAFE"))
+        for case, error in self.failed[:MISMATCHES_SHOWN]:
+            print("*** WARNING: the reference pipeline fails on {0}: {1}".format(case.label, error))
+        if len(self.failed) > MISMATCHES_SHOWN:
+            print("*** WARNING: the reference pipeline fails on {0} more cases".format(
+                    len(self.failed) - MISMATCHES_SHOWN))
+        for path in paths:
+            problems = [r for r in self.results[path.name] if r.mismatch is not None or r.error is not None]
+            for r in problems[:MISMATCHES_SHOWN]:
+                print("*** {0} differs on {1}: {2}".format(path.name, r.case.label, r.mismatch or r.error))
+            if len(problems) > MISMATCHES_SHOWN:
+                print("*** {0} differs on {1} more cases".format(path.name, len(problems) - MISMATCHES_SHOWN))
+
+    def write_cases(self, filename):
+        """
+        write the result of every case on every fast path as tab separated values: fast path, case, reference time,
+        fast path time (in microseconds), speedup and outcome
+        """
+        with open(filename, "w") as f:
+            f.write("fast path\tcase\treference us\tfast path us\tspeedup\toutcome\n")
+            for name, results in self.results.items():
+                for r in results:
+                    if r.error is not None:
+                        outcome = "error: " + r.error
+                    elif r.fast_time is None:
+                        outcome = "not applicable"
+                    else:
+                        outcome = "differs: " + r.mismatch if r.mismatch is not None else "same"
+                    f.write("{0}\t{1}\t{2:.0f}\t{3}\t{4}\t{5}\n".format(
+                            name, r.case.label, 1e6 * r.reference_time,
+                            "{0:.0f}".format(1e6 * r.fast_time) if r.fast_time is not None else "-",
+                            "{0:.2f}".format(r.speedup()) if r.speedup() is not None else "-", outcome))
+        print("*** Wrote the result of every case in {0}".format(filename))
+
+
+def difftest(compiler, rootpath, names=None, fuzz=DEFAULT_FUZZ_CASES, seed=0, casesfile=None):
+    """
+    compare the fast paths against the reference pipeline on the chord derivations of the sample songs and on a
+    seeded corpus of random fragments, and print a report
+    :param names: names of the fast paths to test (None: all registered fast paths)
+    :param casesfile: file to write the result of every case to (None: don't)
+    :return: True if every fast path is safe to enable (fast paths that apply to none of the cases don't count)
+    """
+    paths = fast_paths(names)
+    cases = song_cases(compiler, rootpath) + fuzz_cases(fuzz, seed)
+    print("*** Comparing {0} fast paths against the reference pipeline on {1} cases".format(len(paths), len(cases)))
+    test = DiffTest(compiler)
+    test.run(cases, paths)
+    test.report(paths)
+    if casesfile:
+        test.write_cases(casesfile)
+    return all(test.safe(path.name) for path in paths)
@@ -0,0 +1,256 @@
+import os
+import re
+from collections import OrderedDict
+from fractions import Fraction
+
+import ly.document
+import ly.music
+import ly.music.event
+import ly.music.items
+import ly.pitch.rel2abs
+import music21
+
+from liveengine import DEFAULT_VELOCITY
+from rhythmskeleton import lilypond_pitch
+from songselection import DurationIndex, music_units
+
+EVENT_FORMATS = ["npz", "npy"]
+NO_MIDI = -1  # drum notes that general midi doesn't know
+
+# column name, numpy type; text columns get the width of their longest value (numpy itself is only imported when
+# the events are saved, so that compiling without --export-events doesn't need it)
+COLUMNS = [("track", str), ("staff", str), ("onset", "float64"), ("duration", "float64"), ("midi", "int16"),
+           ("spelling", str), ("velocity", "uint8"), ("chord", str), ("derived", "bool")]
+
+# general midi percussion keys of the lilypond drum names (long and short)
+DRUM_MIDIS = dict((name, midi) for midi, names in [
+    (35, ["acousticbassdrum", "bda"]), (36, ["bassdrum", "bd"]), (37, ["sidestick", "ss"]),
+    (38, ["acousticsnare", "snare", "sna", "sn"]), (39, ["handclap", "hc"]), (40, ["electricsnare", "sne"]),
+    (41, ["lowfloortom", "tomfl"]), (42, ["closedhihat", "hihat", "hhc", "hh"]), (43, ["highfloortom", "tomfh"]),
+    (44, ["pedalhihat", "hhp"]), (45, ["lowtom", "toml"]), (46, ["openhihat", "halfopenhihat", "hho", "hhho"]),
+    (47, ["lowmidtom", "tomml"]), (48, ["himidtom", "tommh"]), (49, ["crashcymbal", "crashcymbala", "cymc", "cymca"]),
+    (50, ["hightom", "tomh"]), (51, ["ridecymbal", "ridecymbala", "cymr", "cymra"]),
+    (52, ["chinesecymbal", "cymch"]), (53, ["ridebell", "rb"]), (54, ["tambourine", "tamb"]),
+    (55, ["splashcymbal", "cyms"]), (56, ["cowbell", "cb"]), (57, ["crashcymbalb", "cymcb"]),
+    (58, ["vibraslap", "vibs"]), (59, ["ridecymbalb", "cymrb"]), (60, ["hibongo", "boh"]), (61, ["lobongo", "bol"]),
+    (62, ["mutehiconga", "cghm"]), (63, ["openhiconga", "cgho"]), (64, ["loconga", "cgl"]), (65, ["hitimbale", "timh"]),
+    (66, ["lotimbale", "timl"]), (67, ["hiagogo", "agh"]), (68, ["loagogo", "agl"]), (69, ["cabasa", "cab"]),
+    (70, ["maracas", "mar"]), (71, ["shortwhistle", "whs"]), (72, ["longwhistle", "whl"]),
+    (73, ["shortguiro", "guis"]), (74, ["longguiro", "guil"]), (75, ["claves", "cl"]), (76, ["hiwoodblock", "wbh"]),
+    (77, ["lowoodblock", "wbl"]), (78, ["mutecuica", "cuim"]), (79, ["opencuica", "cuio"]),
+    (80, ["mutetriangle", "trim"]), (81, ["opentriangle", "triangle", "trio", "tri"])] for name in names)
+
+_TRANSPOSE = re.compile(r"\\transpose\s+([a-z]+[,']*)\s+([a-z]+[,']*)")
+_REFERENCE = re.compile(r"\\([A-Za-z]+)")
+_NOTES = (ly.music.items.Note, ly.music.items.DrumNote)
+
+_intervals = {}  # (lilypond note name, lilypond note name) -> music21 interval
+
+
+def events_filename(filename, fmt):
+    """
+    :param filename: lilypond file the arrangement is written to, e.g. output/song.ly
+    :param fmt: one of EVENT_FORMATS
+    :return: file (npz) or folder (npy) the events of the arrangement are written to, e.g. output/song.npz
+    """
+    base = os.path.splitext(filename)[0]
+    return base + (".npz" if fmt == "npz" else ".events")
+
+
+class ArrangementEvents(object):
+    """
+    every note of an arrangement as columns (one array per property), so that analysis tools can run vectorized
+    queries on them without parsing lilypond or midi
+    """
+    def __init__(self):
+        """
+        holds
+         - columns = map of column name (see COLUMNS) to the list of values, one per note:
+            - track, staff = where the note is played
+            - onset, duration = when the note starts and how long it lasts (in quarter notes from the start of the song)
+            - midi = midi number (for drums the general midi percussion key, or NO_MIDI)
+            - spelling = music21 pitch name with octave, e.g. "F#4" or "B-3" (for drums the lilypond drum name,
+              e.g. "hhc")
+            - velocity = velocity suggested by the dynamics that apply to the note
+            - chord = chord or pattern of the style the note comes from ("" for melodies and raw lilypond code)
+            - derived = True if the chord was derived from another chord instead of written in the style
+        """
+        self.columns = OrderedDict((name, []) for name, dtype in COLUMNS)
+
+    def __len__(self):
+        return len(self.columns["onset"])
+
+    def add(self, track, staff, onset, duration, midi, spelling, velocity, chord, derived):
+        for name, value in zip(self.columns, (track, staff, onset, duration, midi, spelling, velocity, chord,
+                                              derived)):
+            self.columns[name].append(value)
+
+    def arrays(self):
+        """
+        :return: ordered map of column name to numpy array, notes sorted by onset (notes that start together keep
+                 the order of the staves in the score)
+        """
+        import numpy
+        onsets = numpy.array(self.columns["onset"], dtype=numpy.float64)
+        order = numpy.argsort(onsets, kind="stable")
+        return OrderedDict((name, numpy.array(self.columns[name], dtype=dtype)[order]) for name, dtype in COLUMNS)
+
+    def save(self, filename, fmt="npz"):
+        """
+        write the events next to the lilypond file of the arrangement: all columns in a single .npz file, or one .npy
+        file per column in a folder (those can be memory-mapped with numpy.load(..., mmap_mode="r"))
+        :param filename: lilypond file the arrangement was written to
+        :param fmt: one of EVENT_FORMATS
+        :return: name of the file or folder written
+        """
+        import numpy
+        target = events_filename(filename, fmt)
+        arrays = self.arrays()
+        if fmt == "npz":
+            numpy.savez(target, **arrays)
+        else:
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            for name, array in arrays.items():
+                numpy.save(os.path.join(target, name + ".npy"), array)
+        return target
+
+
+def music21_pitch(pitch):
+    """
+    :param pitch: python-ly pitch (absolute)
+    :return: music21 pitch
+    """
+    p = music21.pitch.Pitch(step="CDEFGAB"[pitch.note], octave=pitch.octave + 3)
+    if pitch.alter:
+        p.accidental = music21.pitch.Accidental(float(pitch.alter * 2))
+    return p
+
+
+def transposition_interval(source, target):
+    """
+    :return: music21 interval of a lilypond \\transpose from source to target (note names with octave marks)
+    """
+    if (source, target) not in _intervals:
+        _intervals[(source, target)] = music21.interval.Interval(noteStart=lilypond_pitch(source),
+                                                                 noteEnd=lilypond_pitch(target))
+    return _intervals[(source, target)]
+
+
+class _NoteEvents(ly.music.event.Events):
+    """
+    collects the notes of a python-ly music tree with their position, merging tied notes
+    """
+    def __init__(self):
+        """
+        holds
+         - notes = list of [onset, duration, music21 pitch or drum name, velocity or None] (times in whole notes)
+         - last = notes of the last note or chord
+         - tied = map of pitch or drum name to the note that is tied to the next note or chord
+         - velocity = velocity of the last dynamic, or None
+        """
+        self.notes = []
+        self.last = []
+        self.tied = {}
+        self.velocity = None
+
+    def traverse(self, node, time, scaling):
+        end = node.events(self, time, scaling)
+        if isinstance(node, ly.music.items.Chord):
+            self.play([n for n in node if isinstance(n, _NOTES)], time, end)
+        elif isinstance(node, _NOTES) and not isinstance(node.parent(), ly.music.items.Chord):
+            self.play([node], time, end)
+        elif isinstance(node, ly.music.items.Tie):
+            self.tied = dict((self.key(note[2]), note) for note in self.last)
+        elif isinstance(node, ly.music.items.Dynamic):
+            name = node.token[1:]
+            if name in music21.dynamics.dynamicStrToScalar:
+                self.velocity = int(round(music21.dynamics.Dynamic(name).volumeScalar * 127))
+        return end
+
+    @staticmethod
+    def key(sound):
+        return sound.midi if isinstance(sound, music21.pitch.Pitch) else sound
+
+    def play(self, nodes, time, end):
+        if end == time:
+            return  # grace notes
+        tied = self.tied
+        self.tied = {}
+        self.last = []
+        for node in nodes:
+            if isinstance(node, ly.music.items.DrumNote):
+                sound = node.token
+            else:
+                sound = music21_pitch(node.pitch)
+            note = tied.get(self.key(sound))
+            if note is not None and note[0] + note[1] == time:
+                note[1] += end - time
+            else:
+                note = [time, end - time, sound, self.velocity]
+                self.notes.append(note)
+            self.last.append(note)
+
+
+def lilypond_notes(lycode):
+    """
+    :param lycode: lilypond code without variables or transpositions
+    :return: list of (onset, duration, music21 pitch or lilypond drum name, velocity of the last dynamic before the
+             note or None); times are in quarter notes
+    """
+    document = ly.document.Document("{ " + lycode + " }", mode="lilypond")
+    if "\\relative" in lycode:
+        ly.pitch.rel2abs.rel2abs(ly.document.Cursor(document))
+    events = _NoteEvents()
+    time = Fraction(0)
+    for node in ly.music.document(document):
+        time = events.read(node, time)
+    return [(float(4 * onset), float(4 * duration), sound, velocity)
+            for onset, duration, sound, velocity in events.notes]
+
+
+def arrangement_events(voices, fragments, origins, window=None):
+    """
+    resolve the voices of an arrangement to their notes
+    :param voices: list of (track, staff, music elements, transposition of the voice or None)
+    :param fragments: map of lilypond variable name to the lilypond code it is defined as
+    :param origins: map of lilypond variable name to (chord or pattern name, True if derived)
+    :param window: BarWindow: only keep the notes that start in it (or None for the whole song)
+    :return: ArrangementEvents
+    """
+    index = DurationIndex(fragments)
+    events = ArrangementEvents()
+    parsed = {}
+    first = 4 * window.start if window is not None else None
+    last = 4 * window.end if window is not None and window.end is not None else None
+
+    def expand(match):
+        name = match.group(1)
+        return "{ " + fragments[name] + " }" if name in fragments else match.group(0)
+
+    for track, staff, musicelements, transposition in voices:
+        position = Fraction(0)
+        velocity = DEFAULT_VELOCITY
+        for elements, length in music_units(musicelements, index):
+            lycode = "\n".join(elements)
+            names = index.referenced(lycode)
+            chord, derived = origins.get(names[0], (names[0], False)) if names else ("", False)
+            transpositions = _TRANSPOSE.findall(lycode)
+            if transposition:
+                transpositions.append(transposition)
+            lycode = _REFERENCE.sub(expand, _TRANSPOSE.sub("", lycode))
+            if lycode not in parsed:
+                parsed[lycode] = lilypond_notes(lycode)
+            for onset, duration, sound, dynamic in parsed[lycode]:
+                onset += float(4 * position)
+                velocity = dynamic if dynamic is not None else velocity
+                if isinstance(sound, music21.pitch.Pitch):
+                    for source, target in transpositions:
+                        sound = sound.transpose(transposition_interval(source, target))
+                    midi, spelling = sound.midi, sound.nameWithOctave
+                else:
+                    midi, spelling = DRUM_MIDIS.get(sound, NO_MIDI), sound
+                if (first is None or onset >= first) and (last is None or onset < last):
+                    events.add(track, staff, onset, duration, midi, spelling, velocity, chord, derived)
+            position += length
+    return events
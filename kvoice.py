@@ -0,0 +1,224 @@
+import heapq
+import itertools
+import random
+import time
+
+_MODULUS = 12
+_HALFMODULUS = _MODULUS // 2
+# from this many voices on, the search bounds the cost of reaching the remaining targets as well; for fewer voices
+# the search is so small that calculating that bound costs more time than it saves
+_COVERAGE_BOUND_VOICES = 7
+
+
+def pc_path(source_pc, target_pc):
+    """
+    :return: shortest signed path from source_pc to target_pc (a tritone goes up, as in bijective_vl)
+    """
+    path = (target_pc - source_pc) % _MODULUS
+    return path - _MODULUS if path > _HALFMODULUS else path
+
+
+def ranged_path(voice, target_pc, pitch_range):
+    """
+    :param voice: midi number
+    :param pitch_range: (lowest, highest) midi number a voice may move to, or None
+    :return: shortest signed path from voice to target_pc that stays in pitch_range (going an octave further if
+             needed), or None if there is none
+    """
+    path = pc_path(voice % _MODULUS, target_pc)
+    if pitch_range is None:
+        return path
+    for p in sorted([path, path - _MODULUS, path + _MODULUS], key=abs):
+        if pitch_range[0] <= voice + p <= pitch_range[1]:
+            return p
+    return None
+
+
+def kvoice_vl(voices, target_pcs, top_n=1, pitch_range=None):
+    """
+    find the most efficient voice leadings that keep the number of voices fixed, between chords of any cardinality:
+    every voice moves to one of the target pitch classes, and all target pitch classes are reached (if there are
+    fewer voices than target pitch classes, every voice gets a different one). This gives the same voice leadings as
+    iterating bijective_vl over every doubling of both chords, but without enumerating the doublings: voices are
+    assigned one at a time (in a canonical order), trying the closest target first, and a partial voice leading is
+    abandoned as soon as it can't beat the top_n best ones found so far. For chords of up to seven voices, iterating
+    the doublings is faster in pure python though (see benchmark); the search only catches up at about eight voices.
+
+    :param voices: list of midi numbers (or pitch classes), one per voice; pitches may be doubled
+    :param target_pcs: list of pitch classes (duplicates are ignored)
+    :param top_n: number of voice leadings to return
+    :param pitch_range: (lowest, highest) midi number the voices may move to, or None; moves that leave the range
+                        are pruned from the search (voices must be midi numbers then)
+    :return: list of up to top_n [size, paths] pairs, smallest first, where paths holds a [voice, path] pair for every
+             voice (in the order of voices); voice leadings of the same size are ordered by their target pitch classes.
+             The list is empty if no voice leading stays in pitch_range.
+    """
+    targets = sorted(set(pc % _MODULUS for pc in target_pcs))
+    k = len(voices)
+    if not k or not targets:
+        return []
+    needed = min(k, len(targets))
+    paths = [[ranged_path(v, t, pitch_range) for t in targets] for v in voices]
+    costs = [[abs(p) if p is not None else None for p in row] for row in paths]
+    order = [sorted([j for j in range(len(targets)) if costs[i][j] is not None], key=lambda j: (costs[i][j], j))
+             for i in range(k)]
+    if not all(order):
+        return []  # a voice can't reach any target without leaving the range
+    # lower bound for the cost of the voices from i on: every voice takes its closest target
+    rest = [0] * (k + 1)
+    for i in range(k - 1, -1, -1):
+        rest[i] = rest[i + 1] + costs[i][order[i][0]]
+    # if every target must be reached, each target that isn't reached yet costs one of the voices from i on at least
+    # regret[i][j] on top of its closest target (and a different voice for every such target)
+    cover = len(targets) <= k and k >= _COVERAGE_BOUND_VOICES
+    regret = [[None] * len(targets) for i in range(k + 1)]
+    if cover:
+        for i in range(k - 1, -1, -1):
+            for j in range(len(targets)):
+                extra = costs[i][j] - costs[i][order[i][0]] if costs[i][j] is not None else None
+                later = regret[i + 1][j]
+                regret[i][j] = extra if later is None or (extra is not None and extra < later) else later
+
+    best = []  # heap of (-size, negated assignment) for the top_n best voice leadings found so far
+    assignment = [0] * k
+    used = [0] * len(targets)
+
+    def search(i, size, covered):
+        if i == k:
+            entry = (-size, [-j for j in assignment])
+            if len(best) < top_n:
+                heapq.heappush(best, entry)
+            elif entry > best[0]:
+                heapq.heapreplace(best, entry)
+            return
+        # the lower bound for the voices after this one, without the regret of the target this voice reaches
+        lower = rest[i + 1]
+        unreachable = 0
+        if cover:
+            for j in range(len(targets)):
+                if not used[j]:
+                    if regret[i + 1][j] is None:
+                        unreachable += 1
+                    else:
+                        lower += regret[i + 1][j]
+        for j in order[i]:
+            if used[j] and k < len(targets):
+                continue  # not enough voices to double anything
+            still_needed = needed - covered - (0 if used[j] else 1)
+            if still_needed > k - i - 1:
+                continue  # the remaining voices can't reach all targets anymore
+            newsize = size + costs[i][j]
+            if cover and not used[j]:
+                if unreachable - (regret[i + 1][j] is None) > 0:
+                    continue  # some target can't be reached by the voices after this one
+                bound = newsize + lower - (regret[i + 1][j] or 0)
+            elif unreachable:
+                continue
+            else:
+                bound = newsize + lower
+            if len(best) == top_n and bound > -best[0][0]:
+                continue
+            used[j] += 1
+            assignment[i] = j
+            search(i + 1, newsize, covered + (1 if used[j] == 1 else 0))
+            used[j] -= 1
+
+    search(0, 0, 0)
+    result = []
+    for negsize, negassignment in sorted(best, reverse=True):
+        chosen = [-j for j in negassignment]
+        result.append([-negsize, [[voices[i], paths[i][j]] for i, j in enumerate(chosen)]])
+    return result
+
+
+def brute_force_vl(voices, target_pcs, top_n=1):
+    """
+    same as kvoice_vl, by trying every assignment of target pitch classes to voices (only useful to check kvoice_vl)
+    """
+    targets = sorted(set(pc % _MODULUS for pc in target_pcs))
+    k = len(voices)
+    if not k or not targets:
+        return []
+    needed = min(k, len(targets))
+    found = []
+    for assignment in itertools.product(range(len(targets)), repeat=k):
+        if len(set(assignment)) != needed:
+            continue
+        paths = [pc_path(voices[i] % _MODULUS, targets[j]) for i, j in enumerate(assignment)]
+        found.append((sum(abs(p) for p in paths), assignment, paths))
+    found.sort(key=lambda f: (f[0], f[1]))
+    return [[size, [[voices[i], p] for i, p in enumerate(paths)]] for (size, assignment, paths) in found[:top_n]]
+
+
+def doublings(pcs, k):
+    """
+    :return: every way to double the (sorted, distinct) pitch classes pcs to k voices, in canonical order
+    """
+    return [sorted(pcs + list(extra)) for extra in itertools.combinations_with_replacement(pcs, k - len(pcs))]
+
+
+def doubling_vl(voices, target_pcs):
+    """
+    size of the best voice leading as the voiceleading.py docstring suggests: iterate bijective_vl over every doubling
+    of the target chord (voices must be at least as many as the target pitch classes)
+    """
+    from voiceleading import bijective_vl
+    source = sorted(v % _MODULUS for v in voices)
+    targets = sorted(set(pc % _MODULUS for pc in target_pcs))
+    best = None
+    for doubled in doublings(targets, len(voices)):
+        bijective_vl(source, doubled)
+        size = min(s for (p, s) in bijective_vl.full_list)
+        best = size if best is None else min(best, size)
+    return best
+
+
+def timed(function, cases, repeat=3):
+    """
+    :return: (best time in seconds of repeat runs of function over all cases, results of the last run)
+    """
+    best = None
+    for r in range(repeat):
+        start = time.perf_counter()
+        results = [function(*case) for case in cases]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def benchmark(max_voices=8, max_brute_force_voices=6, problems=200, top_n=3, seed=1):
+    """
+    time kvoice_vl on random chords with up to max_voices voices, and check it against the alternatives:
+     - the doubling iteration, which only finds the size of the best voice leading, against kvoice_vl for the best one
+     - brute force (up to max_brute_force_voices voices), against kvoice_vl for the top_n best ones
+    """
+    rng = random.Random(seed)
+    print("voices  problems  doublings (ms)  kvoice_vl top 1 (ms)  speedup  brute force (ms)  kvoice_vl top {0} (ms)  "
+          "speedup".format(top_n))
+    for k in range(2, max_voices + 1):
+        cases = []
+        for p in range(problems):
+            voices = [rng.randrange(36, 84) for v in range(k)]
+            cases.append((voices, rng.sample(range(_MODULUS), rng.randrange(2, k + 1))))
+        doubling, sizes = timed(doubling_vl, cases)
+        single, found = timed(lambda v, t: kvoice_vl(v, t), cases)
+        if sizes != [f[0][0] for f in found]:
+            print("*** ERROR: kvoice_vl doesn't agree with the doubling iteration for {0} voices".format(k))
+        brute = "-"
+        pruned = "-"
+        speedup = "-"
+        if k <= max_brute_force_voices:
+            brute, expected = timed(lambda v, t: brute_force_vl(v, t, top_n), cases, 1)
+            pruned, found = timed(lambda v, t: kvoice_vl(v, t, top_n), cases)
+            if found != expected:
+                print("*** ERROR: kvoice_vl doesn't agree with brute force for {0} voices".format(k))
+            speedup = "{0:.1f}x".format(brute / pruned if pruned else 0.0)
+            brute = "{0:.2f}".format(1000 * brute / problems)
+            pruned = "{0:.2f}".format(1000 * pruned / problems)
+        print("{0:>6}  {1:>8}  {2:>14.2f}  {3:>20.2f}  {4:>6.1f}x  {5:>16}  {6:>20}  {7:>7}".format(
+                k, problems, 1000 * doubling / problems, 1000 * single / problems,
+                doubling / single if single else 0.0, brute, pruned, speedup))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,174 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+RENDERED_EXTENSIONS = [".pdf", ".midi", ".mid"]
+CACHE_COMPLETE_MARKER = "complete"
+CACHE_BASENAME = "result"
+
+
+def default_cachedir():
+    """
+    :return: folder in which rendered lilypond results are cached if nothing else is specified
+    """
+    return os.path.join(os.path.expanduser("~"), ".cache", "bluegrass", "lilypond")
+
+
+class RenderJob(object):
+    """
+    result of rendering one lilypond file
+    """
+    def __init__(self, inputfile):
+        """
+        holds
+         - inputfile = lilypond file that was rendered
+         - digest = content hash that identifies the rendered results in the cache
+         - outputs = list of files (pdf, midi) that were produced next to the inputfile
+         - cached = true if the outputs were taken from the cache instead of running lilypond
+         - returncode = exit code of the lilypond process (0 if results came from the cache)
+         - elapsed = wall clock time (in seconds) spent on this job
+         - log = everything lilypond printed while rendering
+        """
+        self.inputfile = inputfile
+        self.digest = None
+        self.outputs = []
+        self.cached = False
+        self.returncode = 0
+        self.elapsed = 0.0
+        self.log = ""
+
+    def succeeded(self):
+        return self.returncode == 0
+
+
+class LilypondRunner(object):
+    """
+    class that runs the lilypond executable on one or more generated files using a bounded pool of workers.
+    Results are cached by content hash, so files that did not change since the previous run are never rendered again.
+    """
+    def __init__(self, lilypond="lilypond", cachedir=None, jobs=None, extra_args=None):
+        """
+        :param lilypond: path to the lilypond executable (anything that accepts lilypond's command line will do)
+        :param cachedir: folder in which rendered results are kept
+        :param jobs: maximum number of lilypond processes running at the same time (default: number of cpus)
+        :param extra_args: list of additional command line arguments to pass to lilypond
+        """
+        self.lilypond = lilypond
+        self.cachedir = cachedir if cachedir else default_cachedir()
+        self.jobs = jobs if jobs else (os.cpu_count() or 1)
+        self.extra_args = extra_args if extra_args else []
+
+    def content_hash(self, filename):
+        """
+        :param filename: lilypond file
+        :return: hash over the file contents and everything else that influences the rendered result
+        """
+        h = hashlib.sha1()
+        h.update(self.lilypond.encode("utf-8"))
+        for a in self.extra_args:
+            h.update(b"\0" + a.encode("utf-8"))
+        h.update(b"\0")
+        with open(filename, "rb") as f:
+            h.update(f.read())
+        return h.hexdigest()
+
+    def render(self, filenames):
+        """
+        render all given lilypond files
+        :param filenames: list of lilypond files
+        :return: list of RenderJob, in the same order as filenames
+        """
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            return list(pool.map(self.render_one, filenames))
+
+    def render_one(self, filename):
+        """
+        render a single lilypond file, or fetch its results from the cache if it was rendered before
+        :param filename: lilypond file
+        :return: RenderJob
+        """
+        job = RenderJob(filename)
+        start = time.perf_counter()
+        filename = os.path.abspath(filename)
+        destfolder = os.path.dirname(filename)
+        basename = os.path.splitext(os.path.basename(filename))[0]
+        job.digest = self.content_hash(filename)
+        cacheentry = os.path.join(self.cachedir, job.digest)
+        if os.path.isfile(os.path.join(cacheentry, CACHE_COMPLETE_MARKER)):
+            job.cached = True
+            job.outputs = self.copy_outputs(cacheentry, CACHE_BASENAME, destfolder, basename)
+        else:
+            workfolder = tempfile.mkdtemp(prefix="bluegrass-")
+            try:
+                command = [self.lilypond] + self.extra_args + ["-o", os.path.join(workfolder, basename), filename]
+                try:
+                    proc = subprocess.run(command, cwd=destfolder, stdout=subprocess.PIPE,
+                                          stderr=subprocess.STDOUT)
+                    job.returncode = proc.returncode
+                    job.log = proc.stdout.decode("utf-8", errors="replace")
+                except OSError as e:
+                    job.returncode = -1
+                    job.log = "couldn't run {0}: {1}".format(self.lilypond, e)
+                if job.succeeded():
+                    self.store_in_cache(workfolder, basename, cacheentry)
+                    job.outputs = self.copy_outputs(workfolder, basename, destfolder, basename)
+            finally:
+                shutil.rmtree(workfolder, ignore_errors=True)
+        job.elapsed = time.perf_counter() - start
+        return job
+
+    def store_in_cache(self, workfolder, basename, cacheentry):
+        """
+        copy the rendered results to the cache; the entry only becomes visible once it is complete
+        so that concurrent runs never pick up half-written results
+        """
+        os.makedirs(self.cachedir, exist_ok=True)
+        tmpentry = tempfile.mkdtemp(prefix=os.path.basename(cacheentry) + ".", dir=self.cachedir)
+        self.copy_outputs(workfolder, basename, tmpentry, CACHE_BASENAME)
+        with open(os.path.join(tmpentry, CACHE_COMPLETE_MARKER), "w") as f:
+            f.write(basename)
+        try:
+            os.rename(tmpentry, cacheentry)
+        except OSError:
+            # another job rendered the same content in the meantime
+            shutil.rmtree(tmpentry, ignore_errors=True)
+
+    @staticmethod
+    def copy_outputs(srcfolder, srcbasename, destfolder, destbasename):
+        """
+        copy all rendered files (pdf, midi) from srcfolder to destfolder, renaming them on the fly
+        :return: list of copied files
+        """
+        copied = []
+        for ext in RENDERED_EXTENSIONS:
+            src = os.path.join(srcfolder, srcbasename + ext)
+            if os.path.isfile(src):
+                dest = os.path.join(destfolder, destbasename + ext)
+                shutil.copyfile(src, dest)
+                copied.append(dest)
+        return copied
+
+    @staticmethod
+    def report(jobs):
+        """
+        print a summary of the rendering jobs
+        :param jobs: list of RenderJob
+        :return: true if all jobs succeeded
+        """
+        ok = True
+        for job in jobs:
+            if not job.succeeded():
+                ok = False
+                print("*** ERROR: lilypond failed on {0} (exit code {1}) after {2:.2f}s.".format(
+                        job.inputfile, job.returncode, job.elapsed))
+                print(job.log)
+            elif job.cached:
+                print("*** {0} unchanged: reused cached results in {1:.2f}s: {2}".format(
+                        job.inputfile, job.elapsed, ", ".join(job.outputs)))
+            else:
+                print("*** Rendered {0} in {1:.2f}s: {2}".format(job.inputfile, job.elapsed, ", ".join(job.outputs)))
+        return ok
@@ -0,0 +1,368 @@
+import asyncio
+import contextlib
+import heapq
+import json
+import sys
+import time
+
+from derivationplanner import DerivationPlanner, DIRECT, ERROR, split_elements
+from lily2stream import Lily2Stream
+from stylepack import enumerate_jobs
+
+DEFAULT_TEMPO = 120  # quarter notes per minute
+DEFAULT_VELOCITY = 90
+PERCUSSION_CHANNEL = 9  # general midi reserves channel 10 for drums
+
+NOTE_ON = "note_on"
+NOTE_OFF = "note_off"
+
+
+def fragment_notes(fragment):
+    """
+    :param fragment: lilypond fragment, e.g. "{ c'8 <g' c'' e''>4 }"
+    :return: (list of (onset, duration, midi number), length of the fragment); times are in quarter notes and
+             tied notes are merged into a single note
+    """
+    s = Lily2Stream().parse(fragment).flatten()
+    notes = []
+    pending = {}  # midi number -> note that is tied to the next note
+    for n in s.notes:
+        tied_in = n.tie is not None and n.tie.type in ("stop", "continue")
+        tied_out = n.tie is not None and n.tie.type in ("start", "continue")
+        still_pending = {}
+        for p in n.pitches:
+            note = pending.get(p.midi) if tied_in else None
+            if note is not None and note[0] + note[1] == n.offset:
+                note[1] += n.quarterLength
+            else:
+                note = [float(n.offset), float(n.quarterLength), p.midi]
+                notes.append(note)
+            if tied_out:
+                still_pending[p.midi] = note
+        pending = still_pending
+    return [tuple(note) for note in notes], float(s.highestTime)
+
+
+def lilypond_note_midi(name):
+    """
+    :param name: lilypond note name without octave marks, e.g. "bes"
+    :return: midi number of the note (in lilypond's default octave)
+    """
+    return Lily2Stream().parse("{ " + name + " }").flatten().notes[0].pitches[0].midi
+
+
+class MidiEvent(object):
+    """
+    a single timestamped midi message
+    """
+    def __init__(self, time, kind, track, staff, channel, note, velocity=DEFAULT_VELOCITY):
+        """
+        holds
+         - time = when the event is due, in seconds since the engine started
+         - kind = NOTE_ON or NOTE_OFF
+         - track, staff = where the note comes from in the style
+         - channel, note, velocity = midi message content
+        """
+        self.time = time
+        self.kind = kind
+        self.track = track
+        self.staff = staff
+        self.channel = channel
+        self.note = note
+        self.velocity = velocity
+
+    def as_dict(self):
+        return {"time": round(self.time, 6), "type": self.kind, "track": self.track, "staff": self.staff,
+                "channel": self.channel, "note": self.note, "velocity": self.velocity}
+
+
+class MemorySink(object):
+    """
+    sink that keeps all events in memory, e.g. for tests; a sink is anything with send(event) and close()
+    """
+    def __init__(self):
+        self.events = []
+
+    def send(self, event):
+        self.events.append(event)
+
+    def close(self):
+        pass
+
+
+class FileSink(object):
+    """
+    sink that writes every event as a line of json to a file ("-" for stdout)
+    """
+    def __init__(self, fname):
+        self.f = sys.stdout if fname == "-" else open(fname, "w")
+
+    def send(self, event):
+        self.f.write(json.dumps(event.as_dict(), sort_keys=True) + "\n")
+        self.f.flush()
+
+    def close(self):
+        if self.f is not sys.stdout:
+            self.f.close()
+
+
+class JitterStats(object):
+    """
+    keeps track of how late events were sent compared to when they were due
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, lateness):
+        self.count += 1
+        self.total += lateness
+        self.max = max(self.max, lateness)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class ChordTable(object):
+    """
+    every chord a style can play in every staff, as lists of notes, precomputed when the style is loaded
+    so that playing a chord never needs a derivation
+    """
+    def __init__(self, compiler, stylename):
+        """
+        holds
+         - compiler = StyleCompiler used to load the style and derive chords
+         - style = the loaded style
+         - staves = list of (track, staff) that play chords, in style order
+         - channels = map of (track, staff) to midi channel
+         - notes = map of (track, staff, chord or derivation key) to (list of notes, length in quarter notes)
+         - late = number of chords that had to be derived while playing
+        """
+        self.compiler = compiler
+        self.compiler.seed = compiler.song_seed({})
+        self.style = compiler.init_style(stylename)
+        self.planner = DerivationPlanner({}, self.style)
+        self.staves = []
+        self.channels = {}
+        self.notes = {}
+        self.late = 0
+        for name in self.style["tracks"]:
+            for staff in self.style["tracks"][name]["staves"]:
+                if "chords" in self.style["tracks"][name]["staves"][staff]:
+                    self.channels[(name, staff)] = len(self.staves) + (len(self.staves) >= PERCUSSION_CHANNEL)
+                    self.staves.append((name, staff))
+
+    def build(self):
+        """
+        derive (or take from the style pack) every chord of every staff
+        :return: number of chords in the table
+        """
+        start = time.time()
+        for name, staff in self.staves:
+            chords = self.style["tracks"][name]["staves"][staff]["chords"]
+            for chord in chords:
+                self.notes[(name, staff, chord)] = fragment_notes(chords[chord])
+            for job in enumerate_jobs(self.style, name, staff):
+                key = (name, staff, job.derivation_key())
+                if key not in self.notes:
+                    self.notes[key] = fragment_notes(self.compiler.derived_fragment(self.style, job)[0])
+        print("*** Precomputed {0} chords in {1:.1f}s".format(len(self.notes), time.time() - start))
+        return len(self.notes)
+
+    def lookup(self, chord):
+        """
+        :param chord: chord token, e.g. "VIm_a"
+        :return: map of (track, staff) to (list of notes, length in quarter notes); staves that can't play the chord
+                 are left out
+        """
+        result = {}
+        for name, staff in self.staves:
+            job = self.planner.resolve(name, staff, chord, self.style["tracks"][name]["staves"][staff]["chords"])
+            if job.kind == DIRECT:
+                result[(name, staff)] = self.notes[(name, staff, chord)]
+            elif job.is_derivation():
+                key = (name, staff, job.derivation_key())
+                if key not in self.notes:
+                    # not reachable from enumerate_jobs (e.g. a double accidental): this blows the latency budget
+                    self.late += 1
+                    self.notes[key] = fragment_notes(self.compiler.derived_fragment(self.style, job)[0])
+                result[(name, staff)] = self.notes[key]
+            elif job.kind == ERROR:
+                print("*** WARNING: {0}".format(job.error))
+        return result
+
+
+class LiveEngine(object):
+    """
+    plays chords as they come in: every chord token is turned into timestamped midi events for all staves of a
+    style, scheduled one bar ahead, and sent to a sink when they are due
+    """
+    def __init__(self, table, sink, tempo=DEFAULT_TEMPO, transpose=0):
+        """
+        :param table: ChordTable (built)
+        :param sink: where the events go (e.g. MemorySink or FileSink)
+        :param tempo: quarter notes per minute
+        :param transpose: number of semitones to transpose everything by
+        holds (besides the above)
+         - queue = chord tokens waiting to be scheduled (None to stop)
+         - events = heap of (time, order, sequence number, MidiEvent) waiting to be sent
+         - cursor = time (in seconds since start) at which the next chord starts
+         - jitter = JitterStats
+         - chords, underruns, unknown = statistics
+        """
+        self.table = table
+        self.sink = sink
+        self.seconds_per_quarter = 60.0 / tempo
+        self.transpose = transpose
+        self.queue = asyncio.Queue()
+        self.events = []
+        self.sequence = 0
+        self.cursor = None
+        self.start = None
+        self.finished = False
+        self.wakeup = None
+        self.jitter = JitterStats()
+        self.chords = 0
+        self.underruns = 0
+        self.unknown = 0
+
+    def now(self):
+        return asyncio.get_event_loop().time() - self.start
+
+    def feed(self, chord):
+        """
+        queue a chord token (or a string with several tokens) to be played after the chords fed before
+        """
+        for c in split_elements(chord):
+            self.queue.put_nowait(c)
+
+    def stop(self):
+        """
+        stop after all chords fed so far have been played
+        """
+        self.queue.put_nowait(None)
+
+    def schedule(self, chord):
+        """
+        turn a chord into events that start at the cursor, and move the cursor to the end of the chord
+        :return: time at which the chord starts, or None if no staff can play it
+        """
+        fragments = self.table.lookup(chord)
+        if not fragments:
+            self.unknown += 1
+            return None
+        now = self.now()
+        if self.cursor is None or self.cursor < now:
+            if self.cursor is not None:
+                self.underruns += 1  # the chord arrived too late to follow the previous one seamlessly
+            self.cursor = now
+        length = 0
+        for (name, staff), (notes, fragment_length) in fragments.items():
+            channel = self.table.channels[(name, staff)]
+            for onset, duration, midi in notes:
+                t = self.cursor + onset * self.seconds_per_quarter
+                self.push(MidiEvent(t, NOTE_ON, name, staff, channel, midi + self.transpose))
+                self.push(MidiEvent(t + duration * self.seconds_per_quarter, NOTE_OFF, name, staff, channel,
+                                    midi + self.transpose, 0))
+            length = max(length, fragment_length)
+        start = self.cursor
+        self.cursor += length * self.seconds_per_quarter
+        self.chords += 1
+        self.wakeup.set()
+        return start
+
+    def push(self, event):
+        # note offs go before note ons at the same time, so that a repeated note is retriggered
+        heapq.heappush(self.events, (event.time, event.kind == NOTE_ON, self.sequence, event))
+        self.sequence += 1
+
+    async def sleep_until(self, t):
+        delay = t - self.now()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def run(self):
+        """
+        schedule the queued chords until stop() is called, then wait until every event has been sent
+        """
+        self.wakeup = asyncio.Event()
+        self.start = asyncio.get_event_loop().time()
+        dispatcher = asyncio.ensure_future(self.dispatch())
+        while True:
+            chord = await self.queue.get()
+            if chord is None:
+                break
+            start = self.schedule(chord)
+            if start is not None:
+                # one bar lookahead: only accept the next chord once the one just scheduled starts playing
+                await self.sleep_until(start)
+        self.finished = True
+        self.wakeup.set()
+        await dispatcher
+        self.sink.close()
+
+    async def dispatch(self):
+        """
+        send every event to the sink when it is due
+        """
+        while self.events or not self.finished:
+            if not self.events:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            due = self.events[0][0]
+            if due > self.now():
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), due - self.now())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            event = heapq.heappop(self.events)[3]
+            self.jitter.add(self.now() - event.time)
+            self.sink.send(event)
+
+    def report(self):
+        print("*** Played {0} chords ({1} events); scheduling jitter mean {2:.2f} ms, max {3:.2f} ms; "
+              "{4} underruns, {5} chords derived late, {6} chords not in the style".format(
+                self.chords, self.jitter.count, 1000 * self.jitter.mean(), 1000 * self.jitter.max, self.underruns,
+                self.table.late, self.unknown))
+
+
+async def play_lines(engine, f):
+    """
+    feed chords to the engine as they are read from a file (e.g. stdin), one or more tokens per line
+    """
+    loop = asyncio.get_event_loop()
+    player = asyncio.ensure_future(engine.run())
+    while True:
+        line = await loop.run_in_executor(None, f.readline)
+        if not line:
+            break
+        engine.feed(line)
+    engine.stop()
+    await player
+
+
+def play(compiler, stylename, chordfile=sys.stdin, eventsfile="-", tempo=None, key=None):
+    """
+    play chords read from chordfile live, in the given style; events are written to eventsfile (as json lines). If
+    the events go to stdout, all messages go to stderr, so that stdout only holds events.
+    :param tempo: quarter notes per minute (default: from the style)
+    :param key: lilypond note name to transpose to (default: the key the style is written in)
+    """
+    sink = FileSink(eventsfile)
+    with contextlib.redirect_stdout(sys.stderr if sink.f is sys.stdout else sys.stdout):
+        table = ChordTable(compiler, stylename)
+        table.build()
+        if tempo is None:
+            tempo = table.style["midi"]["tempo"] if "midi" in table.style and "tempo" in table.style["midi"] \
+                else DEFAULT_TEMPO
+        transpose = 0
+        if key is not None:
+            transpose = lilypond_note_midi(key) - lilypond_note_midi(compiler.reference_pitch(table.style))
+        engine = LiveEngine(table, sink, tempo, transpose)
+        print("*** Playing {0} at {1} bpm; waiting for chords".format(stylename, tempo))
+        asyncio.run(play_lines(engine, chordfile))
+        engine.report()
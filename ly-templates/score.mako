@@ -18,6 +18,16 @@ global = {
 %% begin of style fragment definitions
 %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
 
+<%def name="rhythms(rhythmdefinitions)">\
+% if rhythmdefinitions:
+
+%%%% rhythms shared by the chords
+% for rhythm in rhythmdefinitions:
+${rhythm}
+% endfor
+% endif
+</%def>\
+${rhythms(rhythmdefinitions)}\
 % if chorddefinitions:
 % for c in chorddefinitions:
 
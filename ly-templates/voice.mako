@@ -1,4 +1,8 @@
+% if transposition:
+${voicefragmentname} = \transpose ${transposition[0]} ${transposition[1]} {
+% else:
 ${voicefragmentname} = {
+% endif
 \global
 % for c in musicelements:
 ${c}
@@ -0,0 +1,84 @@
+DEFAULT_BEAM_WIDTH = 8
+DEFAULT_CANDIDATES = 4
+
+
+def vl_size(source, target):
+    """
+    size of the smallest voice leading between two chords in pitch space; voices may be doubled
+    (the pitch space counterpart of nonbijective_vl, see Tymoczko "The Geometry of Musical Chords")
+    :param source: sorted list of midi numbers (or None for silence)
+    :param target: sorted list of midi numbers (or None for silence)
+    :return: sum of the distances (in semitones) travelled by all voices; 0 if either chord is silent
+    """
+    if not source or not target:
+        return 0
+    previous_row = None
+    for t in target:
+        row = []
+        for j, s in enumerate(source):
+            d = abs(t - s)
+            if previous_row is None and j == 0:
+                row.append(d)
+            elif previous_row is None:
+                row.append(d + row[j - 1])
+            elif j == 0:
+                row.append(d + previous_row[0])
+            else:
+                row.append(d + min(row[j - 1], previous_row[j], previous_row[j - 1]))
+        previous_row = row
+    return previous_row[-1]
+
+
+class ProgressionVoiceLeader(object):
+    """
+    class to choose voicings for a whole chord progression at once, such that the total voice leading cost
+    from chord to chord is minimal. Uses the Viterbi algorithm with a beam: runtime is linear in the length
+    of the progression (O(length * beam_width * candidates)).
+    """
+    def __init__(self, beam_width=DEFAULT_BEAM_WIDTH):
+        """
+        :param beam_width: number of partial solutions kept after every chord (at least 1)
+        """
+        self.beam_width = max(1, beam_width)
+
+    def choose(self, steps):
+        """
+        :param steps: list (one entry per chord in the progression) of lists of candidate voicings; a candidate
+                      voicing is a sorted list of midi numbers (or None if silent). Candidates are ordered from most
+                      to least preferred, which is used to break ties.
+        :return: (list with the index of the chosen candidate for every step, total cost)
+        """
+        if not steps:
+            return [], 0
+        # beam: candidate index -> (cost, tie breaker, index in history of the previous step)
+        beam = {k: (0, k, None) for k in range(len(steps[0]))}
+        beam = self.prune(beam)
+        history = [beam]
+        for t in range(1, len(steps)):
+            previous = history[-1]
+            new_beam = {}
+            for k, candidate in enumerate(steps[t]):
+                best = None
+                for j, (cost, tiebreak, unused) in previous.items():
+                    c = (cost + vl_size(steps[t - 1][j], candidate), tiebreak + k, j)
+                    if best is None or c < best:
+                        best = c
+                new_beam[k] = best
+            beam = self.prune(new_beam)
+            history.append(beam)
+
+        # trace back the cheapest path
+        k = min(history[-1], key=lambda i: history[-1][i][:2])
+        total = history[-1][k][0]
+        chosen = []
+        for t in reversed(range(len(steps))):
+            chosen.append(k)
+            k = history[t][k][2]
+        chosen.reverse()
+        return chosen, total
+
+    def prune(self, beam):
+        if len(beam) <= self.beam_width:
+            return beam
+        kept = sorted(beam, key=lambda k: beam[k][:2])[:self.beam_width]
+        return {k: beam[k] for k in kept}
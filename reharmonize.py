@@ -0,0 +1,366 @@
+import io
+import os
+import re
+import sys
+
+from ruamel.yaml import YAML
+from ruamel.yaml.scalarstring import FoldedScalarString
+
+from depfile import same_content, write_if_changed
+from derivationplanner import DerivationPlanner, DIRECT, ERROR, SPLITREGEX, is_derivable, split_elements, \
+    split_modifier
+from lily2stream import Lily2Stream
+from numberutils import split_roman_prefix
+from progression import vl_size
+from rhythmskeleton import split_pitches
+from songkeys import keyed_filename, lilypond_midi
+
+DEFAULT_TOP = 3
+DEFAULT_MAX_SUBSTITUTIONS = 4
+
+# spelling of the chord roots that substitutions lead to, by semitones above I
+ROOT_DEGREES = ["I", "IIb", "II", "IIIb", "III", "IV", "Vb", "V", "VIb", "VI", "VIIb", "VII"]
+
+
+class ChordToken(object):
+    """
+    a roman numeral chord token of a song, e.g. VIbm7_a: degree VI, accidental b, quality m7, style chord suffix a
+    """
+    def __init__(self, token, root, quality, suffix):
+        """
+        holds
+         - token = the token as written in the song
+         - root = semitones of the root above I (0-11)
+         - quality = modifier without the suffix, e.g. "m7", "7" or ""
+         - suffix = the part after "_" that selects the style chord to derive from (None if there is none)
+        """
+        self.token = token
+        self.root = root
+        self.quality = quality
+        self.suffix = suffix
+
+    @staticmethod
+    def parse(token, distance_from_I):
+        """
+        :param distance_from_I: function that maps a degree with accidental (e.g. "VIb") to semitones above I
+        :return: ChordToken, or None if token is not a roman numeral chord
+        """
+        if not is_derivable(token):
+            return None
+        number, accidental, modifier = split_roman_prefix(token)
+        if number is None:
+            return None
+        suffix, quality = split_modifier(modifier)
+        return ChordToken(token, distance_from_I(number + accidental) % 12, quality,
+                          suffix if "_" in modifier else None)
+
+    def dominant(self):
+        return self.quality == "7"
+
+    def move(self, semitones, quality):
+        """
+        :return: chord token with the root moved by semitones and the given quality, keeping the style chord suffix
+        """
+        token = ROOT_DEGREES[(self.root + semitones) % 12] + quality
+        return token + "_" + self.suffix if self.suffix is not None else token
+
+
+def tritone_substitution(chord, following):
+    """
+    a dominant seventh chord is replaced by the dominant seventh chord a tritone away, e.g. V7 -> IIb7
+    """
+    return chord.move(6, "7") if chord.dominant() else None
+
+
+def relative_minor(chord, following):
+    """
+    a major chord is replaced by the minor chord a minor third below, e.g. IV -> IIm, V7 -> IIIm7
+    """
+    return chord.move(9, "m" + chord.quality) if chord.quality in ["", "7"] else None
+
+
+def relative_major(chord, following):
+    """
+    a minor chord is replaced by the major chord a minor third above, e.g. VIm -> I, IIm7 -> IV7
+    """
+    return chord.move(3, chord.quality[1:]) if chord.quality in ["m", "m7"] else None
+
+
+def secondary_dominant(chord, following):
+    """
+    a chord is replaced by the dominant seventh chord of the chord that follows it, e.g. I IIm -> VI7 IIm
+    """
+    if following is None or following.root == chord.root:
+        return None
+    return chord.move((following.root + 7 - chord.root) % 12, "7")
+
+
+# substitutions that are tried for every chord: (name, function that maps a ChordToken and the ChordToken that follows
+# it (or None) to the substituted chord token, or None if the substitution doesn't apply)
+SUBSTITUTION_RULES = [
+    ("tritone substitution", tritone_substitution),
+    ("relative minor", relative_minor),
+    ("relative major", relative_major),
+    ("secondary dominant", secondary_dominant),
+]
+
+
+class ChordPosition(object):
+    """
+    one chord of the harmony of a song, with the chords that may replace it
+    """
+    def __init__(self, element, index, token):
+        """
+        holds
+         - element, index = where the chord is: index of the harmony element and of the token in its chords
+         - token = chord token as written in the song
+         - options = list of (chord token, name of the substitution rule or None for the chord as written)
+        """
+        self.element = element
+        self.index = index
+        self.token = token
+        self.options = [(token, None)]
+
+
+class Reharmonization(object):
+    """
+    a candidate progression: a chord token for every position, and how smoothly it voice leads in the style
+    """
+    def __init__(self, cost, tokens, rules):
+        """
+        holds
+         - cost = total voice leading cost (in semitones) from chord to chord, summed over the staves of the style
+         - tokens = chord token for every position
+         - rules = list of (index of the position, rule name) of the substitutions made
+        """
+        self.cost = cost
+        self.tokens = tokens
+        self.rules = rules
+
+
+class Reharmonizer(object):
+    """
+    searches substitute chord progressions for the harmony of a song that voice lead smoothly in the style of the
+    song. The voice leading cost between two chords is the size of the smallest voice leading (see
+    progression.vl_size) between the pitches the staves of the style play for them, computed on midi numbers only.
+    Chords are derived (or taken from the style pack) once, and the search keeps only the best partial progressions
+    per chord and number of substitutions, so its runtime is linear in the length of the song.
+    """
+    def __init__(self, compiler, song, style):
+        """
+        holds
+         - compiler = StyleCompiler that derives the chords, set up for song
+         - song, style = song to reharmonize, and its (resolved) style
+         - planner = DerivationPlanner that decides how a chord is resolved in a staff
+         - staves = list of (track, staff) of the style that play chords
+         - voicings = map of chord token to a list with the sorted midi numbers every staff plays for it (None if
+           a staff is silent), or None if the style can't play the chord
+         - costs = map of (chord token, chord token) to the voice leading cost between them
+        """
+        self.compiler = compiler
+        self.song = song
+        self.style = style
+        self.planner = DerivationPlanner(song, style)
+        self.staves = []
+        for name in style.get("tracks", {}):
+            for staff in style["tracks"][name].get("staves", {}):
+                if "chords" in style["tracks"][name]["staves"][staff]:
+                    self.staves.append((name, staff))
+        self.voicings = {}
+        self.costs = {}
+
+    def positions(self):
+        """
+        :return: list of ChordPosition for every chord in the harmony of the song, in song order, with the
+                 substitutions the style can play
+        """
+        positions = []
+        for e, element in enumerate(self.song.get("harmony") or []):
+            if "chords" in element:
+                for i, token in enumerate(split_elements(element["chords"])):
+                    positions.append(ChordPosition(e, i, token))
+        chords = [ChordToken.parse(p.token, self.compiler.scaledegree_distance_from_I) for p in positions]
+        for k, position in enumerate(positions):
+            if chords[k] is None or self.voicing(position.token) is None:
+                continue
+            following = chords[k + 1] if k + 1 < len(chords) else None
+            for rule, substitute in SUBSTITUTION_RULES:
+                token = substitute(chords[k], following)
+                if token is None or any(token == t for (t, r) in position.options):
+                    continue
+                if self.voicing(token) is not None:
+                    position.options.append((token, rule))
+        return positions
+
+    def voicing(self, token):
+        """
+        :return: list with the sorted midi numbers every staff plays for a chord token (None for a silent staff), or
+                 None if the style can't play it
+        """
+        if token not in self.voicings:
+            voicing = []
+            for name, staff in self.staves:
+                stylechords = self.style["tracks"][name]["staves"][staff]["chords"]
+                job = self.planner.resolve(name, staff, token, stylechords)
+                if job.kind == ERROR:
+                    voicing = None
+                    break
+                if job.kind == DIRECT:
+                    voicing.append(fragment_midis(stylechords[token]))
+                elif job.is_derivation():
+                    voicing.append(fragment_midis(self.compiler.derived_fragment(self.style, job)[0]))
+                else:
+                    voicing.append(None)
+            self.voicings[token] = voicing
+        return self.voicings[token]
+
+    def cost(self, first, second):
+        """
+        :return: voice leading cost from chord token first to chord token second, summed over the staves
+        """
+        if (first, second) not in self.costs:
+            self.costs[(first, second)] = sum(vl_size(a, b) for a, b in zip(self.voicing(first) or [],
+                                                                            self.voicing(second) or []))
+        return self.costs[(first, second)]
+
+    def search(self, positions, top=DEFAULT_TOP, max_substitutions=DEFAULT_MAX_SUBSTITUTIONS):
+        """
+        find the reharmonizations with the smallest total voice leading cost: a Viterbi search over the positions
+        that keeps the top best partial progressions for every (chord, number of substitutions) state
+        :return: (cost of the harmony as written, list of at most top Reharmonization, best first)
+        """
+        if not positions:
+            return 0, []
+        # state (option index, substitutions) -> list of (cost, substitutions, path); a path is a linked list of
+        # (option index, previous path) tuples, so that extending it takes constant time
+        beams = {}
+        for k in range(len(positions[0].options)):
+            beams[(k, 1 if k else 0)] = [(0, 1 if k else 0, (k, None))]
+        beams = {state: paths for state, paths in beams.items() if state[1] <= max_substitutions}
+        for t in range(1, len(positions)):
+            previous, current = positions[t - 1], positions[t]
+            new_beams = {}
+            for (j, used), paths in beams.items():
+                for k, (token, rule) in enumerate(current.options):
+                    substitutions = used + (1 if k else 0)
+                    if substitutions > max_substitutions:
+                        continue
+                    step = self.cost(previous.options[j][0], token)
+                    new_beams.setdefault((k, substitutions), []).extend(
+                            (cost + step, substitutions, (k, path)) for (cost, unused, path) in paths)
+            beams = {state: sorted(paths, key=lambda p: p[:2])[:top] for state, paths in new_beams.items()}
+
+        written = beams[(0, 0)][0][0]
+        finished = sorted([path for (k, used), paths in beams.items() if used for path in paths],
+                          key=lambda p: p[:2])[:top]
+        results = []
+        for cost, substitutions, path in finished:
+            chosen = []
+            while path is not None:
+                chosen.append(path[0])
+                path = path[1]
+            chosen.reverse()
+            results.append(Reharmonization(cost, [p.options[k][0] for p, k in zip(positions, chosen)],
+                                           [(t, positions[t].options[k][1]) for t, k in enumerate(chosen) if k]))
+        return written, results
+
+
+def replace_tokens(text, tokens):
+    """
+    :param text: chords of a harmony element
+    :param tokens: map of token index to the chord token that replaces it
+    :return: text with the tokens replaced and its layout kept (also the line breaks of a folded yaml block)
+    """
+    folds = set(getattr(text, "fold_pos", []))
+    result = ""
+    new_folds = []
+    position = 0
+    index = 0
+    for piece in re.split("(" + SPLITREGEX + ")", text):
+        if re.match(SPLITREGEX, piece):
+            if position in folds:
+                new_folds.append(len(result))
+            result += piece
+        elif piece:
+            result += tokens.get(index, piece)
+            index += 1
+        position += len(piece)
+    if isinstance(text, FoldedScalarString):
+        result = FoldedScalarString(result)
+        result.fold_pos = new_folds
+    return result
+
+
+def fragment_midis(fragment):
+    """
+    :return: sorted list of all distinct midi numbers in a lilypond fragment, or None if it's silent
+    """
+    split = split_pitches(fragment)
+    if split is not None:
+        midis = [lilypond_midi(name) for name in split[1]]
+        if None not in midis:
+            return sorted(set(midis)) or None
+    midis = sorted(set(p.midi for n in Lily2Stream().parse(fragment).flat.notes for p in n.pitches))
+    return midis if midis else None
+
+
+def reharmonized_song(text, positions, reharmonization):
+    """
+    :param text: contents of the song file
+    :param positions: list of ChordPosition the reharmonization was searched for
+    :return: contents of the song file with the chords of the reharmonization
+    """
+    yaml = YAML()
+    document = yaml.load(text)
+    harmony = document["song"]["harmony"]
+    replaced = {}
+    for position, token in zip(positions, reharmonization.tokens):
+        if token != position.token:
+            replaced.setdefault(position.element, {})[position.index] = token
+    for element in replaced:
+        harmony[element]["chords"] = replace_tokens(harmony[element]["chords"], replaced[element])
+    result = io.StringIO()
+    yaml.dump(document, result)
+    return result.getvalue()
+
+
+def reharmonize(compiler, top=DEFAULT_TOP, max_substitutions=DEFAULT_MAX_SUBSTITUTIONS):
+    """
+    search the reharmonizations of the input song that voice lead most smoothly in its style, and write the top best
+    ones as song files next to the output file (e.g. output/song-reharmonized1.yaml)
+    :return: list of files written
+    """
+    inputfile = compiler.options.inputfile[0]
+    song = compiler.load_song(inputfile)
+    if "style" not in song or not song["style"]:
+        print("*** Error: song {0} has no style to reharmonize it in".format(inputfile))
+        sys.exit(4)
+    style = compiler.init_style(song["style"])
+    compiler.seed = compiler.song_seed(song)
+    reharmonizer = Reharmonizer(compiler, song, style)
+    positions = reharmonizer.positions()
+    print("*** Searching reharmonizations of {0} chords ({1} possible substitutions, at most {2} per "
+          "progression)".format(len(positions), sum(len(p.options) - 1 for p in positions), max_substitutions))
+    written, results = reharmonizer.search(positions, top, max_substitutions)
+    if not results:
+        print("*** Found no substitutions that the style can play.")
+        return []
+
+    with open(inputfile, "r") as f:
+        text = f.read()
+    base = os.path.splitext(os.path.abspath(compiler.options.outputfile[0]))[0] + ".yaml"
+    outputs = [(keyed_filename(base, "reharmonized{0}".format(rank + 1)), reharmonized_song(text, positions, result))
+               for rank, result in enumerate(results)]
+    for fname, song_text in outputs:
+        if os.path.isfile(fname) and not same_content(fname, song_text) and not compiler.options.force:
+            print("*** REFUSING TO OVERWRITE EXISTING OUTPUT FILE {0}! QUIT. "
+                  "(use --force to overwrite existing files).".format(fname))
+            sys.exit(1)
+
+    print("*** Voice leading cost of the harmony as written: {0}".format(written))
+    for rank, ((fname, song_text), result) in enumerate(zip(outputs, results)):
+        write_if_changed(fname, song_text)
+        print("***   {0:>3}. cost {1:<6} {2}".format(rank + 1, result.cost, fname))
+        for t, rule in result.rules:
+            print("***          chord {0}: {1} -> {2} ({3})".format(t + 1, positions[t].token, result.tokens[t], rule))
+    return [fname for (fname, song_text) in outputs]
@@ -0,0 +1,243 @@
+import re
+from collections import OrderedDict
+
+import ly.lex
+import ly.lex.lilypond
+import ly.pitch
+import music21
+
+from numberutils import int_to_letter
+
+SKELETON_PITCH = "c"  # stands in for every pitch of a rhythm skeleton
+RHYTHM_PREFIX = "bluegrassRhythm"
+
+# tokens a fragment may consist of to be split in a rhythm skeleton and pitches; anything else (e.g. \relative,
+# \transpose, chord repetitions or octave checks) depends on the pitches themselves
+_ALLOWED_TOKENS = (ly.lex.lilypond.SequentialStart, ly.lex.lilypond.SequentialEnd, ly.lex.lilypond.SimultaneousStart,
+                   ly.lex.lilypond.SimultaneousEnd, ly.lex.lilypond.ChordStart, ly.lex.lilypond.ChordEnd,
+                   ly.lex.lilypond.Note, ly.lex.lilypond.Octave, ly.lex.lilypond.Rest, ly.lex.lilypond.Spacer,
+                   ly.lex.lilypond.Length, ly.lex.lilypond.Dot, ly.lex.lilypond.Scaling, ly.lex.lilypond.Tie,
+                   ly.lex.lilypond.Fraction, ly.lex.lilypond.AccidentalReminder,
+                   ly.lex.lilypond.AccidentalCautionary, ly.lex.lilypond.BeamStart, ly.lex.lilypond.BeamEnd,
+                   ly.lex.lilypond.SlurStart, ly.lex.lilypond.SlurEnd, ly.lex.lilypond.Direction,
+                   ly.lex.lilypond.ScriptAbbreviation, ly.lex.lilypond.Dynamic, ly.lex.lilypond.PipeSymbol,
+                   ly.lex.lilypond.Comment, ly.lex.Space)
+_ALLOWED_COMMANDS = ["\\times", "\\tuplet"]
+
+_ACCIDENTALS = {-2: "eses", -1: "es", 0: "", 1: "is", 2: "isis"}
+_PITCH_NAME = re.compile(r"([a-z]+)([,']*)$")
+_read_pitch = ly.pitch.pitchReader("nederlands")
+_pitches = {}  # lilypond note name -> music21 pitch
+
+# defines the scheme function that the rhythm skeletons use to take over the pitches of the chords: every note of
+# the skeleton gets the pitch at its index in the (distinct) pitches of the chord
+APPLY_PITCHES_DEFINITION = """#(define (bluegrass-apply-pitches pitches order skeleton)
+   (let ((choices (list->vector (map (lambda (note) (ly:music-property note 'pitch))
+                                     (extract-typed-music pitches 'note-event)))))
+     (for-each (lambda (note index)
+                 (ly:music-set-property! note 'pitch (vector-ref choices index)))
+               (extract-typed-music skeleton 'note-event)
+               order)
+     skeleton))"""
+
+
+def pitch_order(pitches):
+    """
+    :param pitches: list of lilypond note names, e.g. ["c'", "g'", "c''", "g'"]
+    :return: (distinct pitches in order of first appearance, index of every pitch in them), e.g.
+             (["c'", "g'", "c''"], (0, 1, 2, 1))
+    """
+    distinct = []
+    order = []
+    for pitch in pitches:
+        if pitch not in distinct:
+            distinct.append(pitch)
+        order.append(distinct.index(pitch))
+    return distinct, tuple(order)
+
+
+def split_pitches(lycode):
+    """
+    split a lilypond fragment in its rhythm and its pitches
+    :param lycode: lilypond fragment, e.g. "{ r8 <g' c'' e''>4 <g' c'' e''>8 }"
+    :return: (skeleton, pitches, groups), or None if the fragment uses anything that depends on its pitches:
+             - skeleton = lycode with every pitch replaced by SKELETON_PITCH, e.g. "{ r8 <c c c>4 <c c c>8 }"
+             - pitches = list of the pitches (lilypond note names with octave marks) in order of appearance
+             - groups = for every pitch: None for a single note, else the number of the chord it is in (counting
+               from 0)
+    """
+    skeleton = []
+    pitches = []
+    groups = []
+    chords = 0
+    in_chord = False
+    for token in ly.lex.state("lilypond").tokens(lycode):
+        if isinstance(token, ly.lex.lilypond.Command) and token in _ALLOWED_COMMANDS:
+            skeleton.append(token)
+        elif not isinstance(token, _ALLOWED_TOKENS):
+            return None
+        elif isinstance(token, ly.lex.lilypond.Note):
+            pitches.append(str(token))
+            groups.append(chords if in_chord else None)
+            skeleton.append(SKELETON_PITCH)
+        elif isinstance(token, ly.lex.lilypond.Octave):
+            if not pitches or skeleton[-1] != SKELETON_PITCH:
+                return None
+            pitches[-1] += token
+        elif isinstance(token, ly.lex.Space):
+            # rhythms that are only spaced differently share their skeleton (line comments end at a line break)
+            _add_space(skeleton, "\n" if "\n" in token else " ")
+        else:
+            if isinstance(token, (ly.lex.lilypond.ChordEnd, ly.lex.lilypond.SequentialEnd)):
+                if skeleton and skeleton[-1] == " ":
+                    skeleton.pop()
+                if isinstance(token, ly.lex.lilypond.SequentialEnd):
+                    _add_space(skeleton, " ")
+            if isinstance(token, ly.lex.lilypond.ChordStart):
+                in_chord = True
+            elif isinstance(token, ly.lex.lilypond.ChordEnd):
+                in_chord = False
+                chords += 1
+            skeleton.append(token)
+            if isinstance(token, ly.lex.lilypond.SequentialStart):
+                skeleton.append(" ")
+    return "".join(skeleton), pitches, groups
+
+
+def _add_space(skeleton, space):
+    """
+    add whitespace to a skeleton under construction, unless it already ends in whitespace or in a chord start
+    """
+    if not skeleton or isinstance(skeleton[-1], ly.lex.lilypond.ChordStart):
+        return
+    if skeleton[-1] == " " and space == "\n":
+        skeleton[-1] = space
+    elif skeleton[-1] not in [" ", "\n"]:
+        skeleton.append(space)
+
+
+def fill_pitches(skeleton, pitches):
+    """
+    :param skeleton: rhythm skeleton (see split_pitches)
+    :param pitches: list of lilypond note names with octave marks, one for every pitch in the skeleton
+    :return: lilypond fragment with the rhythm of the skeleton and the given pitches
+    """
+    remaining = iter(pitches)
+    return "".join(next(remaining) if isinstance(token, ly.lex.lilypond.Note) else token
+                   for token in ly.lex.state("lilypond").tokens(skeleton))
+
+
+def lilypond_pitch_name(pitch):
+    """
+    :param pitch: music21 pitch
+    :return: lilypond note name with octave marks, e.g. "bes," for B-flat 2, or None if lilypond has no name for it
+    """
+    alter = pitch.accidental.alter if pitch.accidental is not None else 0
+    if alter not in _ACCIDENTALS:
+        return None
+    octave = pitch.octave - 3
+    return pitch.step.lower() + _ACCIDENTALS[alter] + ("'" * octave if octave > 0 else "," * -octave)
+
+
+def lilypond_pitch(name):
+    """
+    :param name: lilypond note name with octave marks, e.g. "bes,"
+    :return: music21 pitch (shared between callers: copy it before changing it)
+    """
+    if name not in _pitches:
+        match = _PITCH_NAME.match(name)
+        note, alter = _read_pitch(match.group(1))
+        p = music21.pitch.Pitch(step="CDEFGAB"[note], octave=ly.pitch.octaveToNum(match.group(2)) + 3)
+        if alter:
+            p.accidental = music21.pitch.Accidental(float(alter * 2))
+        _pitches[name] = p
+    return _pitches[name]
+
+
+class RhythmSkeletons(object):
+    """
+    the rhythms shared by the chord fragments of a score: a rhythm that several chords use is defined once, as a music
+    function that takes the distinct pitches of a chord (e.g. "\\bluegrassRhythmA { c' e' g' }"), which keeps scores
+    with many (derived) chords compact. Chords share a rhythm if they only differ in their pitches, and repeat their
+    pitches in the same places.
+    """
+    def __init__(self):
+        """
+        holds
+         - split = ordered map of lilypond fragment to [rhythm, distinct pitches, number of chords defined with it],
+           for the fragments that can be split; a rhythm is a (skeleton, index of every note in the distinct pitches)
+           tuple
+         - names = ordered map of rhythm to the name of its music function, for the rhythms that are shared
+        """
+        self.split = OrderedDict()
+        self.names = OrderedDict()
+
+    def add(self, lycode):
+        """
+        :param lycode: lilypond fragment of a chord
+        """
+        if lycode in self.split:
+            self.split[lycode][2] += 1
+            return
+        split = split_pitches(lycode)
+        if split is not None and split[1]:
+            distinct, order = pitch_order(split[1])
+            self.split[lycode] = [(split[0], order), distinct, 1]
+
+    def share(self, rendered):
+        """
+        name the rhythms that more than one chord uses, in order of first use, as far as defining them once makes the
+        score shorter
+        :param rendered: function that returns the text that a list of rhythm definitions (APPLY_PITCHES_DEFINITION
+                         first) takes up in the score, with everything the template puts around them
+        """
+        chords = OrderedDict()
+        for lycode, (rhythm, pitches, count) in self.split.items():
+            chords.setdefault(rhythm, []).append((lycode, pitches, count))
+        names = OrderedDict()
+        definitions = [APPLY_PITCHES_DEFINITION]
+        saved = 0
+        for rhythm in chords:
+            if sum(count for lycode, pitches, count in chords[rhythm]) < 2:
+                continue
+            name = RHYTHM_PREFIX + int_to_letter(len(names) + 1)
+            definition = self.definition(name, rhythm)
+            shorter = sum(count * (len(lycode) - len(self.call(name, pitches)))
+                          for lycode, pitches, count in chords[rhythm])
+            if shorter > len(rendered(definitions + [definition])) - len(rendered(definitions)):
+                names[rhythm] = name
+                definitions.append(definition)
+                saved += shorter
+        self.names = names if saved > len(rendered(definitions)) else OrderedDict()
+
+    @staticmethod
+    def definition(name, rhythm):
+        """
+        :return: lilypond definition of the music function for a rhythm
+        """
+        skeleton, order = rhythm
+        return "{0} =\n#(define-music-function (parser location pitches) (ly:music?)\n" \
+               "   (bluegrass-apply-pitches pitches '({1}) #{{ {2} #}}))".format(name, " ".join(str(i) for i in order),
+                                                                          skeleton)
+
+    @staticmethod
+    def call(name, pitches):
+        """
+        :return: lilypond code that calls the music function of a rhythm with the given pitches
+        """
+        return "\\{0} {{ {1} }}".format(name, " ".join(pitches))
+
+    def definitions(self):
+        """
+        :return: list of lilypond definitions of the music functions of the shared rhythms
+        """
+        return [self.definition(name, rhythm) for rhythm, name in self.names.items()]
+
+    def fragment(self, lycode):
+        """
+        :return: lilypond code to define a fragment with: a call of its shared rhythm, or lycode itself
+        """
+        if lycode in self.split and self.split[lycode][0] in self.names:
+            rhythm, pitches, count = self.split[lycode]
+            return self.call(self.names[rhythm], pitches)
+        return lycode
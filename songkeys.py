@@ -0,0 +1,88 @@
+import os
+
+ALL_KEYS = ["c", "des", "d", "ees", "e", "f", "fis", "g", "aes", "a", "bes", "b"]
+
+_NATURAL_PCS = {"c": 0, "d": 2, "e": 4, "f": 5, "g": 7, "a": 9, "b": 11}
+
+
+def lilypond_semitones(name):
+    """
+    :param name: lilypond note name without octave marks, e.g. "bes", "as" or "fisis"
+    :return: number of semitones from c to the note in the same octave (ces = -1), or None if name is not a note name
+    """
+    if not name or name[0] not in _NATURAL_PCS:
+        return None
+    pc = _NATURAL_PCS[name[0]]
+    rest = name[1:]
+    if name[0] in "ae" and rest.startswith("s") and not rest.startswith("is"):
+        pc -= 1  # as, es (and ases, eses)
+        rest = rest[1:]
+    while rest:
+        if rest.startswith("is"):
+            pc += 1
+        elif rest.startswith("es"):
+            pc -= 1
+        else:
+            return None
+        rest = rest[2:]
+    return pc
+
+
+def lilypond_midi(name):
+    """
+    :param name: lilypond note name with octave marks (absolute), e.g. "e,," or "g'"
+    :return: midi number of the note (c is 48), or None if name is not a note name
+    """
+    base = name.rstrip(",'")
+    marks = name[len(base):]
+    semitones = lilypond_semitones(base)
+    if semitones is None or ("," in marks and "'" in marks):
+        return None
+    return 48 + semitones + 12 * (marks.count("'") - marks.count(","))
+
+
+def parse_keys(text):
+    """
+    :param text: comma separated lilypond note names, e.g. "c,d,bes", or "all" for the twelve major keys
+    :return: list of note names, or None if text is None
+    """
+    if text is None:
+        return None
+    if text.strip() == "all":
+        return list(ALL_KEYS)
+    keys = []
+    for key in text.split(","):
+        key = key.strip()
+        if lilypond_semitones(key) is None:
+            raise ValueError("unknown key {0} (expected lilypond note names, e.g. c,d,bes)".format(key))
+        if key not in keys:
+            keys.append(key)
+    return keys
+
+
+def nearest_transposition(home, key):
+    """
+    :param home: key the song is written in (lilypond note name)
+    :param key: key to render the song in (lilypond note name)
+    :return: (from, to) for a lilypond \\transpose that moves home to key by at most a tritone up or down,
+             or None if both are the same note
+    """
+    if home == key:
+        return None
+    distance = lilypond_semitones(key) - lilypond_semitones(home)
+    octave = ""
+    while distance > 6:
+        distance -= 12
+        octave += ","
+    while distance < -6:
+        distance += 12
+        octave += "'"
+    return home, key + octave
+
+
+def keyed_filename(filename, key):
+    """
+    :return: filename with the key added, e.g. output/song-bes.ly for output/song.ly and bes
+    """
+    base, ext = os.path.splitext(filename)
+    return "{0}-{1}{2}".format(base, key, ext)
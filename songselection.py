@@ -0,0 +1,307 @@
+import re
+from fractions import Fraction
+
+import ly.document
+import ly.lex
+import ly.lex.lilypond
+import ly.music
+import ly.rhythm
+
+_REFERENCE = re.compile(r"\\([A-Za-z]+)")
+# code without music of its own, e.g. what is left of "{ \transpose c d { \someChord } }" without the variable,
+# or a comment
+_NO_MUSIC = re.compile(r"^(?:[\s{}]|%(?!\{)[^\n]*|\\transpose\s+[a-z]+[,']*\s+[a-z]+[,']*)*$")
+# commands that still apply after the bar they are in: key, clef and time changes
+_STATE_COMMAND = re.compile(r"\\(?:key\s+[a-z]+\s*\\[a-z]+|clef\s+(?:\"[^\"]*\"|[A-Za-z0-9_^-]+)|time\s+\d+/\d+)")
+
+
+def parse_names(text):
+    """
+    :param text: comma separated names, e.g. "bass,piano"
+    :return: set of names, or None if text is None
+    """
+    if text is None:
+        return None
+    return set(name.strip() for name in text.split(",") if name.strip())
+
+
+def parse_bars(text):
+    """
+    :param text: range of bars, e.g. "9-16", "9" (a single bar) or "9-" (up to the end of the song); bars count from 1
+    :return: (first bar, last bar or None), or None if text is None
+    """
+    if text is None:
+        return None
+    first, separator, last = text.partition("-")
+    try:
+        first = int(first)
+        last = (int(last) if last.strip() else None) if separator else first
+    except ValueError:
+        raise ValueError("invalid bar range {0} (expected e.g. 9-16)".format(text))
+    if first < 1 or (last is not None and last < first):
+        raise ValueError("invalid bar range {0} (expected e.g. 9-16)".format(text))
+    return first, last
+
+
+def select_staves(spec, only_tracks, only_staves):
+    """
+    :param spec: style, rhythm or song specification
+    :param only_tracks: set of names of the tracks to keep (None: all)
+    :param only_staves: set of names of the staves to keep (None: all)
+    :return: shallow copy of spec with only the selected tracks and staves (spec itself if nothing is filtered)
+    """
+    if (only_tracks is None and only_staves is None) or "tracks" not in spec:
+        return spec
+    tracks = {}
+    for name in spec["tracks"]:
+        if only_tracks is not None and name not in only_tracks:
+            continue
+        track = dict(spec["tracks"][name])
+        if "staves" in track:
+            track["staves"] = dict((staff, track["staves"][staff]) for staff in track["staves"]
+                                   if only_staves is None or staff in only_staves)
+            if not track["staves"]:
+                continue
+        tracks[name] = track
+    selected = dict(spec)
+    selected["tracks"] = tracks
+    return selected
+
+
+def music_length(lycode):
+    """
+    :param lycode: lilypond code
+    :return: length of the music (in whole notes); variables count as 0
+    """
+    music = ly.music.document(ly.document.Document("{ " + lycode + " }"))
+    return sum((node.length() for node in music), Fraction(0))
+
+
+def cut_at_bar_checks(lycode, skip):
+    """
+    drop whole bars (as delimited by bar checks) from the start of lilypond code
+    :param lycode: lilypond code without variables
+    :param skip: maximum length (in whole notes) of the music to drop
+    :return: (list of the key, clef and time changes in the dropped bars, remaining lilypond code, length of the
+             music dropped), or None if no bar can be dropped
+    """
+    if "\\relative" in lycode:
+        return None  # pitches depend on the notes before them
+    document = ly.document.Document("{ " + lycode + " }", mode="lilypond")
+    ly.rhythm.rhythm_explicit(ly.document.Cursor(document))  # the first note kept may rely on an earlier duration
+    text = document.plaintext()
+    depth = 0
+    begin = cut = len("{ ")
+    dropped = Fraction(0)
+    for token in ly.lex.state("lilypond").tokens(text):
+        if isinstance(token, (ly.lex.lilypond.OpenBracket, ly.lex.lilypond.OpenSimultaneous)):
+            depth += 1
+        elif isinstance(token, (ly.lex.lilypond.CloseBracket, ly.lex.lilypond.CloseSimultaneous)):
+            depth -= 1
+        elif isinstance(token, ly.lex.lilypond.PipeSymbol) and depth == 1:
+            length = music_length(text[begin:token.pos])
+            if dropped + length > skip:
+                break
+            dropped += length
+            begin = cut = token.end
+    if not dropped:
+        return None
+    return _STATE_COMMAND.findall(text[len("{ "):cut]), text[cut:-len(" }")], dropped
+
+
+def spacer(length):
+    """
+    :return: lilypond spacer rest of the given length (in whole notes)
+    """
+    return "s1*{0}/{1}".format(length.numerator, length.denominator)
+
+
+class DurationIndex(object):
+    """
+    lengths of the fragments (chords, voicings and patterns) defined in a score, so that the length of music that
+    refers to them can be found without expanding it
+    """
+    def __init__(self, fragments):
+        """
+        holds
+         - fragments = map of lilypond variable name to the lilypond code it is defined as
+         - lengths = map of lilypond variable name to the length of its music (in whole notes), filled when needed
+         - measured = map of lilypond code to its length (in whole notes), for the code measured so far: voices
+           repeat the same elements over and over
+        """
+        self.fragments = fragments
+        self.lengths = {}
+        self.measured = {}
+
+    def fragment_length(self, name):
+        if name not in self.lengths:
+            self.lengths[name] = music_length(self.fragments[name])
+        return self.lengths[name]
+
+    def references(self, lycode):
+        """
+        :return: True if lycode uses one of the fragments
+        """
+        return any(name in self.fragments for name in _REFERENCE.findall(lycode))
+
+    def referenced(self, lycode):
+        """
+        :return: list of the names of the fragments lycode uses, in order of appearance
+        """
+        return [name for name in _REFERENCE.findall(lycode) if name in self.fragments]
+
+    def length(self, lycode):
+        """
+        :return: length (in whole notes) of lilypond code that may use the fragments
+        """
+        if lycode not in self.measured:
+            self.measured[lycode] = self.measure(lycode)
+        return self.measured[lycode]
+
+    def measure(self, lycode):
+        total = Fraction(0)
+        parts = _REFERENCE.split(lycode)
+        for i in range(1, len(parts), 2):
+            if parts[i] in self.fragments:
+                total += self.fragment_length(parts[i])
+                parts[i] = ""
+            else:
+                parts[i] = "\\" + parts[i]
+        rest = "".join(parts)
+        return total if _NO_MUSIC.match(rest) else total + music_length(rest)
+
+
+def music_units(musicelements, index):
+    """
+    :param musicelements: music elements of a voice
+    :param index: DurationIndex of the fragments the elements may use
+    :return: list of (list of music elements, length) in which the elements are grouped such that every group has a
+             well defined length: an element that uses a fragment is a group of its own, consecutive other elements
+             (e.g. "\\key", "d", "\\major") are kept together
+    """
+    units = []
+    run = []
+    for element in musicelements:
+        if index.references(element):
+            if run:
+                units.append((run, index.length("\n".join(run))))
+                run = []
+            units.append(([element], index.length(element)))
+        else:
+            run.append(element)
+    if run:
+        units.append((run, index.length("\n".join(run))))
+    return units
+
+
+class WindowedVoice(object):
+    """
+    voice definition that still has to be cut to a window of bars (see BarWindow.crop)
+    """
+    def __init__(self, template, voicefragmentname, musicelements, transposition):
+        self.template = template
+        self.voicefragmentname = voicefragmentname
+        self.musicelements = musicelements
+        self.transposition = transposition
+
+    def units(self, index):
+        """
+        :return: list of (list of music elements, length), see music_units
+        """
+        return music_units(self.musicelements, index)
+
+    def render(self, musicelements):
+        return self.template.render(voicefragmentname=self.voicefragmentname, musicelements=musicelements,
+                                    transposition=self.transposition)
+
+
+class BarWindow(object):
+    """
+    range of bars of a song to compile: voices only keep the music that sounds in (or reaches into) the window, with
+    all transpositions and mutes as they are at the start of the window
+    """
+    def __init__(self, first, last, bar_length):
+        """
+        holds
+         - first, last = first and last bar to keep (counting from 1; last None for up to the end)
+         - bar_length = length of a bar (in whole notes)
+         - start, end = where the window starts and ends in the song (in whole notes; end None for the end of the song)
+        """
+        self.first = first
+        self.last = last
+        self.bar_length = bar_length
+        self.start = (first - 1) * bar_length
+        self.end = last * bar_length if last is not None else None
+
+    @staticmethod
+    def bar_length_of(time):
+        """
+        :param time: time signature, e.g. "3/4"
+        :return: length of a bar (in whole notes)
+        """
+        numerator, denominator = time.split("/")
+        return Fraction(int(numerator), int(denominator))
+
+    def crop(self, voicedefinitions, fragments):
+        """
+        replace every WindowedVoice in voicedefinitions by its rendered definition, cut to the window.
+        Music is dropped per element; an element that starts before the window but reaches into it is kept and the
+        time before the window is not typeset, so all voices are padded to start at the earliest element kept.
+        :param fragments: map of lilypond variable name to code for every chord and pattern defined in the score
+        """
+        index = DurationIndex(fragments)
+        voices = []
+        origin = self.start
+        for i, voice in enumerate(voicedefinitions):
+            if isinstance(voice, WindowedVoice):
+                units = voice.units(index)
+                positions = []
+                position = Fraction(0)
+                first = len(units)
+                for k, (elements, length) in enumerate(units):
+                    positions.append(position)
+                    if first == len(units) and length and position + length > self.start:
+                        first = k
+                    position += length
+                commands = []
+                if first < len(units) and positions[first] < self.start and \
+                        not index.references("\n".join(units[first][0])):
+                    # e.g. a long melody: drop its bars before the window
+                    cut = cut_at_bar_checks("\n".join(units[first][0]), self.start - positions[first])
+                    if cut is not None:
+                        commands, rest, dropped = cut
+                        units[first] = ([rest], units[first][1] - dropped)
+                        positions[first] += dropped
+                begin = positions[first] if first < len(units) else self.start
+                origin = min(origin, begin)
+                voices.append((i, voice, units, positions, first, begin, commands))
+
+        for i, voice, units, positions, first, begin, commands in voices:
+            musicelements = [self.control(origin), "{"]
+            for elements, length in units[:first]:
+                if not length:
+                    musicelements.extend(elements)  # keep key changes and the like
+            musicelements.extend(commands)
+            if begin > origin:
+                musicelements.append(spacer(begin - origin))
+            for (elements, length), position in zip(units[first:], positions[first:]):
+                if self.end is not None and position >= self.end:
+                    break
+                musicelements.extend(elements)
+            musicelements.extend(["}", ">>"])
+            voicedefinitions[i] = voice.render(musicelements)
+
+    def control(self, origin):
+        """
+        :return: start of a simultaneous section that hides what comes before and after the window and numbers the
+                 bars as in the whole song
+        """
+        parts = ["<< {"]
+        if self.start > origin:
+            parts.append("\\set Score.skipTypesetting = ##t {0}".format(spacer(self.start - origin)))
+            parts.append("\\set Score.skipTypesetting = ##f")
+        parts.append("\\set Score.currentBarNumber = #{0}".format(self.first))
+        if self.end is not None:
+            parts.append("{0} \\set Score.skipTypesetting = ##t".format(spacer(self.end - self.start)))
+        parts.append("}")
+        return " ".join(parts)
@@ -0,0 +1,114 @@
+from derivationplanner import DIRECT, split_elements
+
+SECTION = "section"
+
+
+def is_boundary(element):
+    """
+    :param element: entry of a harmony, percussion or melody list of a song
+    :return: true if a new shard starts at the element (an explicit section marker or a transposition)
+    """
+    return SECTION in element or "transpose" in element
+
+
+class ShardState(object):
+    """
+    everything a shard of a song needs to know about the elements that come before it
+    """
+    def __init__(self, destpitch):
+        """
+        holds
+         - destpitch = key to which the music is transposed
+         - muted_staves = set of names of the staves that are muted
+         - muted_tracks = set of names of the tracks that are muted
+         - played = map of (track, staff) to the number of chords played so far that get a voicing
+                    (only counted for harmony lists)
+        """
+        self.destpitch = destpitch
+        self.muted_staves = set([])
+        self.muted_tracks = set([])
+        self.played = {}
+
+    def copy(self):
+        s = ShardState(self.destpitch)
+        s.muted_staves = set(self.muted_staves)
+        s.muted_tracks = set(self.muted_tracks)
+        s.played = dict(self.played)
+        return s
+
+    def is_muted(self, track, staff):
+        return track in self.muted_tracks or staff in self.muted_staves
+
+    def apply(self, element):
+        """
+        update the state for an element that doesn't produce any music (transpose, (un)mute, section)
+        """
+        if "transpose" in element:
+            self.destpitch = element["transpose"]["to"]
+        elif "mute-staff" in element:
+            self.muted_staves.add(element["mute-staff"]["staff"].strip())
+        elif "mute-track" in element:
+            self.muted_tracks.add(element["mute-track"]["track"].strip())
+        elif "unmute-staff" in element:
+            self.muted_staves.remove(element["unmute-staff"]["staff"].strip())
+        elif "unmute-track" in element:
+            self.muted_tracks.remove(element["unmute-track"]["track"].strip())
+
+    def advance(self, element, plan=None):
+        """
+        update the state for any element
+        :param plan: DerivationPlan; if given, the chords played in every staff of the plan are counted
+        """
+        if "chords" in element:
+            if plan is not None:
+                chords = split_elements(element["chords"])
+                for (track, staff) in plan.sequences:
+                    if not self.is_muted(track, staff):
+                        voiced = [c for c in chords if self.is_voiced(plan.lookup(track, staff, c))]
+                        self.played[(track, staff)] = self.played.get((track, staff), 0) + len(voiced)
+        else:
+            self.apply(element)
+
+    @staticmethod
+    def is_voiced(job):
+        return job is not None and (job.kind == DIRECT or job.is_derivation())
+
+
+class Shard(object):
+    """
+    consecutive elements of a harmony, percussion or melody list that can be compiled independently
+    """
+    def __init__(self, index, section, state):
+        """
+        holds
+         - index = position of the shard in the list of shards
+         - section = name of the section the shard belongs to (None before the first section marker)
+         - elements = the elements of the song that make up the shard
+         - state = ShardState at the start of the shard
+        """
+        self.index = index
+        self.section = section
+        self.elements = []
+        self.state = state
+
+
+def split_shards(elements, state, plan=None):
+    """
+    split a list of song elements at section markers and transpositions; the starting state of every shard is found
+    with a single scan over the elements before it
+    :param elements: harmony, percussion or melody list of a song
+    :param state: ShardState at the start of the list (not modified)
+    :param plan: DerivationPlan, to count the chords played in every staff (for harmony lists)
+    :return: list of Shard, in song order
+    """
+    shards = []
+    state = state.copy()
+    section = None
+    for element in elements:
+        if SECTION in element:
+            section = element[SECTION]
+        if not shards or (is_boundary(element) and shards[-1].elements):
+            shards.append(Shard(len(shards), section, state.copy()))
+        shards[-1].elements.append(element)
+        state.advance(element, plan)
+    return shards
@@ -1,20 +1,37 @@
+import copy
+import multiprocessing
 import os
 import sys
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import music21
 from mako.template import Template
 from ruamel.yaml import YAML, RoundTripLoader
 
+from barcheck import BarChecker
+from depfile import dependency_rules, same_content, write_if_changed
+from derivationplanner import DerivationPlanner, DIRECT, is_derivable, split_elements
+from eventexport import arrangement_events
 from harvestedproperties import HarvestedProperties
 from lily2stream import Lily2Stream
-from numberutils import int_to_roman, int_to_text, split_roman_prefix, starts_with_one_of
-from voiceleading import VoiceLeader, SHIIHS_VOICELEADING
+from numberutils import int_to_letter, int_to_roman, int_to_text
+from progression import ProgressionVoiceLeader, DEFAULT_BEAM_WIDTH, DEFAULT_CANDIDATES
+from rhythmskeleton import APPLY_PITCHES_DEFINITION, RhythmSkeletons, fill_pitches, lilypond_pitch, \
+    lilypond_pitch_name, split_pitches
+from songkeys import keyed_filename, lilypond_midi, nearest_transposition, parse_keys
+from songselection import BarWindow, WindowedVoice, parse_bars, parse_names, select_staves
+from songshards import ShardState, split_shards
+from styleindex import StyleIndex
+from stylepack import StylePack, enumerate_jobs, style_hash, stylepack_filename
+from vlcache import VoiceLeadingCache, DEFAULT_VL_CACHE_SIZE
+from vltable import default_vltable_filename
+from voiceleading import VoiceLeader, SHIIHS_VOICELEADING, PROGRESSION_VOICELEADING, engines, find_engine, seeded_rng, \
+    use_table
 
 HARMONY = 1
 MELODY = 2
 PERCUSSION = 3
-SPLITREGEX = " |\||\n|\t"
 
 import cProfile
 import tempfile
@@ -112,6 +129,23 @@ def cleanup_string_for_lilypond(s):
     return c
 
 
+_shard_work = None  # (StyleCompiler, style) shared with the forked workers that derive the chords of a shard
+
+
+def derive_shard(keys):
+    """
+    derive the chords of one shard of a song in a worker process
+    :param keys: list of (track, staff, chord) keys of the derivation plan
+    :return: list of (key in StyleCompiler.derived, lilypond fragment)
+    """
+    compiler, style = _shard_work
+    results = []
+    for key in keys:
+        job = compiler.plan.lookup(*key)
+        results.append((compiler.derived_key(job), compiler.derive_chord(style, job)))
+    return results
+
+
 class StyleCompiler(object):
     """
     class to compile a style file and a song file to a lilypond file
@@ -120,13 +154,79 @@ class StyleCompiler(object):
     def __init__(self, rootpath, options):
         self.rootpath = rootpath
         self.options = options
-        self.muted_staves = set([])
-        self.muted_tracks = set([])
+        self.plan = None
+        self.shards = None
+        self.transposition = None
+        self.window = None
+        self.barchecker = None
+        self.fragments = {}
+        self.origins = {}
+        self.voices = []
+        self.arrangements = []
+        self.inputs = []
+        self.seed = 0
+        self.stylepack = None
+        self.stylehash = None
+        self.cache = {}
+        self.styleindex = StyleIndex(self.parse_style_file)
+        self.templates = {}
+        self.derived = {}
+        self.voicings = {}
+        self.vlcache = VoiceLeadingCache(getattr(options, "vlcachesize", [DEFAULT_VL_CACHE_SIZE])[0])
+        self.vltable = getattr(options, "vltable", [default_vltable_filename()])[0]
+        if not use_table(self.vltable):
+            self.vltable = None
         # print(options)
 
+    def cached(self, key, fnames, loader):
+        """
+        :param key: identifies the cached value
+        :param fnames: files the value was made from
+        :param loader: function that makes the value
+        :return: value made by loader, reused for as long as none of the files in fnames changes
+        """
+        stamp = tuple(os.path.getmtime(f) if os.path.exists(f) else None for f in fnames)
+        if key in self.cache and self.cache[key][0] == stamp:
+            return self.cache[key][1]
+        value = loader()
+        self.cache[key] = (stamp, value)
+        return value
+
+    def template(self, name):
+        """
+        :param name: name of a file in ly-templates
+        :return: mako Template, compiled only once
+        """
+        fname = os.path.join(self.rootpath, "ly-templates", name)
+        self.read_input(fname)
+        if name not in self.templates:
+            self.templates[name] = Template(filename=fname)
+        return self.templates[name]
+
+    def read_input(self, fname):
+        """
+        remember that the current compilation depends on fname (see write_depfile)
+        """
+        fname = os.path.abspath(fname)
+        if fname not in self.inputs:
+            self.inputs.append(fname)
+
+    def style_filename(self, subfolder, stylename):
+        return os.path.join(self.rootpath, subfolder, stylename) + ".yaml"
+
     def load_style(self, subfolder, stylename):
+        """
+        :return: style specification, with everything it inherits from the styles it extends (see StyleIndex)
+        """
+        fname = self.style_filename(subfolder, stylename)
+        chain = self.styleindex.chain(fname)
+        for f in chain:
+            self.read_input(f)
+        return self.cached(("style", fname), chain, lambda: self.styleindex.resolve(fname))
+
+    @staticmethod
+    def parse_style_file(fname):
         style = ""
-        fname = os.path.join(self.rootpath, subfolder, stylename) + ".yaml"
         try:
             with open(fname, "r") as f:
                 style = f.read()
@@ -146,15 +246,23 @@ class StyleCompiler(object):
         try:
             with open(fname, "r") as f:
                 song = f.read()
-            parsed_song = YAML()
-            parsed_song = parsed_song.load(song)
-            song = parsed_song["song"]
+            song = StyleCompiler.parse_song(song)
             print("*** Loaded song file ", fname)
         except Exception as e:
             print("*** Error: couldn't load song file {0}. {1}.\nReason: {2}".format(fname, sys.exc_info()[0], e))
             sys.exit(4)
         return song
 
+    @staticmethod
+    def parse_song(text):
+        """
+        :param text: contents of a song file (yaml)
+        :return: parsed song specification
+        """
+        parsed_song = YAML()
+        parsed_song = parsed_song.load(text)
+        return parsed_song["song"]
+
     @staticmethod
     def fragmentname(trackname, staffname, chordname):
         ct = cleanup_string_for_lilypond(trackname)
@@ -176,24 +284,157 @@ class StyleCompiler(object):
 
     @profile
     def compile(self):
+        """
+        compile the input file to the output file, or to one output file per key if --keys is given
+        :return: list of files written
+        """
         # read song and style specs
         song = self.load_song(self.options.inputfile[0])
+        keys = parse_keys(getattr(self.options, "keys", [None])[0])
+        result = self.render(song, keys)
+        if result is None:
+            return []
+        self.read_input(self.options.inputfile[0])
+
+        if not self.options.outputfile:
+            for text in ([result] if keys is None else result.values()):
+                print(text)
+            return []
+
+        filename = os.path.abspath(self.options.outputfile[0])
+        if keys is None:
+            outputs = [(filename, result)]
+        else:
+            outputs = [(keyed_filename(filename, key), text) for key, text in result.items()]
+        written = self.write_outputs(outputs)
+        eventformat = getattr(self.options, "exportevents", [None])[0]
+        if eventformat:
+            for (fname, text), arrangement in zip(outputs, self.arrangements):
+                if fname in written:
+                    print("*** Wrote {0} notes to {1}".format(len(arrangement),
+                                                              arrangement.save(fname, eventformat)))
+        self.write_depfile(written)
+        return written
+
+    def write_outputs(self, outputs):
+        """
+        :param outputs: list of (filename, lilypond code); a file that already holds exactly its lilypond code is left
+                        untouched (also its modification time), so that build tools don't consider it changed
+        :return: list of files written (or already up to date)
+        """
+        unchanged = [same_content(fname, text) for fname, text in outputs]
+        for (fname, text), same in zip(outputs, unchanged):
+            if same:
+                continue
+            elif os.path.isfile(fname) and not self.options.force:
+                print("*** REFUSING TO OVERWRITE EXISTING OUTPUT FILE {0}! QUIT. "
+                      "(use --force to overwrite existing files).".format(fname))
+                sys.exit(1)
+            elif os.path.isfile(fname) and self.options.force:
+                print("*** WARNING: OVERWRITING EXISTING OUTPUT FILE {0} AS REQUESTED!".format(fname))
+
+        # the outputs are independent: write them concurrently
+        with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+            written = list(executor.map(lambda output: self.write_output(*output), outputs))
+        for (fname, text), ok, same in zip(outputs, written, unchanged):
+            if same:
+                print("*** Result in {0} is unchanged; left the file as it was.".format(fname))
+            elif ok:
+                print("*** Wrote result in {0}. Please run lilypond on that file.".format(fname))
+            else:
+                print("*** ERROR WRITING TO FILE {0}. COMPILATION FAILED.".format(fname))
+        return [fname for (fname, text), ok in zip(outputs, written) if ok]
+
+    @staticmethod
+    def write_output(filename, text):
+        """
+        :return: True if text was written to filename
+        """
+        try:
+            write_if_changed(filename, text)
+            return True
+        except:
+            return False
+
+    def dependencies(self):
+        """
+        :return: list of every file the last compilation read: song, styles (including the styles they extend),
+                 style pack, voice leading table and lilypond templates
+        """
+        return self.inputs + ([os.path.abspath(self.vltable)] if self.vltable else [])
+
+    def write_depfile(self, written):
+        """
+        if --depfile is given, write a Makefile style dependency file that makes the files written depend on every
+        file the compilation read, so that make only recompiles (and reruns lilypond) when one of them changes
+        :param written: list of files written
+        """
+        depfilename = getattr(self.options, "depfile", [None])[0]
+        if not depfilename or not written:
+            return
+        try:
+            if write_if_changed(depfilename, dependency_rules(written, self.dependencies())):
+                print("*** Wrote dependencies in {0}.".format(depfilename))
+        except IOError:
+            print("*** ERROR WRITING DEPENDENCIES TO FILE {0}.".format(depfilename))
+            sys.exit(1)
+
+    def render(self, song, keys=None, seed=None):
+        """
+        compile a song to lilypond
+        :param song: parsed song specification
+        :param keys: list of lilypond note names of the keys to render the song in; everything up to the voices is
+                     calculated only once for all keys
+        :param seed: seed for all random choices (default: see song_seed)
+        :return: lilypond code (string), or an ordered map of key to lilypond code if keys are given, or None in
+                 case of a dry run
+        """
         song_style = song["style"] if "style" in song else ""
         song_rhythm = song["rhythm"] if "rhythm" in song else ""
         song_title = song["header"]["title"]
         song_writer = song["header"]["composer"]
+        self.seed = self.song_seed(song) if seed is None else seed
+        self.shards = None
+        self.fragments = {}
+        self.origins = {}
+        self.arrangements = []
+        self.inputs = []
         print("*** Rendering {0} by {1} to lilypond".format(song_title, song_writer))
 
         # read style specs
         style = self.init_style(song_style)
         rhythm = self.init_percussion(song_rhythm)  # read lilypond template
 
-        lytemplate = Template(filename=os.path.join(self.rootpath, "ly-templates", "score.mako"))
+        # only keep the selected staves, so that the others aren't derived or rendered
+        only_tracks = parse_names(getattr(self.options, "onlytracks", [None])[0])
+        only_staves = parse_names(getattr(self.options, "onlystaves", [None])[0])
+        song = select_staves(song, only_tracks, only_staves)
+        style = select_staves(style, only_tracks, only_staves)
+        rhythm = select_staves(rhythm, only_tracks, only_staves)
+
+        lytemplate = self.template("score.mako")
 
         globalproperties = merge_dicts(style["global"], song["global"])
 
+        time = globalproperties["time"] if "time" in globalproperties else "4/4"
+        bars = parse_bars(getattr(self.options, "bars", [None])[0])
+        self.window = None
+        if bars is not None:
+            self.window = BarWindow(bars[0], bars[1], BarWindow.bar_length_of(time))
+
         if song_style:
+            self.plan = self.plan_derivations(song, style)
+            if getattr(self.options, "dryrun", False):
+                self.plan.report(style)
+                return None
             chorddefinitions, knownchords = self.calculate_chord_definitions(style)
+            workers = getattr(self.options, "shardworkers", [1])[0]
+            if workers and workers > 1:
+                self.derive_shards_in_parallel(song, style, workers)
+            self.calculate_derived_chords(self.plan, style, knownchords, chorddefinitions)
+            self.calculate_progressions(style, knownchords, chorddefinitions)
+            if self.vlcache.lookups():
+                self.vlcache.report()
         else:
             chorddefinitions, knownchords = None, None
 
@@ -202,8 +443,47 @@ class StyleCompiler(object):
         else:
             patterndefinitions, knownpatterns = None, None
 
+        self.barchecker = None
+        if getattr(self.options, "barcheck", True):
+            self.barchecker = BarChecker(BarWindow.bar_length_of(time), time)
+            self.report_problems(self.barchecker.fragment_problems("chord", self.written_fragments(style, "chords")) +
+                                 self.barchecker.fragment_problems("pattern",
+                                                                   self.written_fragments(rhythm, "patterns")))
+
+        if keys is None:
+            return self.render_score(song, style, rhythm, lytemplate, globalproperties, knownchords, chorddefinitions,
+                                     knownpatterns, patterndefinitions)
+
+        home = self.song_key(song, style)
+        scores = OrderedDict()
+        try:
+            for key in keys:
+                self.transposition = nearest_transposition(home, key)
+                scores[key] = self.render_score(song, style, rhythm, lytemplate, globalproperties, knownchords,
+                                                chorddefinitions, knownpatterns, patterndefinitions)
+        finally:
+            self.transposition = None
+        return scores
+
+    def render_score(self, song, style, rhythm, lytemplate, globalproperties, knownchords, chorddefinitions,
+                     knownpatterns, patterndefinitions):
+        """
+        render the voices, staves and score of a song of which all chords and patterns are known; pitched voices are
+        transposed as specified in self.transposition. If events are exported, the notes of the arrangement are
+        added to self.arrangements.
+        :return: lilypond code (string)
+        """
+        self.voices = []
         harvestedproperties = self.calculate_voice_definitions(knownchords, chorddefinitions, knownpatterns,
                                                                patterndefinitions, song, style, rhythm)
+        if self.barchecker is not None:
+            # the voices have the same lengths in every key: check them only once
+            self.report_problems(self.barchecker.voice_problems(self.voices, self.fragments, self.origins))
+            self.barchecker = None
+        if getattr(self.options, "exportevents", [None])[0]:
+            self.arrangements.append(arrangement_events(self.voices, self.fragments, self.origins, self.window))
+        if self.window is not None:
+            self.window.crop(harvestedproperties.voicedefinitions, self.fragments)
 
         stavedefinitions, tracktostaff = self.calculate_staff_definitions(harvestedproperties)
 
@@ -213,38 +493,84 @@ class StyleCompiler(object):
         for name in harvestedproperties.sorted_style_tracks:
             sorted_track_names.append(tracktostaff[name])
 
-        if self.options.outputfile:
-            filename = os.path.abspath(self.options.outputfile[0])
-            if os.path.isfile(filename) and not self.options.force:
-                print("*** REFUSING TO OVERWRITE EXISTING OUTPUT FILE {0}! QUIT. " + \
-                      "(use --force to overwrite existing files).".format(self.options.outputfile))
-                sys.exit(1)
-            elif os.path.isfile(filename) and self.options.force:
-                print("*** WARNING: OVERWRITING EXISTING OUTPUT FILE {0} AS REQUESTED!".format(self.options.outputfile))
+        rhythmdefinitions = None
+        if chorddefinitions and getattr(self.options, "rhythmskeletons", True):
+            chorddefinitions, rhythmdefinitions = self.share_rhythms(
+                    chorddefinitions, lambda definitions: lytemplate.get_def("rhythms").render(
+                            rhythmdefinitions=definitions))
+
+        return lytemplate.render(headerproperties=song["header"],
+                                 globalproperties=globalproperties,
+                                 rhythmdefinitions=rhythmdefinitions,
+                                 chorddefinitions=chorddefinitions,
+                                 patterndefinitions=patterndefinitions,
+                                 voicedefinitions=harvestedproperties.voicedefinitions,
+                                 stavedefinitions=stavedefinitions,
+                                 parts=sorted_track_names,
+                                 tempo=song["midi"]["tempo"])
 
-            try:
-                with open(filename, "w") as f:
-                    f.write(lytemplate.render(headerproperties=song["header"],
-                                              globalproperties=globalproperties,
-                                              chorddefinitions=chorddefinitions,
-                                              patterndefinitions=patterndefinitions,
-                                              voicedefinitions=harvestedproperties.voicedefinitions,
-                                              stavedefinitions=stavedefinitions,
-                                              parts=sorted_track_names,
-                                              tempo=song["midi"]["tempo"]))
-                    print("*** Wrote result in {0}. Please run lilypond on that file.".format(filename))
+    @staticmethod
+    def share_rhythms(chorddefinitions, rendered):
+        """
+        factor the chord definitions into rhythm skeletons and pitches: every rhythm that more than one chord uses is
+        defined once as a music function, and the chords that use it become calls of it with their pitches (as far
+        as that makes the score shorter)
+        :param chorddefinitions: map of track name to list of chord definitions ("fragment name = lilypond code")
+        :param rendered: function that returns the text a list of rhythm definitions takes up in the rendered score
+        :return: (map of track name to list of chord definitions, list of rhythm definitions to put before them)
+        """
+        skeletons = RhythmSkeletons()
+        for name in chorddefinitions:
+            for definition in chorddefinitions[name]:
+                skeletons.add(definition.split(" = ", 1)[1])
+        skeletons.share(rendered)
+        if not skeletons.names:
+            return chorddefinitions, None
+        shared = {}
+        for name in chorddefinitions:
+            shared[name] = []
+            for definition in chorddefinitions[name]:
+                fragname, lycode = definition.split(" = ", 1)
+                shared[name].append("{0} = {1}".format(fragname, skeletons.fragment(lycode)))
+        return shared, [APPLY_PITCHES_DEFINITION] + skeletons.definitions()
 
-            except:
-                print("*** ERROR WRITING TO FILE {0}. COMPILATION FAILED.".format(self.options.outputfile))
-        else:
-            print(lytemplate.render(headerproperties=song["header"],
-                                    globalproperties=globalproperties,
-                                    chorddefinitions=chorddefinitions,
-                                    patterndefinitions=patterndefinitions,
-                                    voicedefinitions=harvestedproperties.voicedefinitions,
-                                    stavedefinitions=stavedefinitions,
-                                    parts=sorted_track_names,
-                                    tempo=song["midi"]["tempo"]))
+    @staticmethod
+    def written_fragments(style, kind):
+        """
+        :param kind: "chords" or "patterns"
+        :return: list of (track, staff, name, lilypond code) of the chords or patterns as written in the style
+        """
+        fragments = []
+        for name in style.get("tracks", {}):
+            for staff in style["tracks"][name].get("staves", {}):
+                written = style["tracks"][name]["staves"][staff].get(kind) or {}
+                for fragment in written:
+                    fragments.append((name, staff, fragment, written[fragment]))
+        return fragments
+
+    @staticmethod
+    def report_problems(problems):
+        for problem in problems:
+            print("*** WARNING: {0}".format(problem))
+
+    @staticmethod
+    def song_key(song, style):
+        """
+        :return: key in which the song is written (lilypond note name): the tonic of the key in its global
+                 properties, else the key in which the style is written
+        """
+        if "global" in song and "key" in song["global"]:
+            return song["global"]["key"].split()[0]
+        return StyleCompiler.reference_pitch(style)
+
+    def song_seed(self, song):
+        """
+        :return: seed for all random choices: from the command line if specified, else from the song, else 0
+        """
+        seed = getattr(self.options, "seed", [None])[0]
+        if seed is None:
+            seed = int(song["seed"]) if "seed" in song else 0
+        return seed
 
     def init_from_file(self, subfolder, filename):
         if filename:
@@ -261,8 +587,42 @@ class StyleCompiler(object):
 
     def init_style(self, song_style):
         style = self.init_from_file("instrumental", song_style)
+        self.stylepack = None
+        self.stylehash = None
+        if song_style:
+            fname = self.style_filename(os.path.join("styles", "instrumental"), song_style)
+            packfname = stylepack_filename(fname)
+            chain = self.styleindex.chain(fname)
+            self.stylehash = style_hash(chain)
+            # a pack goes stale when the style or any style it extends changes
+            self.stylepack = self.cached(("stylepack", packfname), chain + [packfname],
+                                         lambda: StylePack.load(packfname, self.stylehash))
+            if os.path.isfile(packfname):
+                self.read_input(packfname)
         return style
 
+    def precompile_style(self, stylename):
+        """
+        derive every chord the style supports, in every staff, and save the results in a style pack
+        next to the style file (or in the output file if one was specified explicitly)
+        :param stylename: name of a style in styles/instrumental
+        """
+        self.seed = self.song_seed({})
+        style = self.init_from_file("instrumental", stylename)
+        fname = self.style_filename(os.path.join("styles", "instrumental"), stylename)
+        pack = StylePack(stylename, style_hash(self.styleindex.chain(fname)), self.seed)
+        for name in style["tracks"]:
+            for staff in style["tracks"][name]["staves"]:
+                if "chords" in style["tracks"][name]["staves"][staff]:
+                    vlmethod = self.voiceleading_method(style, name, staff)
+                    jobs = enumerate_jobs(style, name, staff)
+                    print("*** Deriving {0} chords for track {1}, staff {2}".format(len(jobs), name, staff))
+                    for job in jobs:
+                        pack.add(job, vlmethod, self.derive_chord(style, job))
+        packfilename = getattr(self.options, "packfile", [None])[0] or stylepack_filename(fname)
+        pack.save(packfilename)
+        print("*** Wrote style pack with {0} derived chords in {1}.".format(pack.size(), packfilename))
+
     def calculate_staff_definitions(self, harvestedproperties):
         stavedefinitions = []
         tracktostaff = {}
@@ -271,7 +631,7 @@ class StyleCompiler(object):
             if stafftype == "Staff":
                 for voice in harvestedproperties.stafftypes[staffname]:
                     voicename = voice[1]
-                    stafftemplate = Template(filename=os.path.join(self.rootpath, "ly-templates", "Staff.mako"))
+                    stafftemplate = self.template("Staff.mako")
                     lyricsname = None
                     if harvestedproperties.haslyrics[voicename]:
                         lyricsname = voicename + "Lyrics"
@@ -291,7 +651,7 @@ class StyleCompiler(object):
             elif stafftype == "PianoStaff":
                 lyricsname = {}
                 sorted_voices = []
-                stafftemplate = Template(filename=os.path.join(self.rootpath, "ly-templates", "PianoStaff.mako"))
+                stafftemplate = self.template("PianoStaff.mako")
                 for i, voice in enumerate(harvestedproperties.stafftypes[staffname]):
                     voicename = voice[1]
                     sorted_voices.append((int_to_roman(i + 1), voicename))
@@ -318,7 +678,7 @@ class StyleCompiler(object):
                                                                                    harvestedproperties.staffproperties else []
                     staffoverr = harvestedproperties.staffoverrides[voicename] if voicename in \
                                                                                   harvestedproperties.staffoverrides else []
-                    stafftemplate = Template(filename=os.path.join(self.rootpath, "ly-templates", "DrumStaff.mako"))
+                    stafftemplate = self.template("DrumStaff.mako")
                     staffdefinition = stafftemplate.render(
                             staffname=staffname + "DrumStaff",
                             instrumentName=harvestedproperties.instrumentname[staffname],
@@ -347,6 +707,163 @@ class StyleCompiler(object):
 
         return chorddefinitions, knownchords
 
+    @staticmethod
+    def plan_derivations(song, style):
+        """
+        resolve every chord used in the song before doing any work, and bail out if some can't be resolved
+        :return: DerivationPlan
+        """
+        plan = DerivationPlanner(song, style).plan()
+        if plan.errors:
+            for e in plan.errors:
+                print("ERROR! {0}".format(e))
+            print("Bailing out.")
+            sys.exit(2)
+        return plan
+
+    def derived_key(self, job):
+        """
+        :return: key under which the derivation for job is remembered in self.derived
+        """
+        return self.stylehash, self.seed, job.track, job.staff, job.derivation_key()
+
+    def derived_fragment(self, style, job):
+        """
+        :param job: DerivationJob
+        :return: (lilypond fragment for the derived chord, true if it was taken from the style pack)
+        """
+        new_fragment = self.stylepack.lookup(job, self.seed) if self.stylepack else None
+        if new_fragment is not None:
+            return new_fragment, True
+        # derivations are remembered for as long as this compiler lives (e.g. in server mode)
+        key = self.derived_key(job)
+        if key not in self.derived:
+            self.derived[key] = self.derive_chord(style, job)
+        return self.derived[key], False
+
+    def calculate_derived_chords(self, plan, style, knownchords, chorddefinitions):
+        packed = 0
+        for job in plan.jobs():
+            new_fragment, from_pack = self.derived_fragment(style, job)
+            if from_pack:
+                packed += 1
+            self.register_chord(job.track, job.staff, job.chord, new_fragment, knownchords, chorddefinitions,
+                                derived=True)
+        if self.stylepack:
+            print("*** Took {0} of {1} derived chords from the style pack".format(packed, len(plan.jobs())))
+
+    def derive_shards_in_parallel(self, song, style, workers):
+        """
+        derive the chords of the song in worker processes, one shard of the harmony list per task: every chord is
+        derived for the shard in which it is used first. The results end up in self.derived, so that
+        calculate_derived_chords registers them in the usual order.
+        :param workers: maximum number of worker processes
+        """
+        global _shard_work
+        if "fork" not in multiprocessing.get_all_start_methods() or multiprocessing.current_process().daemon:
+            return  # workers need to inherit the compiler; and e.g. server workers can't have children
+        assigned = set([])
+        work = []
+        for shard in self.harmony_shards(song, self.reference_pitch(style)):
+            keys = []
+            for element in shard.elements:
+                if "chords" not in element:
+                    continue
+                for c in split_elements(element["chords"]):
+                    for (track, staff) in self.plan.sequences:
+                        job = self.plan.lookup(track, staff, c)
+                        if job is None or not job.is_derivation() or job.key() in assigned:
+                            continue
+                        assigned.add(job.key())
+                        if self.derived_key(job) in self.derived:
+                            continue
+                        if self.stylepack and self.stylepack.lookup(job, self.seed) is not None:
+                            continue
+                        keys.append(job.key())
+            if keys:
+                work.append(keys)
+        workers = min(workers, len(work), os.cpu_count() or 1)
+        if workers < 2:
+            return
+        print("*** Deriving {0} chords from {1} sections of the song with {2} workers".format(
+                sum(len(keys) for keys in work), len(work), workers))
+        _shard_work = (self, style)
+        try:
+            pool = multiprocessing.get_context("fork").Pool(workers)
+            try:
+                for results in pool.imap_unordered(derive_shard, work):
+                    for key, fragment in results:
+                        self.derived[key] = fragment
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _shard_work = None
+
+    def calculate_progressions(self, style, knownchords, chorddefinitions):
+        """
+        for staves that use PROGRESSION_VOICELEADING: choose a voicing for every chord played in the staff such that
+        the voice leading over the whole progression is minimal, and define the extra voicings that are needed
+        """
+        self.voicings = {}
+        beam_width = getattr(self.options, "beamwidth", [DEFAULT_BEAM_WIDTH])[0]
+        for (name, staff), sequence in self.plan.sequences.items():
+            if self.voiceleading_method(style, name, staff) != PROGRESSION_VOICELEADING:
+                continue
+            candidates = {}
+            steps = []
+            for c in sequence:
+                job = self.plan.lookup(name, staff, c)
+                if job.kind == DIRECT or job.is_derivation():
+                    if c not in candidates:
+                        candidates[c] = self.voicing_candidates(style, job)
+                    steps.append(c)
+            chosen, cost = ProgressionVoiceLeader(beam_width).choose(
+                    [[midis for (vname, fragment, midis) in candidates[c]] for c in steps])
+            emitted = []
+            for c, k in zip(steps, chosen):
+                vname, fragment, midis = candidates[c][k]
+                if vname not in knownchords[name][staff]:
+                    job = self.plan.lookup(name, staff, c)
+                    self.register_chord(name, staff, vname, fragment, knownchords, chorddefinitions, token=job.chord,
+                                        derived=job.is_derivation())
+                emitted.append(vname)
+            self.voicings[(name, staff)] = emitted
+            print("*** Voiced {0} chords in track {1}, staff {2} with total voice leading cost {3}".format(
+                    len(steps), name, staff, cost))
+
+    def voicing_candidates(self, style, job):
+        """
+        :param job: DerivationJob for a chord that is played in a staff with PROGRESSION_VOICELEADING
+        :return: list of (chord name, lilypond fragment, sorted midi numbers) for every voicing the chord can get;
+                 the first entry is the chord as it is defined (or derived) under its own name
+        """
+        if not job.is_derivation():
+            fragment = style["tracks"][job.track]["staves"][job.staff]["chords"][job.chord]
+            return [(job.chord, fragment, self.stream_midis(Lily2Stream().parse(fragment)))]
+        key = (self.stylehash, self.seed, job.track, job.staff, job.derivation_key(), "voicings")
+        if key not in self.derived:
+            candidates = []
+            for k in range(DEFAULT_CANDIDATES):
+                derived = self.derive_chord_pitches(style, job, k)
+                if derived is None:
+                    s = self.derive_chord_stream(style, job, k)
+                    derived = (self.unparse_stream(s), self.stream_midis(s))
+                fragment, midis = derived
+                if all(fragment != f for (n, f, m) in candidates):
+                    vname = job.chord if k == 0 else job.chord + "Voicing" + int_to_letter(len(candidates) + 1)
+                    candidates.append((vname, fragment, midis))
+            self.derived[key] = candidates
+        return self.derived[key]
+
+    @staticmethod
+    def stream_midis(s):
+        """
+        :return: sorted list of all distinct midi numbers in the stream, or None if it's silent
+        """
+        midis = sorted(set(p.midi for n in s.flat.notes for p in n.pitches))
+        return midis if midis else None
+
     def calculate_patterns(self, rhythm):
         patterndefinitions = {}
         knownpatterns = defaultdict(lambda: defaultdict(set))
@@ -362,25 +879,31 @@ class StyleCompiler(object):
                         self.register_pattern(name, staff, pat, fragcontent, knownpatterns, patterndefinitions)
         return patterndefinitions, knownpatterns
 
-    def register_chord(self, name, staff, chord, fragcontent, knownchords, chorddefinitions):
+    def register_chord(self, name, staff, chord, fragcontent, knownchords, chorddefinitions, token=None,
+                       derived=False):
+        """
+        :param token: chord of the song that chord is a voicing of (default: chord itself)
+        :param derived: True if the chord was derived from another chord of the style
+        """
         knownchords[name][staff].add(chord)
         fragname = self.fragmentname(name, staff, chord)
         fragment = "{0} = {1}".format(fragname, fragcontent)
         chorddefinitions[name].append(fragment)
+        self.fragments[fragname] = fragcontent
+        self.origins[fragname] = (chord if token is None else token, derived)
 
     def register_pattern(self, name, staff, pat, fragcontent, knownpatterns, patterndefinitions):
         knownpatterns[name][staff].add(pat)
         fragname = self.fragmentname(name, staff, pat)
         fragment = "{0} = {1}".format(fragname, fragcontent)
         patterndefinitions[name].append(fragment)
+        self.fragments[fragname] = fragcontent
+        self.origins[fragname] = (pat, False)
 
     def calculate_voice_definitions(self, knownchords, chorddefinitions, knownpatterns, patterndefinitions, song, style,
                                     rhythm):
         h = HarvestedProperties()
-        if "specified-relative-to" in style and "key" in style["specified-relative-to"]:
-            refpitch = style["specified-relative-to"]["key"]
-        else:
-            refpitch = "c"
+        refpitch = self.reference_pitch(style)
 
         if "tracks" in song:
             for name in song["tracks"]:
@@ -399,6 +922,15 @@ class StyleCompiler(object):
 
         return h
 
+    @staticmethod
+    def reference_pitch(style):
+        """
+        :return: key in which the style is written (lilypond note name)
+        """
+        if "specified-relative-to" in style and "key" in style["specified-relative-to"]:
+            return style["specified-relative-to"]["key"]
+        return "c"
+
     def process_track(self, harmonytype, song, style, refpitch, name, knownchords, chorddefinitions, knownpatterns, h):
         if "tracks" in style and name in style["tracks"] and "instrumentName" in style["tracks"][name]:
             h.instrumentname[name] = style["tracks"][name]["instrumentName"]
@@ -422,18 +954,17 @@ class StyleCompiler(object):
         h.hasclef[voicefragmentname] = "treble"
         if "clef" in style["tracks"][name]["staves"][staff]:
             h.hasclef[voicefragmentname] = style["tracks"][name]["staves"][staff]["clef"]
-        staff_voice_template = Template(filename=os.path.join(self.rootpath,
-                                                              "ly-templates", "voice.mako"))
+        staff_voice_template = self.template("voice.mako")
         h.haslyrics[voicefragmentname] = False
         vl = VoiceLeader()
         self.process_harmony(harmonytype, song, style, refpitch, destpitch, knownchords, chorddefinitions,
                              knownpatterns, staff, name, staff_voice_template, voicefragmentname, h)
 
-        if "lyrics" in style["tracks"][name]["staves"][staff]:
+        if "lyrics" in style["tracks"][name]["staves"][staff] and self.window is None:
+            # lyrics can't be cut to a range of bars: leave them out then
             h.haslyrics[voicefragmentname] = True
             lyrics = style["tracks"][name]["staves"][staff]["lyrics"]
-            staff_lyrics_template = Template(
-                    filename=os.path.join(self.rootpath, "ly-templates", "lyrics.mako"))
+            staff_lyrics_template = self.template("lyrics.mako")
             rendered_lyrics = staff_lyrics_template.render(voicefragmentname=voicefragmentname + "Lyrics",
                                                            musicelements=[lyrics.replace("|", "|\n")])
             h.voicedefinitions.append(rendered_lyrics)
@@ -444,180 +975,101 @@ class StyleCompiler(object):
                         knownpatterns, staff, name, staff_voice_template, voicefragmentname, h):
         musicelements = []
         if harmonytype == MELODY and "music" in style["tracks"][name]["staves"][staff]:
-            for element in style["tracks"][name]["staves"][staff]["music"]:
-                if "notes" in element:
-                    lycode = element["notes"].replace("|", "|\n")
-                    self.insert_transposable_lilypondcode(refpitch, destpitch, lycode, musicelements)
-                elif "ly" in element:
-                    self.insert_raw_lilypondcode(element["ly"], musicelements)
-                elif "transpose" in element:
-                    destpitch = element["transpose"]["to"]
-            voice = staff_voice_template.render(voicefragmentname=voicefragmentname, musicelements=musicelements)
-            h.voicedefinitions.append(voice)
+            for shard in split_shards(style["tracks"][name]["staves"][staff]["music"], ShardState(destpitch)):
+                musicelements.extend(self.melody_shard_elements(shard, refpitch))
+            self.voices.append((name, staff, musicelements, self.transposition))
+            h.voicedefinitions.append(self.voice_definition(staff_voice_template, voicefragmentname, musicelements,
+                                                            self.transposition))
 
         if harmonytype == PERCUSSION and "percussion" in song:
-            for harmonyelement in song["percussion"]:
-                if "patterns" in harmonyelement:
-                    patterns = harmonyelement["patterns"]
-                    import re
-                    patterns = (el for el in re.split(SPLITREGEX, patterns) if el)  # cut out empty entries
-                    for p in patterns:
-                        if name not in self.muted_tracks and staff not in self.muted_staves:
-                            self.insert_nontransposable_pattern(p, knownpatterns, staff, name, musicelements)
-                        else:
-                            self.insert_nontransposable_pattern("\\" + self.voicename(name, staff) + "Rest",
-                                                                knownpatterns, staff, name, musicelements)
-                elif "ly" in harmonyelement:
-                    self.insert_raw_lilypondcode(harmonyelement["ly"], musicelements)
-                elif "mute-staff" in harmonyelement:
-                    staffname = harmonyelement["mute-staff"]["staff"].strip()
-                    self.muted_staves.add(staffname)
-                elif "mute-track" in harmonyelement:
-                    trackname = harmonyelement["mute-track"]["track"].strip()
-                    self.muted_tracks.add(trackname)
-                elif "unmute-staff" in harmonyelement:
-                    staffname = harmonyelement["unmute-staff"]["staff"].strip()
-                    self.muted_staves.remove(staffname)
-                elif "unmute-track" in harmonyelement:
-                    trackname = harmonyelement["unmute-track"]["track"].strip()
-                    self.muted_tracks.remove(trackname)
-
-            voice = staff_voice_template.render(voicefragmentname=voicefragmentname,
-                                                musicelements=musicelements)
-            h.voicedefinitions.append(voice)
+            for shard in split_shards(song["percussion"], ShardState(destpitch)):
+                musicelements.extend(self.percussion_shard_elements(shard, knownpatterns, staff, name))
+            self.voices.append((name, staff, musicelements, None))
+            h.voicedefinitions.append(self.voice_definition(staff_voice_template, voicefragmentname, musicelements,
+                                                            None))  # drums don't transpose
 
         if harmonytype == HARMONY and "chords" in style["tracks"][name]["staves"][staff]:
-            for harmonyelement in song["harmony"]:
-                if "chords" in harmonyelement:
-                    chords = harmonyelement["chords"]
-                    import re
-                    chords = (el for el in re.split(SPLITREGEX, chords) if el)  # cut out empty entries
-                    for c in chords:
-                        if name not in self.muted_tracks and staff not in self.muted_staves:
-                            if c in knownchords[name][staff]:
-                                self.insert_transposable_pattern(c, refpitch, destpitch, staff, name, musicelements)
-                            elif self.to_be_derived_from_existing(c):  # calculate from previous chord
-                                cname = cleanup_string_for_lilypond("{0}".format(c))
-                                vname = self.voicename(name, staff) + cname
-                                number, accidental, modifier = split_roman_prefix(c)
-                                if "_" in modifier:
-                                    msplit = modifier.split("_")
-                                    modifier_without_suffix = msplit[1]
-                                    modifier_without_prefix = msplit[0]
-                                else:
-                                    modifier_without_suffix = modifier
-                                    modifier_without_prefix = modifier
-                                one_chord = "I" + modifier_without_suffix
-
-                                # if one_chord not in knownchords[name][staff] and not \
-                                #     (one_chord.endswith("m") and one_chord[:-1] in knownchords[name][staff]):
-                                #     print("ERROR! Style always needs at least specification of the I chord.")
-                                #     print("In case of track {0}, staff {1} we couldn't find it.".format(
-                                #             name, staff))
-                                #     print("Bailing out.")
-                                #     sys.exit(1)
-
-                                if one_chord not in knownchords[name][staff] and \
-                                        not modifier_without_prefix.startswith("m") and \
-                                                modifier_without_prefix != "":
-                                    # minor can be calculated from major if needed;
-                                    # other types require explicit hints
-                                    print("ERROR! Cannot find chord {0} in style file.".format(one_chord))
-                                    print("Need it to calculate chord {0} in track {1}, staff {2}.".format(c,
-                                                                                                           name, staff))
-                                    print("Bailing out.")
-                                    sys.exit(2)
-
-                                elif one_chord not in knownchords[name][staff] and \
-                                        modifier_without_prefix.startswith("m"):
-                                    #
-                                    # e.g. you try to calculat VIm but Im doesn't exist in the style file
-                                    # in that case: calculate VIm from I.
-                                    #
-                                    style_scale = style["specified-relative-to"]["key"]
-                                    style_scale_mode = style["specified-relative-to"]["mode"]
-                                    name_to_constructor = {
-                                        "major": music21.scale.MajorScale,
-                                        "minor": music21.scale.MinorScale
-                                    }
-                                    source_scale = name_to_constructor[style_scale_mode](style_scale)
-                                    sourcepitch = music21.pitch.Pitch(style_scale)
-                                    target_distance = self.scaledegree_distance_from_I(number + accidental)
-                                    target_interval = music21.interval.Interval(target_distance)
-                                    target_pitch = music21.interval.transposePitch(sourcepitch, target_interval)
-                                    target_scale = music21.scale.MinorScale(target_pitch.name)
-                                    fragment = style["tracks"][name]["staves"][staff]["chords"]["I"]
-                                    vl = VoiceLeader()
-                                    l = Lily2Stream()
-                                    s = l.parse(fragment)
-                                    vlmethod = self.voiceleading_method(style, name, staff)
-                                    src2targetdistance = target_pitch.midi - sourcepitch.midi
-                                    self.transform_note_stream(s, src2targetdistance, source_scale, target_scale, vl, vlmethod)
-                                    self.transform_chord_stream(s, src2targetdistance, source_scale, target_scale, vl, vlmethod)
-
-                                    new_fragment = "{ " + l.unparse(
-                                            s.flat.getElementsByClass(["Note", "Chord", "Rest"]).stream()) + " }"
-                                    self.insert_transposable_voicename(refpitch, destpitch, vname, musicelements)
-                                    self.register_chord(name, staff, c, new_fragment, knownchords,
-                                                        chorddefinitions)
-
-                                elif one_chord in knownchords[name][staff]:
-                                    #
-                                    # e.g. you try to find VIm7 and Im7 exists in the style file
-                                    #
-                                    style_scale = style["specified-relative-to"]["key"]
-                                    style_scale_mode = style["specified-relative-to"]["mode"]
-                                    name_to_constructor = {
-                                        "major": music21.scale.MajorScale,
-                                        "minor": music21.scale.MinorScale
-                                    }
-                                    source_scale = name_to_constructor[style_scale_mode](style_scale)
-                                    sourcepitch = music21.pitch.Pitch(style_scale)
-                                    target_distance = self.scaledegree_distance_from_I(number + accidental)
-                                    target_interval = music21.interval.Interval(target_distance)
-                                    target_pitch = music21.interval.transposePitch(sourcepitch, target_interval)
-                                    target_scale = music21.scale.MajorScale(target_pitch.name)
-                                    if "m" in modifier_without_prefix:
-                                        target_scale = music21.scale.MinorScale(target_pitch.name)
-                                    # start from Im7 to calculate VIm7
-                                    fragment = style["tracks"][name]["staves"][staff]["chords"][one_chord]
-                                    vl = VoiceLeader()
-                                    l = Lily2Stream()
-                                    s = l.parse(fragment)
-                                    vlmethod = self.voiceleading_method(style, name, staff)
-                                    src2targetdistance = target_pitch.midi - sourcepitch.midi
-                                    self.transform_note_stream(s, src2targetdistance, source_scale, target_scale, vl, vlmethod)
-                                    self.transform_chord_stream(s, src2targetdistance, source_scale, target_scale, vl, vlmethod)
-
-                                    new_fragment = "{ " + l.unparse(
-                                            s.flat.getElementsByClass(["Note", "Chord", "Rest"]).stream()) + " }"
-                                    self.insert_transposable_voicename(refpitch, destpitch, vname, musicelements)
-                                    self.register_chord(name, staff, c, new_fragment, knownchords,
-                                                        chorddefinitions)
-                            else:
-                                musicelements.append(c)
+            voicings = self.voicings.get((name, staff), [])
+            for shard in self.harmony_shards(song, destpitch):
+                musicelements.extend(self.harmony_shard_elements(shard, refpitch, voicings, staff, name))
+            self.voices.append((name, staff, musicelements, self.transposition))
+            h.voicedefinitions.append(self.voice_definition(staff_voice_template, voicefragmentname, musicelements,
+                                                            self.transposition))
+
+    def voice_definition(self, staff_voice_template, voicefragmentname, musicelements, transposition):
+        """
+        :return: the rendered voice definition, or a WindowedVoice if only a range of bars is compiled (the voices are
+                 cut to the window when they are all known)
+        """
+        if self.window is not None:
+            return WindowedVoice(staff_voice_template, voicefragmentname, musicelements, transposition)
+        return staff_voice_template.render(voicefragmentname=voicefragmentname, musicelements=musicelements,
+                                           transposition=transposition)
+
+    def harmony_shards(self, song, refpitch):
+        """
+        :return: the harmony list of the song split in shards (see songshards.split_shards)
+        """
+        if self.shards is None:
+            self.shards = split_shards(song["harmony"], ShardState(refpitch), self.plan) if "harmony" in song else []
+        return self.shards
+
+    def melody_shard_elements(self, shard, refpitch):
+        state = shard.state.copy()
+        musicelements = []
+        for element in shard.elements:
+            if "notes" in element:
+                lycode = element["notes"].replace("|", "|\n")
+                self.insert_transposable_lilypondcode(refpitch, state.destpitch, lycode, musicelements)
+            elif "ly" in element:
+                self.insert_raw_lilypondcode(element["ly"], musicelements)
+            elif "transpose" in element:
+                state.apply(element)
+        return musicelements
+
+    def percussion_shard_elements(self, shard, knownpatterns, staff, name):
+        state = shard.state.copy()
+        musicelements = []
+        for harmonyelement in shard.elements:
+            if "patterns" in harmonyelement:
+                for p in split_elements(harmonyelement["patterns"]):
+                    if not state.is_muted(name, staff):
+                        self.insert_nontransposable_pattern(p, knownpatterns, staff, name, musicelements)
+                    else:
+                        self.insert_nontransposable_pattern("\\" + self.voicename(name, staff) + "Rest",
+                                                            knownpatterns, staff, name, musicelements)
+            elif "ly" in harmonyelement:
+                self.insert_raw_lilypondcode(harmonyelement["ly"], musicelements)
+            else:
+                state.apply(harmonyelement)
+        return musicelements
+
+    def harmony_shard_elements(self, shard, refpitch, voicings, staff, name):
+        """
+        :param voicings: the chords to play in this staff if it uses PROGRESSION_VOICELEADING, for the whole song
+        :return: list of music elements for one shard of the harmony list, in one staff
+        """
+        state = shard.state.copy()
+        voicings = iter(voicings[state.played.get((name, staff), 0):])
+        musicelements = []
+        for harmonyelement in shard.elements:
+            if "chords" in harmonyelement:
+                for c in split_elements(harmonyelement["chords"]):
+                    if not state.is_muted(name, staff):
+                        job = self.plan.lookup(name, staff, c)
+                        if job.kind == DIRECT or job.is_derivation():
+                            c = next(voicings, c)
+                            self.insert_transposable_pattern(c, refpitch, state.destpitch, staff, name,
+                                                             musicelements)
                         else:
-                            musicelements.append("\\" + self.voicename(name, staff) + "Rest")
-                elif "ly" in harmonyelement:
-                    self.insert_raw_lilypondcode(harmonyelement["ly"], musicelements)
-                elif "transpose" in harmonyelement:
-                    destpitch = harmonyelement["transpose"]["to"]
-                elif "mute-staff" in harmonyelement:
-                    staffname = harmonyelement["mute-staff"]["staff"].strip()
-                    self.muted_staves.add(staffname)
-                elif "mute-track" in harmonyelement:
-                    trackname = harmonyelement["mute-track"]["track"].strip()
-                    self.muted_tracks.add(trackname)
-                elif "unmute-staff" in harmonyelement:
-                    staffname = harmonyelement["unmute-staff"]["staff"].strip()
-                    self.muted_staves.remove(staffname)
-                elif "unmute-track" in harmonyelement:
-                    trackname = harmonyelement["unmute-track"]["track"].strip()
-                    self.muted_tracks.remove(trackname)
-
-            voice = staff_voice_template.render(voicefragmentname=voicefragmentname,
-                                                musicelements=musicelements)
-            h.voicedefinitions.append(voice)
+                            musicelements.append(c)
+                    else:
+                        musicelements.append("\\" + self.voicename(name, staff) + "Rest")
+            elif "ly" in harmonyelement:
+                self.insert_raw_lilypondcode(harmonyelement["ly"], musicelements)
+            else:
+                state.apply(harmonyelement)
+        return musicelements
 
     def insert_transposable_voicename(self, refpitch, destpitch, vname, musicelements):
         if refpitch == destpitch:
@@ -660,7 +1112,7 @@ class StyleCompiler(object):
             musicelements.append(e)
 
     def to_be_derived_from_existing(self, c):
-        return starts_with_one_of(c.upper(), ["III", "II", "IV", "I", "VII", "VI", "V"])
+        return is_derivable(c)
 
     def scaledegree_distance_from_I(self, degree):
         """
@@ -712,6 +1164,96 @@ class StyleCompiler(object):
         }
         return d[("I", degree)] if ("I", degree) in d else 0
 
+    def derive_chord(self, style, job):
+        """
+        calculate a chord that is not specified in the style from one that is
+        :param style: style that contains the source chord
+        :param job: DerivationJob describing source chord, target degree and target scale
+        :return: lilypond fragment (string) for the derived chord
+        """
+        derived = self.derive_chord_pitches(style, job)
+        if derived is not None:
+            return derived[0]
+        return self.unparse_stream(self.derive_chord_stream(style, job))
+
+    @staticmethod
+    def unparse_stream(s):
+        return "{ " + Lily2Stream().unparse(s.flat.getElementsByClass(["Note", "Chord", "Rest"]).stream()) + " }"
+
+    def derivation(self, style, job, voicing=0):
+        """
+        :param voicing: which voicing to use for PROGRESSION_VOICELEADING (0 = most efficient)
+        :return: (source scale, target scale, distance in semitones from source to target, VoiceLeader, voice leading
+                 method) to derive the chord of job with
+        """
+        style_scale = style["specified-relative-to"]["key"]
+        style_scale_mode = style["specified-relative-to"]["mode"]
+        name_to_constructor = {
+            "major": music21.scale.MajorScale,
+            "minor": music21.scale.MinorScale
+        }
+        source_scale = name_to_constructor[style_scale_mode](style_scale)
+        sourcepitch = music21.pitch.Pitch(style_scale)
+        target_distance = self.scaledegree_distance_from_I(job.degree)
+        target_interval = music21.interval.Interval(target_distance)
+        target_pitch = music21.interval.transposePitch(sourcepitch, target_interval)
+        if job.minor:
+            target_scale = music21.scale.MinorScale(target_pitch.name)
+        else:
+            target_scale = music21.scale.MajorScale(target_pitch.name)
+        # every derived chord gets its own random stream, so that the result doesn't depend on processing order
+        vl = VoiceLeader(seeded_rng(self.seed, job.track, job.staff, job.derivation_key()), voicing,
+                         self.vlcache, self.staff_range(style, job.track, job.staff))
+        vlmethod = self.voiceleading_method(style, job.track, job.staff)
+        return source_scale, target_scale, target_pitch.midi - sourcepitch.midi, vl, vlmethod
+
+    def derive_chord_stream(self, style, job, voicing=0):
+        """
+        :param voicing: which voicing to use for PROGRESSION_VOICELEADING (0 = most efficient)
+        :return: music21 stream with the derived chord
+        """
+        source_scale, target_scale, src2targetdistance, vl, vlmethod = self.derivation(style, job, voicing)
+        # e.g. start from Im7 to calculate VIm7
+        fragment = style["tracks"][job.track]["staves"][job.staff]["chords"][job.source]
+        l = Lily2Stream()
+        s = l.parse(fragment)
+        self.transform_note_stream(s, src2targetdistance, source_scale, target_scale, vl, vlmethod)
+        self.transform_chord_stream(s, src2targetdistance, source_scale, target_scale, vl, vlmethod)
+        return s
+
+    def derive_chord_pitches(self, style, job, voicing=0):
+        """
+        derive a chord by voice leading only the pitches of its source chord: the rhythm skeleton of the source
+        fragment (rests, durations, tuplets, ties, articulations) is kept as it is written
+        :param voicing: which voicing to use for PROGRESSION_VOICELEADING (0 = most efficient)
+        :return: (lilypond fragment, sorted list of its distinct midi numbers or None if it's silent), or None if
+                 the source fragment can't be split in a rhythm skeleton and pitches (see derive_chord_stream for
+                 those)
+        """
+        fragment = style["tracks"][job.track]["staves"][job.staff]["chords"][job.source]
+        split = split_pitches(fragment)
+        if split is None or "<<" in split[0]:
+            return None  # simultaneous music orders its notes differently in a music21 stream
+        skeleton, names, groups = split
+        source_scale, target_scale, src2targetdistance, vl, vlmethod = self.derivation(style, job, voicing)
+        pitches = [copy.deepcopy(lilypond_pitch(name)) for name in names]
+        # like transform_note_stream and transform_chord_stream: first all single notes together, then every chord
+        result = [None] * len(pitches)
+        positions = [[i for i, g in enumerate(groups) if g is None]]
+        for group in sorted(set(g for g in groups if g is not None)):
+            positions.append([i for i, g in enumerate(groups) if g == group])
+        for where in positions:
+            if where:
+                moved = vl.calculate([pitches[i] for i in where], src2targetdistance, source_scale, target_scale,
+                                     reorder_notes=vlmethod, map_accidentals=True)
+                for i, p in zip(where, moved):
+                    result[i] = p
+        new_names = [lilypond_pitch_name(p) for p in result]
+        if None in new_names:
+            return None
+        midis = sorted(set(p.midi for p in result))
+        return fill_pitches(skeleton, new_names), midis if midis else None
+
     def transform_chord_stream(self, s, src2targetdistance, source_scale, target_scale, vl, vlmethod):
         chord_stream = s.flat.getElementsByClass(["Chord"]).stream()
         if chord_stream:
@@ -738,8 +1280,41 @@ class StyleCompiler(object):
                 for p, n in enumerate(note_stream):
                     n.pitch = result[p]
 
+    @staticmethod
+    def staff_range(style, name, staff):
+        """
+        :return: (lowest, highest) midi number the derived chords in a staff may use, from its range in the style,
+                 e.g. range: {low: "e,,", high: "g'"} (lilypond note names or midi numbers), or None if it has no range
+        """
+        if "range" not in style["tracks"][name]["staves"][staff]:
+            return None
+        spec = style["tracks"][name]["staves"][staff]["range"]
+        limits = []
+        for limit in ["low", "high"]:
+            value = spec[limit] if limit in spec else None
+            midi = value if isinstance(value, int) else lilypond_midi("{0}".format(value).strip())
+            if midi is None:
+                print("*** Error: invalid {0} limit {1} in the range of track {2}, staff {3} (expected e.g. "
+                      "range: {{low: \"e,,\", high: \"g'\"}})".format(limit, value, name, staff))
+                sys.exit(3)
+            limits.append(midi)
+        if limits[0] > limits[1]:
+            print("*** Error: empty range in track {0}, staff {1}".format(name, staff))
+            sys.exit(3)
+        return limits[0], limits[1]
+
     def voiceleading_method(self, style, name, staff):
+        """
+        :return: voiceLeadingMethod of a staff, as the key of its voice leading engine (see VoiceLeadingEngine.key):
+                 the style may give the name of the engine (e.g. "kvoice") or its number (e.g. 5)
+        """
         vlmethod = SHIIHS_VOICELEADING
         if "voiceLeadingMethod" in style["tracks"][name]["staves"][staff]:
             vlmethod = style["tracks"][name]["staves"][staff]["voiceLeadingMethod"]
-        return vlmethod
+        engine = find_engine(vlmethod)
+        if engine is None:
+            print("*** Error: unknown voiceLeadingMethod {0} in track {1}, staff {2} (known: {3})".format(
+                    vlmethod, name, staff, ", ".join("{0} ({1})".format(e.name, e.number) if e.number is not None
+                                                     else e.name for e in engines())))
+            sys.exit(3)
+        return engine.key
@@ -0,0 +1,129 @@
+import os
+import sys
+from collections.abc import Mapping
+
+STYLE_EXTENSION = ".yaml"
+
+
+def merge_specs(base, override):
+    """
+    merge (part of) the specification of a style with the overrides of a style that extends it: mappings are merged
+    key by key, any other value in override replaces the one in base, and a key that is set to null (~) in override
+    is removed
+    :return: merged specification (base and override are left untouched)
+    """
+    if not isinstance(base, Mapping) or not isinstance(override, Mapping):
+        return override
+    merged = dict(base)
+    for key in override:
+        if override[key] is None:
+            merged.pop(key, None)
+        elif key in merged:
+            merged[key] = merge_specs(merged[key], override[key])
+        else:
+            merged[key] = override[key]
+    return merged
+
+
+class StyleTracks(Mapping):
+    """
+    the tracks of a style that extends other styles; a track is only merged with the same track in the base styles
+    when it is used, so tracks a song doesn't compile (e.g. with --only-tracks) cost nothing
+    """
+    def __init__(self, layers):
+        """
+        holds
+         - layers = list of the tracks as specified in the style and in the styles it extends, base style first
+         - names = list of the names of all tracks: those of the base style first, in the order of the style files
+         - merged = map of track name to the merged track specification, for the tracks used so far
+        """
+        self.layers = layers
+        self.names = []
+        for layer in layers:
+            for name in layer:
+                if layer[name] is None:
+                    if name in self.names:
+                        self.names.remove(name)
+                elif name not in self.names:
+                    self.names.append(name)
+        self.merged = {}
+
+    def __getitem__(self, name):
+        if name not in self.merged:
+            if name not in self.names:
+                raise KeyError(name)
+            track = None
+            for layer in self.layers:
+                if name in layer:
+                    track = layer[name] if track is None or layer[name] is None else merge_specs(track, layer[name])
+            self.merged[name] = track
+        return self.merged[name]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+
+class StyleIndex(object):
+    """
+    the style files used so far: every file is parsed only once (until it changes), also when several styles extend
+    it. A style that says "extends: <style>" only specifies what it changes; everything else is inherited from the
+    style it extends (which is looked up in the same folder).
+    """
+    def __init__(self, parse):
+        """
+        holds
+         - parse = function that parses a style file to the style specification in it
+         - parsed = map of file name to (modification time, style specification as written in the file)
+        """
+        self.parse = parse
+        self.parsed = {}
+
+    def specification(self, fname):
+        """
+        :return: the style specification in fname, without the styles it extends
+        """
+        stamp = os.path.getmtime(fname) if os.path.exists(fname) else None
+        if fname not in self.parsed or self.parsed[fname][0] != stamp:
+            self.parsed[fname] = (stamp, self.parse(fname))
+        return self.parsed[fname][1]
+
+    def chain(self, fname):
+        """
+        :return: list of the files of the style and of all styles it extends, base style first
+        """
+        chain = [fname]
+        spec = self.specification(fname)
+        while "extends" in spec and spec["extends"]:
+            base = os.path.join(os.path.dirname(chain[0]), spec["extends"] + STYLE_EXTENSION)
+            if base in chain:
+                print("*** Error: style file {0} extends itself (through {1})".format(fname, " <- ".join(chain)))
+                sys.exit(3)
+            chain.insert(0, base)
+            spec = self.specification(base)
+        return chain
+
+    def resolve(self, fname):
+        """
+        :return: the complete style specification of fname, with everything it inherits from the styles it extends
+        """
+        chain = self.chain(fname)
+        if len(chain) == 1:
+            return self.specification(fname)
+        style = {}
+        layers = []
+        for f in chain:
+            spec = self.specification(f)
+            for key in spec:
+                if key == "extends":
+                    continue
+                elif key == "tracks":
+                    layers.append(spec[key] or {})
+                elif spec[key] is None:
+                    style.pop(key, None)
+                else:
+                    style[key] = merge_specs(style[key], spec[key]) if key in style else spec[key]
+        style["tracks"] = StyleTracks(layers)
+        return style
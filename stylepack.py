@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+
+from derivationplanner import DerivationJob, DERIVE_FROM_MODIFIER
+from numberutils import split_roman_prefix
+from voiceleading import find_engine
+
+STYLEPACK_FORMAT_VERSION = 1
+STYLEPACK_EXTENSION = ".pack.json"
+DEGREES = ["I", "II", "III", "IV", "V", "VI", "VII"]
+DEGREE_ACCIDENTALS = ["", "b", "#"]
+
+
+def style_hash(fnames):
+    """
+    :param fnames: style file and the files of the styles it extends (see StyleIndex.chain)
+    :return: hash of the style files contents; a style pack is only valid for the exact style files it was made from
+    """
+    h = hashlib.sha1()
+    for fname in fnames:
+        with open(fname, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def stylepack_filename(stylefilename):
+    """
+    :param stylefilename: e.g. styles/instrumental/waltz.yaml
+    :return: e.g. styles/instrumental/waltz.pack.json
+    """
+    return os.path.splitext(stylefilename)[0] + STYLEPACK_EXTENSION
+
+
+def source_chords(chords):
+    """
+    :param chords: map of chord name to lilypond fragment for a single staff of a style
+    :return: list of chord names that other chords can be derived from (I, I7, Ia, Iend, ...)
+    """
+    return [c for c in chords if split_roman_prefix(c)[0] == "I"]
+
+
+def enumerate_jobs(style, name, staff):
+    """
+    :return: list of DerivationJob for every chord that can be derived in the given track and staff:
+             all degrees with accidentals, from every source chord, in a major and in a minor scale
+    """
+    jobs = []
+    for source in source_chords(style["tracks"][name]["staves"][staff]["chords"]):
+        for minor in [False, True]:
+            for degree in DEGREES:
+                for accidental in DEGREE_ACCIDENTALS:
+                    chord = degree + accidental + ("m" if minor else "") + "_" + source[1:]
+                    jobs.append(DerivationJob(name, staff, chord, DERIVE_FROM_MODIFIER, source=source,
+                                              degree=degree + accidental, minor=minor))
+    return jobs
+
+
+class StylePack(object):
+    """
+    precompiled derivations of all chords a style supports, so that song compilation doesn't need to derive them
+    """
+    def __init__(self, stylename="", stylehash="", seed=0):
+        """
+        holds
+         - stylename = name of the style the pack was made from
+         - stylehash = hash of the style file the pack was made from
+         - seed = seed that was used for the random choices in voice leading
+         - tracks = map of track name to map of staff name to
+                    {"voiceLeadingMethod": method, "derivations": map of derivation key to lilypond fragment}
+        """
+        self.stylename = stylename
+        self.stylehash = stylehash
+        self.seed = seed
+        self.tracks = {}
+
+    def add(self, job, vlmethod, fragment):
+        staff = self.tracks.setdefault(job.track, {}).setdefault(job.staff, {"voiceLeadingMethod": vlmethod,
+                                                                              "derivations": {}})
+        staff["derivations"][job.derivation_key()] = fragment
+
+    def lookup(self, job, seed):
+        """
+        :param job: DerivationJob
+        :param seed: seed of the song being compiled
+        :return: precompiled lilypond fragment for the job, or None if the pack can't provide it
+        """
+        if job.track not in self.tracks or job.staff not in self.tracks[job.track]:
+            return None
+        staff = self.tracks[job.track][job.staff]
+        engine = find_engine(staff["voiceLeadingMethod"])
+        if seed != self.seed and (engine is None or not engine.deterministic):
+            # randomized voice leading: results are only the same for the same seed
+            return None
+        return staff["derivations"].get(job.derivation_key())
+
+    def size(self):
+        return sum(len(self.tracks[t][s]["derivations"]) for t in self.tracks for s in self.tracks[t])
+
+    def save(self, fname):
+        with open(fname, "w") as f:
+            json.dump({"format": STYLEPACK_FORMAT_VERSION,
+                       "style": self.stylename,
+                       "style-hash": self.stylehash,
+                       "seed": self.seed,
+                       "tracks": self.tracks}, f, indent=1, sort_keys=True)
+
+    @staticmethod
+    def load(fname, stylehash):
+        """
+        :param fname: style pack file
+        :param stylehash: hash of the style file the pack should belong to
+        :return: StylePack, or None if there is no (valid, up to date) pack
+        """
+        if not os.path.isfile(fname):
+            return None
+        try:
+            with open(fname, "r") as f:
+                data = json.load(f)
+        except ValueError as e:
+            print("*** WARNING: ignoring unreadable style pack {0}: {1}".format(fname, e))
+            return None
+        if data.get("format") != STYLEPACK_FORMAT_VERSION:
+            print("*** WARNING: ignoring style pack {0} with unsupported format {1}. Please precompile the style "
+                  "again.".format(fname, data.get("format")))
+            return None
+        if data.get("style-hash") != stylehash:
+            print("*** WARNING: ignoring outdated style pack {0}. Please precompile the style again.".format(fname))
+            return None
+        pack = StylePack(data["style"], data["style-hash"], data["seed"])
+        pack.tracks = data["tracks"]
+        print("*** Loaded style pack ", fname)
+        return pack
@@ -0,0 +1,164 @@
+import multiprocessing
+import os
+
+from derivationplanner import DIRECT
+from lily2stream import Lily2Stream
+from songkeys import keyed_filename
+from voiceleading import PROGRESSION_VOICELEADING, nonbijective_vl
+
+DEFAULT_KEEP = 1
+
+_variant_work = None  # (StyleCompiler, song) shared with the forked workers that render a variant
+
+
+def voice_leading_distance(first, second):
+    """
+    :param first: sorted list of distinct midi numbers
+    :param second: sorted list of distinct midi numbers
+    :return: size (in semitones) of the smallest voice leading between the chords in pitch space: for chords with the
+             same number of notes this is the bijective voice leading that pairs the notes from low to high, for
+             other chords the nonbijective one
+    """
+    if len(first) == len(second):
+        return sum(abs(b - a) for a, b in zip(first, second))
+    return nonbijective_vl(first, second, pcs=False)[0]
+
+
+class VariantMetrics(object):
+    """
+    objective measures of how an arrangement is voiced, summed over all staves that play chords
+    """
+    def __init__(self):
+        """
+        holds
+         - distance = total voice leading distance (in semitones) between consecutive chords in a staff
+         - repeated = number of notes that are played again by the next chord in a staff
+         - spread = sum over all staves of the distance (in semitones) between their lowest and highest note
+        """
+        self.distance = 0
+        self.repeated = 0
+        self.spread = 0
+
+    def add_staff(self, chords):
+        """
+        :param chords: sorted lists of midi numbers of the chords played in a staff, in song order
+        """
+        for first, second in zip(chords, chords[1:]):
+            self.distance += voice_leading_distance(first, second)
+            self.repeated += len(set(first) & set(second))
+        if chords:
+            self.spread += max(c[-1] for c in chords) - min(c[0] for c in chords)
+
+    def rank_key(self):
+        """
+        :return: sort key: smoothest voice leading first, then the most compact register, then the most common tones
+        """
+        return self.distance, self.spread, -self.repeated
+
+
+def played_chords(compiler, style):
+    """
+    :param compiler: StyleCompiler that just rendered a song in style
+    :return: map of (track, staff) to the sorted midi numbers of the chords played in it, in song order (silent chords
+             are left out)
+    """
+    midis = {}
+
+    def fragment_midis(fragment):
+        if fragment not in midis:
+            midis[fragment] = compiler.stream_midis(Lily2Stream().parse(fragment))
+        return midis[fragment]
+
+    played = {}
+    for (name, staff), sequence in compiler.plan.sequences.items():
+        voicings = iter(compiler.voicings.get((name, staff), []))
+        progression = compiler.voiceleading_method(style, name, staff) == PROGRESSION_VOICELEADING
+        chords = []
+        for c in sequence:
+            job = compiler.plan.lookup(name, staff, c)
+            if progression and (job.kind == DIRECT or job.is_derivation()):
+                vname = next(voicings)
+                chord = [m for (n, f, m) in compiler.voicing_candidates(style, job) if n == vname][0]
+            elif job.kind == DIRECT:
+                chord = fragment_midis(style["tracks"][name]["staves"][staff]["chords"][c])
+            elif job.is_derivation():
+                chord = fragment_midis(compiler.derived_fragment(style, job)[0])
+            else:
+                continue
+            if chord:
+                chords.append(chord)
+        played[(name, staff)] = chords
+    return played
+
+
+def render_variant(seed):
+    """
+    render a song with the given seed and measure the result (also used in the worker processes)
+    :return: (seed, lilypond code, VariantMetrics)
+    """
+    compiler, song = _variant_work
+    text = compiler.render(song, seed=seed)
+    metrics = VariantMetrics()
+    if "style" in song and song["style"]:
+        style = compiler.init_style(song["style"])
+        for chords in played_chords(compiler, style).values():
+            metrics.add_staff(chords)
+    return seed, text, metrics
+
+
+def generate_variants(compiler, song, count):
+    """
+    render count variants of a song with consecutive seeds (starting at the seed of the song), in parallel worker
+    processes if possible. The first variant is rendered in this process: that bails out early on errors in the song
+    and leaves the styles and caches warm for the workers.
+    :return: list of (seed, lilypond code, VariantMetrics), best variant first
+    """
+    global _variant_work
+    first = compiler.song_seed(song)
+    _variant_work = (compiler, song)
+    try:
+        results = [render_variant(first)]
+        seeds = list(range(first + 1, first + count))
+        workers = min(len(seeds), os.cpu_count() or 1)
+        if workers > 1 and "fork" in multiprocessing.get_all_start_methods() and \
+                not multiprocessing.current_process().daemon:
+            print("*** Rendering {0} variants with {1} workers".format(len(seeds), workers))
+            pool = multiprocessing.get_context("fork").Pool(workers)
+            try:
+                results.extend(pool.map(render_variant, seeds))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results.extend(render_variant(seed) for seed in seeds)
+    finally:
+        _variant_work = None
+    return sorted(results, key=lambda r: (r[2].rank_key(), r[0]))
+
+
+def report(ranked, filenames):
+    """
+    :param ranked: list of (seed, lilypond code, VariantMetrics), best variant first
+    :param filenames: map of seed to the file the variant was written to (for the variants that were kept)
+    """
+    print("*** Ranking of {0} variants (voice leading distance, register spread, repeated notes):".format(len(ranked)))
+    for rank, (seed, text, metrics) in enumerate(ranked):
+        print("***   {0:>3}. seed {1:<6} distance {2:<6} spread {3:<4} repeated {4:<6} {5}".format(
+                rank + 1, seed, metrics.distance, metrics.spread, metrics.repeated, filenames.get(seed, "")))
+
+
+def compile_variants(compiler, count, keep=DEFAULT_KEEP):
+    """
+    compile the input file count times with different seeds, and write the keep best variants to the output file with
+    the seed added (e.g. output/song-seed3.ly)
+    :return: list of files written
+    """
+    song = compiler.load_song(compiler.options.inputfile[0])
+    ranked = generate_variants(compiler, song, count)
+    filename = os.path.abspath(compiler.options.outputfile[0])
+    outputs = [(keyed_filename(filename, "seed{0}".format(seed)), text) for (seed, text, metrics) in ranked[:keep]]
+    written = compiler.write_outputs(outputs)
+    report(ranked, dict((seed, fname) for (seed, text, metrics), (fname, t) in zip(ranked, outputs)))
+    compiler.read_input(compiler.options.inputfile[0])
+    compiler.write_depfile(written)
+    return written
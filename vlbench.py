@@ -0,0 +1,150 @@
+import glob
+import os
+import re
+import time
+
+import music21
+
+from lily2stream import Lily2Stream
+from styleindex import StyleIndex
+from voiceleading import VoiceLeader, engines, seeded_rng
+
+# degrees the chords of a style are derived to: (roman numeral, semitones above I, minor)
+TARGET_DEGREES = [("II", 2, True), ("III", 4, True), ("IV", 5, False), ("V", 7, False), ("VI", 9, True),
+                  ("VII", 11, False)]
+_SOURCE_CHORD = re.compile(r"^I(?![IV])")  # chords on the first degree, e.g. I, I7, Im
+
+
+class VoiceLeadingProblem(object):
+    """
+    one call of a voice leading engine: the pitches of (a chord in) a style fragment, and the pitches they are
+    modally transposed to in the target scale
+    """
+    def __init__(self, label, pitches, target_pitches):
+        """
+        holds
+         - label = where the problem comes from, e.g. "bluegrass/piano/piano-right/I7->V"
+         - pitches = list of music21 pitches to move
+         - target_pitches = the pitches, modally transposed (see VoiceLeader.target_pitches)
+        """
+        self.label = label
+        self.pitches = pitches
+        self.target_pitches = target_pitches
+
+
+def fragment_pitch_lists(fragment):
+    """
+    :param fragment: lilypond fragment of a chord in a style
+    :return: list of lists of music21 pitches that a derivation voice leads: all single notes together, and every
+             chord on its own (see StyleCompiler.transform_note_stream and transform_chord_stream)
+    """
+    s = Lily2Stream().parse(fragment)
+    lists = []
+    notes = [n.pitch for n in s.flat.getElementsByClass(["Note"])]
+    if notes:
+        lists.append(notes)
+    for cd in s.flat.getElementsByClass(["Chord"]):
+        if cd.pitches:
+            lists.append(list(cd.pitches))
+    return lists
+
+
+def style_problems(stylename, style):
+    """
+    :param style: resolved style specification
+    :return: list of VoiceLeadingProblem: every chord on the first degree of every staff, derived to every degree
+    """
+    relative = style["specified-relative-to"] if "specified-relative-to" in style else {"key": "c", "mode": "major"}
+    scale = music21.scale.MinorScale if relative["mode"] == "minor" else music21.scale.MajorScale
+    source_scale = scale(relative["key"])
+    sourcepitch = music21.pitch.Pitch(relative["key"])
+    targets = []
+    for degree, distance, minor in TARGET_DEGREES:
+        target_pitch = music21.interval.Interval(distance).transposePitch(sourcepitch)
+        targets.append((degree, distance, (music21.scale.MinorScale if minor else music21.scale.MajorScale)(
+                target_pitch.name)))
+    leader = VoiceLeader()
+    problems = []
+    for name in style["tracks"]:
+        for staff in style["tracks"][name].get("staves", {}):
+            chords = style["tracks"][name]["staves"][staff].get("chords") or {}
+            for chord in chords:
+                if not _SOURCE_CHORD.match(chord):
+                    continue
+                for pitches in fragment_pitch_lists(chords[chord]):
+                    for degree, distance, target_scale in targets:
+                        target_pitches, respelled = leader.target_pitches(pitches, distance, source_scale,
+                                                                          target_scale)
+                        label = "{0}/{1}/{2}/{3}->{4}".format(stylename, name, staff, chord, degree)
+                        problems.append(VoiceLeadingProblem(label, pitches, target_pitches))
+    return problems
+
+
+def corpus(rootpath, stylenames=None):
+    """
+    :param rootpath: folder with the styles folder
+    :param stylenames: names of the styles in styles/instrumental to take the problems from (None: all of them)
+    :return: list of VoiceLeadingProblem
+    """
+    from stylecompiler import StyleCompiler
+    index = StyleIndex(StyleCompiler.parse_style_file)
+    if stylenames is None:
+        fnames = sorted(glob.glob(os.path.join(rootpath, "styles", "instrumental", "*.yaml")))
+    else:
+        fnames = [os.path.join(rootpath, "styles", "instrumental", name + ".yaml") for name in stylenames]
+    problems = []
+    for fname in fnames:
+        problems.extend(style_problems(os.path.splitext(os.path.basename(fname))[0], index.resolve(fname)))
+    return problems
+
+
+def voiceleading_size(pitches, result):
+    """
+    :return: total distance in semitones that the voices move
+    """
+    return sum(abs(p.midi - r.midi) for p, r in zip(pitches, result))
+
+
+def run_engine(engine, problems, seed=0, repeat=3):
+    """
+    :return: (best time in seconds of the repeat runs over all problems, list with for every problem the size of the
+             voice leading found, or None if the engine failed on it)
+    """
+    best = None
+    sizes = []
+    for r in range(repeat):
+        sizes = []
+        elapsed = 0.0
+        for problem in problems:
+            vl = VoiceLeader(seeded_rng(seed, engine.name, problem.label))
+            start = time.perf_counter()
+            try:
+                result = vl.reorder(problem.pitches, problem.target_pitches, engine.key)
+            except Exception:
+                result = None
+            elapsed += time.perf_counter() - start
+            sizes.append(voiceleading_size(problem.pitches, result) if result is not None else None)
+        best = elapsed if best is None else min(best, elapsed)
+    return best, sizes
+
+
+def benchmark(rootpath, stylenames=None, seed=0, repeat=3):
+    """
+    run every registered voice leading engine over the same corpus of problems from the styles, and print their
+    throughput and the quality of their voice leadings side by side: the average size of the voice leadings (in
+    semitones), and how often an engine found the smallest voice leading of all engines
+    """
+    problems = corpus(rootpath, stylenames)
+    print("*** Benchmarking voice leading engines on {0} problems".format(len(problems)))
+    results = [(engine, run_engine(engine, problems, seed, repeat)) for engine in engines()]
+    smallest = [min([sizes[i] for engine, (elapsed, sizes) in results if sizes[i] is not None] or [None])
+                for i in range(len(problems))]
+    print("engine        number  problems/s  us/problem  failed  mean size  smallest")
+    for engine, (elapsed, sizes) in results:
+        solved = [size for size in sizes if size is not None]
+        best = sum(1 for size, low in zip(sizes, smallest) if size is not None and size == low)
+        print("{0:<12}  {1:>6}  {2:>10.0f}  {3:>10.1f}  {4:>6}  {5:>9}  {6:>7.1f}%".format(
+                engine.name, engine.number if engine.number is not None else "-",
+                len(problems) / elapsed if elapsed else 0.0, 1e6 * elapsed / len(problems) if problems else 0.0,
+                len(sizes) - len(solved), "{0:.2f}".format(float(sum(solved)) / len(solved)) if solved else "-",
+                100.0 * best / len(problems) if problems else 0.0))
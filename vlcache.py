@@ -0,0 +1,166 @@
+from collections import OrderedDict
+
+import music21
+
+DEFAULT_VL_CACHE_SIZE = 4096
+
+CACHED_SOLUTION = "solution"  # the voice led result itself
+CACHED_TARGETS = "targets"  # only the (modally transposed) target pitches, the voice leading still has to be done
+
+_STEPS = "CDEFGAB"
+_NATURAL_PCS = [0, 2, 4, 5, 7, 9, 11]
+
+
+def natural_ps(dnn):
+    """
+    :param dnn: diatonic note number (as in music21: C4 = 29)
+    :return: midi number of the natural note with that diatonic note number
+    """
+    octave, step = divmod(dnn - 1, 7)
+    return 12 * (octave + 1) + _NATURAL_PCS[step]
+
+
+class VoiceLeadingCache(object):
+    """
+    bounded (least recently used) cache of voice leading problems, keyed by the shape of a problem instead of by its
+    pitches: the source pitches are expressed relative to the tonic of the source scale (put in the octave of the
+    lowest source pitch), and the answer relative to the tonic of the target scale (put just below the window the
+    target pitches are searched in, see VoiceLeader.target_window), which makes the key invariant under
+    transposition.
+
+    The modal transposition puts every target pitch in the lowest octave of that window, so as long as the window
+    spans an octave the answer only depends on which pitches of the target scale fall below the start of the window.
+    Deriving e.g. IIm, IIIm and VIm from Im then shares a single entry whenever the same scale pitches wrap around,
+    as do the same derivations in a style specified in another key. Narrower windows are keyed by the distance to the
+    target as well. An entry is transposed back to the problem at hand when it is used.
+    """
+    def __init__(self, maxsize=DEFAULT_VL_CACHE_SIZE):
+        """
+        holds
+         - maxsize = maximum number of entries kept; the least recently used entry is dropped first
+         - entries = ordered map of normalized key to (kind, shape) with kind CACHED_SOLUTION or CACHED_TARGETS and
+                     shape a tuple of pitches relative to the reference
+         - hits, misses, evictions = statistics
+         - scale_pcs = map of scale class name to the pitch classes of its degrees, relative to its tonic
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.scale_pcs = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def reference(from_fragment, from_scale):
+        """
+        :return: (diatonic note number, midi number) of the tonic of from_scale in the octave of the lowest pitch of
+                 from_fragment
+        """
+        tonic = from_scale.tonic
+        lowest = min(p.diatonicNoteNum for p in from_fragment)
+        octaves = (lowest - tonic.diatonicNoteNum) // 7
+        return tonic.diatonicNoteNum + 7 * octaves, tonic.ps + 12 * octaves
+
+    @staticmethod
+    def relative(pitches, reference):
+        """
+        :param pitches: list of pitches
+        :param reference: (diatonic note number, midi number) as returned by reference()
+        :return: tuple with for every pitch (diatonic steps, semitones, has explicit natural) relative to the reference
+        """
+        dnn, ps = reference
+        return tuple((p.diatonicNoteNum - dnn, p.ps - ps,
+                      p.accidental is not None and p.accidental.name == "natural") for p in pitches)
+
+    @staticmethod
+    def absolute(shape, reference):
+        """
+        inverse of relative()
+        :return: list of new pitches, or None if the shape can't be spelled at this transposition without triple
+                 accidentals (add_accidental_to_pitch_accidental respells those, which doesn't transpose)
+        """
+        dnn, ps = reference
+        pitches = []
+        for steps, semitones, natural in shape:
+            alter = ps + semitones - natural_ps(dnn + steps)
+            if abs(alter) > 2:
+                return None
+            p = music21.pitch.Pitch(_STEPS[(dnn + steps - 1) % 7])
+            p.octave = (dnn + steps - 1) // 7
+            if alter or natural:
+                p.accidental = music21.pitch.Accidental(alter)
+            pitches.append(p)
+        return pitches
+
+    def below_window(self, to_scale, window):
+        """
+        :param window: (lowest, highest) midi number the target pitches are searched in
+        :return: (reference, wrapped): the tonic of to_scale in the octave just below the start of the window, as
+                 (diatonic note number, midi number), and the number of pitches of to_scale that fall below the start
+                 of the window in that octave (and so are moved up an octave)
+        """
+        name = type(to_scale).__name__
+        if name not in self.scale_pcs:
+            self.scale_pcs[name] = sorted((p.ps - to_scale.tonic.ps) % 12 for p in to_scale.getPitches()[:-1])
+        tonic = to_scale.tonic
+        octaves = int((window[0] - tonic.ps) // 12)
+        start = window[0] - (tonic.ps + 12 * octaves)
+        return (tonic.diatonicNoteNum + 7 * octaves, tonic.ps + 12 * octaves), \
+            sum(1 for pc in self.scale_pcs[name] if pc < start)
+
+    def normalize(self, from_fragment, src2targetdistance, from_scale, to_scale, window, *extra):
+        """
+        :param window: (lowest, highest) midi number the target pitches are searched in
+        :param extra: everything else the solution depends on (voice leading method, ...)
+        :return: (key, reference) with reference the pitch the cached answer is relative to, or (None, None) if the
+                 problem can't be normalized
+        """
+        if self.maxsize <= 0 or not from_fragment:
+            return None, None
+        for p in from_fragment:
+            if p.microtone.cents or (p.accidental is not None and p.accidental.alter != int(p.accidental.alter)):
+                return None, None
+        source = self.reference(from_fragment, from_scale)
+        scales = (type(from_scale).__name__, type(to_scale).__name__)
+        if window[1] - window[0] >= 11:
+            # every pitch class is found in the first octave of the window: the target degree doesn't matter
+            reference, wrapped = self.below_window(to_scale, window)
+            return (self.relative(from_fragment, source), scales, wrapped) + tuple(extra), reference
+        from_tonic = from_scale.tonic
+        to_tonic = to_scale.tonic
+        octaves, steps = divmod(to_tonic.diatonicNoteNum - from_tonic.diatonicNoteNum, 7)
+        scales += (steps, to_tonic.ps - from_tonic.ps - 12 * octaves)
+        # the window relative to the source as well, so that the key stays invariant under transposition
+        key = (self.relative(from_fragment, source), src2targetdistance, scales,
+               window[0] - source[1], window[1] - source[1]) + tuple(extra)
+        return key, source
+
+    def lookup(self, key, reference):
+        """
+        :return: (kind, list of pitches transposed to reference) or None if the cache can't provide them
+        """
+        entry = self.entries.get(key)
+        pitches = self.absolute(entry[1], reference) if entry is not None else None
+        if pitches is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0], pitches
+
+    def put(self, key, kind, shape):
+        self.entries[key] = (kind, shape)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def lookups(self):
+        return self.hits + self.misses
+
+    def hit_rate(self):
+        return float(self.hits) / self.lookups() if self.lookups() else 0.0
+
+    def report(self):
+        print("*** Voice leading cache: {0} hits, {1} misses ({2:.1f}% hit rate), {3} entries, {4} evictions".format(
+                self.hits, self.misses, 100 * self.hit_rate(), len(self.entries), self.evictions))
@@ -0,0 +1,225 @@
+import itertools
+import mmap
+import os
+import struct
+import time
+
+VLTABLE_FORMAT_VERSION = 1
+VLTABLE_MAGIC = b"BGVL"
+DEFAULT_MAX_CARDINALITY = 4
+
+_MODULUS = 12
+# magic, format version, max cardinality, number of sets, offset of the bijective section, offset of the
+# nonbijective section
+_HEADER = struct.Struct("<4sBB2xIII")
+_INDEX = struct.Struct("<{0}H".format(1 << _MODULUS))
+_NO_SET = 0xFFFF
+_END_OF_PATH = 0xFF
+
+
+def default_vltable_filename():
+    return os.path.join(os.path.expanduser("~"), ".cache", "bluegrass", "vltable.bin")
+
+
+def set_mask(pcs):
+    """
+    :param pcs: sorted list of pitch classes without duplicates
+    :return: 12 bit mask of the set, or None if pcs is not a sorted list of distinct pitch classes
+    """
+    mask = 0
+    previous = -1
+    for pc in pcs:
+        if not previous < pc < _MODULUS:
+            return None
+        mask |= 1 << pc
+        previous = pc
+    return mask
+
+
+def all_sets(max_cardinality):
+    """
+    :return: list of all pitch class sets (sorted tuples) with 1 up to max_cardinality elements,
+             ordered by cardinality first
+    """
+    sets = []
+    for n in range(1, max_cardinality + 1):
+        sets.extend(itertools.combinations(range(_MODULUS), n))
+    return sets
+
+
+def rotation_paths(first_pcs, second_pcs, rotation):
+    """
+    :return: the [startPC, path] pairs of bijective_vl for the given rotation of second_pcs
+             (rotation k pairs first_pcs[i] with second_pcs[i - k])
+    """
+    n = len(first_pcs)
+    paths = []
+    for i in range(n):
+        path = (second_pcs[(i - rotation) % n] - first_pcs[i]) % _MODULUS
+        if path > _MODULUS // 2:
+            path -= _MODULUS
+        paths.append([first_pcs[i], path])
+    return paths
+
+
+def layout(max_cardinality):
+    """
+    :return: (list of sets, map of cardinality to (rank of its first set, number of sets, offset of its block in the
+             bijective section)), size of the bijective section, size of a nonbijective record)
+    """
+    sets = all_sets(max_cardinality)
+    blocks = {}
+    first = 0
+    offset = 0
+    for n in range(1, max_cardinality + 1):
+        count = sum(1 for s in sets if len(s) == n)
+        blocks[n] = (first, count, offset)
+        first += count
+        offset += count * count * 2 * n
+    return sets, blocks, offset, 1 + 2 * max_cardinality
+
+
+def generate(fname, max_cardinality=DEFAULT_MAX_CARDINALITY):
+    """
+    calculate the bijective and nonbijective voice leadings between all pitch class sets with up to max_cardinality
+    elements, and write them to a table file
+    """
+    import voiceleading
+    table, voiceleading._TABLE = voiceleading._TABLE, None  # calculate, don't look up
+    try:
+        start = time.time()
+        sets, blocks, bijective_size, record_size = layout(max_cardinality)
+        index = [_NO_SET] * (1 << _MODULUS)
+        for rank, s in enumerate(sets):
+            index[set_mask(s)] = rank
+
+        bijective = bytearray(bijective_size)
+        for n in range(1, max_cardinality + 1):
+            first, count, offset = blocks[n]
+            for a, b in itertools.product(range(count), repeat=2):
+                voiceleading.bijective_vl(list(sets[first + a]), list(sets[first + b]), sort=False)
+                sizes = [size for (paths, size) in voiceleading.bijective_vl.full_list]
+                # full_list holds rotation 1, 2, ..., n (= 0); bijective_vl sorts it with a stable sort
+                by_rotation = sizes[-1:] + sizes[:-1]
+                order = sorted(range(n), key=lambda x: sizes[x])
+                pos = offset + (a * count + b) * 2 * n
+                bijective[pos:pos + n] = bytes((x + 1) % n for x in order)
+                bijective[pos + n:pos + 2 * n] = bytes(by_rotation)
+
+        nonbijective = bytearray([_END_OF_PATH]) * (len(sets) * len(sets) * record_size)
+        for a, b in itertools.product(range(len(sets)), repeat=2):
+            size, vl = voiceleading.nonbijective_vl(list(sets[a]), list(sets[b]))
+            pos = (a * len(sets) + b) * record_size
+            nonbijective[pos] = size
+            nonbijective[pos + 1:pos + 1 + len(vl)] = bytes(s * _MODULUS + t for (s, t) in vl)
+
+        folder = os.path.dirname(os.path.abspath(fname))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        bijective_offset = _HEADER.size + _INDEX.size
+        with open(fname + ".tmp", "wb") as f:
+            f.write(_HEADER.pack(VLTABLE_MAGIC, VLTABLE_FORMAT_VERSION, max_cardinality, len(sets),
+                                 bijective_offset, bijective_offset + len(bijective)))
+            f.write(_INDEX.pack(*index))
+            f.write(bijective)
+            f.write(nonbijective)
+        os.replace(fname + ".tmp", fname)
+        print("*** Wrote voice leading table for {0} pitch class sets (up to {1} pitch classes) in {2} ({3} bytes, "
+              "{4:.1f}s).".format(len(sets), max_cardinality, fname, os.path.getsize(fname), time.time() - start))
+    finally:
+        voiceleading._TABLE = table
+
+
+class VoiceLeadingTable(object):
+    """
+    read-only, memory-mapped table of precomputed voice leadings between pitch class sets (see generate); the
+    mapping is shared between processes by the operating system
+    """
+    def __init__(self, f, data):
+        """
+        holds
+         - f, data = the open table file and its memory mapping
+         - max_cardinality = largest set in the table
+         - index = map of set mask to rank of the set (_NO_SET if the set is not in the table)
+         - blocks, record_size, sets = layout of the table (see layout)
+        """
+        self.f = f
+        self.data = data
+        magic, version, self.max_cardinality, nsets, self.bijective_offset, self.nonbijective_offset = \
+            _HEADER.unpack_from(data, 0)
+        self.index = _INDEX.unpack_from(data, _HEADER.size)
+        sets, self.blocks, bijective_size, self.record_size = layout(self.max_cardinality)
+        self.sets = len(sets)
+
+    @staticmethod
+    def load(fname):
+        """
+        :return: VoiceLeadingTable, or None if there is no (valid) table file
+        """
+        if not os.path.isfile(fname):
+            return None
+        f = open(fname, "rb")
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError) as e:
+            f.close()
+            print("*** WARNING: ignoring unreadable voice leading table {0}: {1}".format(fname, e))
+            return None
+        if len(data) < _HEADER.size or _HEADER.unpack_from(data, 0)[:2] != (VLTABLE_MAGIC, VLTABLE_FORMAT_VERSION):
+            data.close()
+            f.close()
+            print("*** WARNING: ignoring voice leading table {0} with unsupported format. Please generate it "
+                  "again.".format(fname))
+            return None
+        table = VoiceLeadingTable(f, data)
+        expected = table.nonbijective_offset + table.sets * table.sets * table.record_size
+        if len(data) != expected:
+            table.close()
+            print("*** WARNING: ignoring truncated voice leading table {0}. Please generate it again.".format(fname))
+            return None
+        print("*** Loaded voice leading table ", fname)
+        return table
+
+    def close(self):
+        self.data.close()
+        self.f.close()
+
+    def rank(self, pcs):
+        mask = set_mask(pcs)
+        if mask is None:
+            return None
+        rank = self.index[mask]
+        return None if rank == _NO_SET else rank
+
+    def bijective(self, first_pcs, second_pcs):
+        """
+        :param first_pcs: sorted list of distinct pitch classes
+        :param second_pcs: sorted list of distinct pitch classes, same length
+        :return: (rotations ordered from smallest to largest voice leading (ties in bijective_vl order), size of the
+                 voice leading for every rotation), or None if the sets are not in the table
+        """
+        n = len(first_pcs)
+        a = self.rank(first_pcs)
+        b = self.rank(second_pcs)
+        if a is None or b is None or len(second_pcs) != n:
+            return None
+        first, count, offset = self.blocks[n]
+        pos = self.bijective_offset + offset + ((a - first) * count + (b - first)) * 2 * n
+        record = self.data[pos:pos + 2 * n]
+        return list(record[:n]), list(record[n:])
+
+    def nonbijective(self, source, target):
+        """
+        :param source: sorted list of distinct pitch classes
+        :param target: sorted list of distinct pitch classes
+        :return: (size, voice leading as list of [source pc, target pc]) as nonbijective_vl calculates them,
+                 or None if the sets are not in the table
+        """
+        a = self.rank(source)
+        b = self.rank(target)
+        if a is None or b is None:
+            return None
+        pos = self.nonbijective_offset + (a * self.sets + b) * self.record_size
+        record = self.data[pos:pos + self.record_size]
+        vl = [list(divmod(x, _MODULUS)) for x in record[1:] if x != _END_OF_PATH]
+        return record[0], vl
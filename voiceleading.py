@@ -1,18 +1,37 @@
+import bisect
 import copy
+import hashlib
 import random
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from itertools import cycle
 
 import music21
 
+from kvoice import kvoice_vl
+from vlcache import CACHED_SOLUTION, CACHED_TARGETS
+from vltable import VoiceLeadingTable, rotation_paths
+
+_TABLE = None  # VoiceLeadingTable with precomputed voice leadings between pitch class sets, if one is loaded
+
 _VERYLARGENUMBER = 1000000  # effectively infinity
 _MODULUS = 12  # size of the octave
 
 _HALFMODULUS = int(0.5 + _MODULUS / 2.0)
 
+# shortest distance in semitones between two pitch classes
+_SEMITONE_DISTANCE = [[min((b - a) % _MODULUS, (a - b) % _MODULUS) for b in range(_MODULUS)] for a in range(_MODULUS)]
+# shortest distance in semitones between the natural notes with the given note names
+_STEPS = "CDEFGAB"
+_STEP_TO_INDEX = {step: i for i, step in enumerate(_STEPS)}
+_NATURAL_PCS = [0, 2, 4, 5, 7, 9, 11]
+_LETTER_DISTANCE = [[_SEMITONE_DISTANCE[a][b] for b in _NATURAL_PCS] for a in _NATURAL_PCS]
+
 DIRECT_TRANSPOSITION = 0
 SHIIHS_VOICELEADING = 1
 NAIVE_VOICELEADING = 2
 TYMOCZKO_VOICELEADING = 3
+PROGRESSION_VOICELEADING = 4
+KVOICE_VOICELEADING = 5
 
 """
 
@@ -47,7 +66,7 @@ voice leading
 
 Sometimes, you want something in between, e.g. the best 4-voice voice leading between triads or from a 4-voice seventh
 to a triad; in this case, you need to iterate bijective_vl over all possible doublings of the chords.
-This can be time consuming.
+This can be time consuming. (kvoice.kvoice_vl does this with a branch-and-bound search.)
 
 TODO: allow different choices of metric
 
@@ -89,30 +108,47 @@ def bijective_vl(first_pcs, second_pcs, sort=False):
     return current_best
 
 
+def ranked_bijective_vl(first_pcs, second_pcs, rank=0):
+    """
+    :return: [paths, size] of the rank-th most efficient bijective voice leading, i.e. bijective_vl(first_pcs,
+             second_pcs, sort=True).full_list[rank] (rank is clamped to the number of voice leadings); looked up in the
+             precomputed table if the sets are in it, so only the requested voice leading is built
+    """
+    ranked = _TABLE.bijective(first_pcs, second_pcs) if _TABLE is not None else None
+    if ranked is None:
+        bijective_vl(first_pcs, second_pcs, sort=True)
+        return bijective_vl.full_list[min(rank, len(bijective_vl.full_list) - 1)]
+    rotations, sizes = ranked
+    r = rotations[min(rank, len(rotations) - 1)]
+    return [rotation_paths(first_pcs, second_pcs, r), sizes[r]]
+
+
 """===================================================================================================================
 
 voicelead expects a source list of PITCHES and a target list of PCs, both should be the same length; it outputs one of
 the topN most efficient voice leadings from the source pitches to the target PCs.
-if topN is 1, it gives you the most efficient voice leading"""
+if topN is 1, it gives you the most efficient voice leading
+the optional rng (anything with a randrange method, e.g. random.Random) makes the random selection reproducible"""
 
 
-def voicelead(in_pitches_input, target_pcs_output, top_n=1):
+def voicelead(in_pitches_input, target_pcs_output, top_n=1, rng=random, pitch_range=None):
     in_pitches = [p.midi for p in in_pitches_input]
     target_pcs = [p.midi for p in target_pcs_output]
     in_pcs = sorted([p % _MODULUS for p in in_pitches])  # convert input pitches to PCs and sort them
     target_pcs = sorted(target_pcs)
-    paths = bijective_vl(in_pcs, target_pcs, top_n != 1)  # find the possible bijective VLs
     if top_n != 1:  # randomly select on of the N most efficient
         # possibilities
-        my_range = min(len(bijective_vl.full_list), top_n)
-        paths = bijective_vl.full_list[random.randrange(0, my_range)][0]
+        my_range = min(len(in_pcs), top_n)
+        paths = ranked_bijective_vl(in_pcs, target_pcs, rng.randrange(0, my_range))[0]
+    else:
+        paths = bijective_vl(in_pcs, target_pcs)  # find the possible bijective VLs
     output = []
     temp_paths = paths[:]  # copy the list of paths
     for in_pitch in in_pitches:
         for path in temp_paths:  # when we find a path remove it from our list
             # (so we don't duplicate paths)
             if (in_pitch % _MODULUS) == path[0]:
-                output.append(in_pitch + path[1])
+                output.append(fit_midi(in_pitch + path[1], pitch_range))  # octave moves keep the voice in range
                 temp_paths.remove(path)
                 break
 
@@ -124,6 +160,12 @@ def voicelead(in_pitches_input, target_pcs_output, top_n=1):
             if p.midi == m:
                 midi_to_pitch.append(p)
                 break
+        else:
+            if pitch_range is not None:  # moved to another octave to stay in range
+                for p in target_pcs_output:
+                    if p.midi % _MODULUS == m % _MODULUS:
+                        midi_to_pitch.append(fit_to_range(p, (m, m)))
+                        break
     # print (midi_to_pitch)
     return midi_to_pitch
 
@@ -152,6 +194,10 @@ def nonbijective_vl(source, target, pcs=True):
         target = [x % _MODULUS for x in target]
     source = sorted(list(set(source)))
     target = sorted(list(set(target)))
+    if pcs and _TABLE is not None:
+        found = _TABLE.nonbijective(source, target)
+        if found is not None:
+            return found
     temp_target = []
     if pcs:
         for i in range(len(target)):  # for PCs, iterate over every inversion of the target
@@ -162,7 +208,7 @@ def nonbijective_vl(source, target, pcs=True):
                 cur_vl = find_matrix_vl()
         cur_vl = cur_vl[:-1]
     else:
-        cur_size = build_matrix(source, temp_target)  # no need to iterate for pitches
+        cur_size = build_matrix(source, target, pcs=False)  # no need to iterate for pitches
         cur_vl = find_matrix_vl()
     return cur_size, cur_vl
 
@@ -198,7 +244,9 @@ def build_matrix(source, target, pcs=True):  # requires sorted source and target
     for i in range(1, len(outputMatrix)):
         for j in range(1, len(outputMatrix[i])):
             outputMatrix[i][j] += min([outputMatrix[i][j - 1], outputMatrix[i - 1][j], outputMatrix[i - 1][j - 1]])
-    return outputMatrix[i][j] - theMatrix[i][j]
+    if pcs:
+        return outputMatrix[i][j] - theMatrix[i][j]  # the last cell pairs the repeated first elements
+    return outputMatrix[-1][-1]
 
 
 def find_matrix_vl():  # identifies the voice leading for each matrix
@@ -220,6 +268,7 @@ def find_matrix_vl():  # identifies the voice leading for each matrix
             if outputMatrix[i][j - 1] < my_min:
                 my_min = outputMatrix[i][j - 1]
                 new_i = i
+                new_j = j - 1
             i = new_i
             j = new_j
         elif i > 0:
@@ -262,13 +311,79 @@ GPL License
 """
 
 
+def use_table(fname):
+    """
+    look up voice leadings between small pitch class sets in a precomputed table (see vltable.generate)
+    instead of calculating them
+    :param fname: table file; if it doesn't exist, voice leadings are calculated as usual
+    :return: true if the table is used
+    """
+    global _TABLE
+    if _TABLE is not None and _TABLE.f.name == fname:
+        return True
+    _TABLE = VoiceLeadingTable.load(fname)
+    return _TABLE is not None
+
+
+def fit_midi(midi, pitch_range):
+    """
+    :param pitch_range: (lowest, highest) midi number, or None
+    :return: midi, moved by as few octaves as possible into pitch_range (unchanged if pitch_range is None or narrower
+             than an octave and missing this pitch class)
+    """
+    if pitch_range is None:
+        return midi
+    fitted = midi
+    if fitted < pitch_range[0]:
+        fitted += _MODULUS * ((pitch_range[0] - fitted + _MODULUS - 1) // _MODULUS)
+    elif fitted > pitch_range[1]:
+        fitted -= _MODULUS * ((fitted - pitch_range[1] + _MODULUS - 1) // _MODULUS)
+    return fitted if pitch_range[0] <= fitted <= pitch_range[1] else midi
+
+
+def fit_to_range(pitch, pitch_range):
+    """
+    :param pitch_range: (lowest, highest) midi number, or None
+    :return: pitch, or a copy of it moved by as few octaves as possible into pitch_range
+    """
+    midi = fit_midi(pitch.midi, pitch_range)
+    if midi == pitch.midi:
+        return pitch
+    p = copy.deepcopy(pitch)
+    p.octave = p.implicitOctave + (midi - pitch.midi) // _MODULUS
+    return p
+
+
+def seeded_rng(seed, *names):
+    """
+    make an independent random number generator for the given seed and names (e.g. track, staff, chord),
+    so that the numbers it produces do not depend on what other generators were used before
+    :param seed: integer
+    :param names: strings that identify the stream
+    :return: random.Random
+    """
+    key = ":".join(["{0}".format(seed)] + ["{0}".format(n) for n in names])
+    return random.Random(int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8], "big"))
+
+
 class VoiceLeader(object):
     """
     class to calculate voice leading from one pattern to the next
     (C) 2015 Stefaan Himpe - LGPL license
     """
-    def __init__(self):
-        pass
+    def __init__(self, rng=None, voicing=0, cache=None, pitch_range=None):
+        """
+        :param rng: random number generator used to choose between equally good voicings
+                    (default: python's global random generator)
+        :param voicing: for PROGRESSION_VOICELEADING: which voicing to use, 0 being the most efficient one
+        :param cache: optional VoiceLeadingCache shared between voice leaders
+        :param pitch_range: (lowest, highest) midi number the voice leading may use, e.g. the range of the instrument;
+                            candidates outside it are left out of the search (None: no limits)
+        """
+        self.rng = rng if rng is not None else random
+        self.voicing = voicing
+        self.cache = cache
+        self.pitch_range = pitch_range
 
     @staticmethod
     def add_accidental_to_pitch_accidental(pitch, accidental):
@@ -332,139 +447,300 @@ class VoiceLeader(object):
         :param from_fragment: list of pitches
         :param from_scale: scale in which the above pitches are to be interpreted
         :param to_scale: scale into which the pitches should be (modally) transposed
-        :param reorder_notes: reorder notes in resulting fragment to minimize voice leading distance
+        :param reorder_notes: name or number of the voice leading engine (see find_engine) that reorders the notes in
+                              the resulting fragment to minimize voice leading distance
         :param map_accidentals: keep to map the notes that fall outside the scale as well
         :return: to_fragment: new fragment with minimal voice leading distance to from_fragment
         """
+        engine = find_engine(reorder_notes)
+        if self.cache is None:
+            target_pitches, respelled = self.target_pitches(from_fragment, src2targetdistance, from_scale, to_scale,
+                                                            map_accidentals)
+            return self.reorder(from_fragment, target_pitches, reorder_notes)
+
+        # the other methods make random choices (which must consume the same random numbers whether or not the
+        # problem was seen before), keep octave numbers or break ties on sorted pitch classes, none of which
+        # transposes; for those only the target pitches are cached and the (cheap) voice leading itself is redone
+        transposable = engine.transposable
+        window = self.target_window(from_fragment, src2targetdistance)
+        key, reference = self.cache.normalize(from_fragment, src2targetdistance, from_scale, to_scale,
+                                              (window[0].ps, window[1].ps), engine.key, map_accidentals,
+                                              self.voicing if engine.ranked else 0)
+        entry = self.cache.lookup(key, reference) if key is not None else None
+        if entry is not None:
+            kind, pitches = entry
+            if kind == CACHED_SOLUTION:
+                return pitches
+            return self.reorder(from_fragment, pitches, reorder_notes)
+
+        target_pitches, respelled = self.target_pitches(from_fragment, src2targetdistance, from_scale, to_scale,
+                                                        map_accidentals, window)
+        cacheable = key is not None and not respelled
+        if cacheable and not transposable:
+            self.cache.put(key, CACHED_TARGETS, self.cache.relative(target_pitches, reference))
+        result = self.reorder(from_fragment, target_pitches, reorder_notes)
+        if cacheable and transposable:
+            self.cache.put(key, CACHED_SOLUTION, self.cache.relative(result, reference))
+        return result
+
+    def target_pitches(self, from_fragment, src2targetdistance, from_scale, to_scale, map_accidentals=True,
+                       window=None):
+        """
+        modally transpose every pitch of from_fragment from from_scale to to_scale (without any voice leading)
+        :param window: (minpitch, maxpitch) as returned by target_window, if it is known already
+        :return: (list of pitches, one for every pitch in from_fragment; true if a pitch had to be respelled
+                 enharmonically to avoid triple accidentals)
+        """
         degrees_accidentals = [from_scale.getScaleDegreeAndAccidentalFromPitch(n) for n in from_fragment]
-        pitch_midi = {p.midi: p for p in from_fragment}
-
-        # to guarantee a suitable octave, only consider the pitches from the source fragment and target fragment
-        # augmented with some margin (a third)
-        minpitch = music21.interval.Interval("M-3").transposePitch(pitch_midi[min(pitch_midi.keys())])
-        maxpitch = music21.interval.Interval("M3").transposePitch(
-                music21.interval.Interval(src2targetdistance).transposePitch(pitch_midi[max(pitch_midi.keys())]))
-
+        minpitch, maxpitch = window if window is not None else self.target_window(from_fragment, src2targetdistance)
         target_pitches_without_accidentals = [to_scale.pitchFromDegree(d[0], minPitch=minpitch,
                                                                        maxPitch=maxpitch) for d in degrees_accidentals]
         target_pitches = []
+        respelled = False
         if map_accidentals:
             for p, d in zip(target_pitches_without_accidentals, degrees_accidentals):
+                step = p.step
                 target_pitches.append(self.add_accidental_to_pitch_accidental(p, d[1]))
+                respelled = respelled or p.step != step
         else:
             target_pitches = target_pitches_without_accidentals
+        return target_pitches, respelled
 
-        src2target = {}
-        if not reorder_notes:
-            for srcpitch, targetpitch in zip(from_fragment, target_pitches):
-                src2target[srcpitch] = targetpitch
-        elif reorder_notes == NAIVE_VOICELEADING:
-            src2target_helper = defaultdict(lambda: tuple((None, 1e10, 1e10)))
-            for srcpitch in from_fragment:
-                for targetpitch in target_pitches:
-                    st = min(music21.interval.notesToChromatic(srcpitch, targetpitch).semitones % 12,
-                             music21.interval.notesToChromatic(targetpitch, srcpitch).semitones % 12)
-                    namediff = min(music21.interval.notesToChromatic(music21.pitch.Pitch(srcpitch.step),
-                                                                     music21.pitch.Pitch(
-                                                                             targetpitch.step)).semitones % 12,
-                                   music21.interval.notesToChromatic(music21.pitch.Pitch(targetpitch.step),
-                                                                     music21.pitch.Pitch(srcpitch.step)).semitones % 12)
-                    if (st < src2target_helper[srcpitch][2]) or \
-                            (st == src2target_helper[srcpitch][2] and namediff < src2target_helper[srcpitch][1]):
-                        tp = copy.deepcopy(targetpitch)
-                        tp.octave = srcpitch.octave
-                        src2target_helper[srcpitch] = (tp, namediff, st)
-            for p in src2target_helper:
-                src2target[p] = src2target_helper[p][0]
-        elif reorder_notes == TYMOCZKO_VOICELEADING:
-            vl = voicelead(from_fragment, target_pitches, top_n=2)
-            from itertools import cycle
-            for srcpitch, targetpitch in zip(from_fragment, cycle(vl)):
-                src2target[srcpitch] = targetpitch
-        elif reorder_notes == SHIIHS_VOICELEADING:
-            ###
-            # algorithm:
-            #
-            # we have pitches in the original or from_fragment, e.g. [C, E, G]
-            # we have target pitches, which are the orignal pitches modally transposed in the new key, e.g. [F, A, C]
-            #
-            # we try to find a mapping from pitches in the from_fragment, to pitches in the to_fragment
-            # where midi distance between original pitch and new pitch is minimal
-            #
-            # we also try to avoid repeating pitches in time
-            # the result in this example should be the mapping:
-            # from [C, E, G] => [C, F, A]
-            ###
-
-            # first calculate the cost from every srcpitch to every targetpitch
-            # store the resulting mapping ( (srcpitch,targetpitch) => cost ) in matrix
-            matrix = {}
-            for srcpitch in from_fragment:
-                for targetpitch in target_pitches:
-                    # enlarge the possibilities by transposing the target pitches
-                    # an octave up and down
-                    tlower = copy.deepcopy(targetpitch)
-                    tlower.octave -= 1
-                    tupper = copy.deepcopy(targetpitch)
-                    tupper.octave += 1
-                    expanded_target_pitch = [targetpitch, tlower, tupper]
-                    for t in expanded_target_pitch:
-                        matrix[(srcpitch, t)] = self.calculate_cost(srcpitch, t)
-
-            # now reverse the mapping: from cost to map(src->target)
-            inv_matrix = defaultdict(list)
-            for (s, t) in matrix:
-                inv_matrix[matrix[(s, t)]].append((s, t))
-
-            # now investigate which (src -> target) to select
-            previous_source_note = None
-            previously_calculated_note = None
-            # we need to map every note in the from_fragment to a new note in the resulting fragment
-            for p in from_fragment:
-                # map every note only once
-                while p not in src2target:
-                    # start with lowest cost first
-                    for i in sorted(inv_matrix.keys()):
-                        # select all mappings (src->target) with this cost
-                        possible_notes = inv_matrix[i]
-                        list_of_notes = []
-                        for n in possible_notes:
-                            # select from all these mappings only the ones that start with the fromFragment pitch
-                            if n[0] == p:
-                                note = n[1]
-                                list_of_notes.append(note)
-                        if list_of_notes:
-                            # if multiple candidate mappings,select the one with most equal interval to src fragment
-                            if previously_calculated_note:
-                                original_distance = 0
-                                distance_to_prev_note = defaultdict(list)
-                                if previous_source_note:
-                                    # we can take into account original interval to select note
-                                    original_distance = self.calculate_cost(previous_source_note, p)
-                                for note in list_of_notes:
-                                    distance_to_prev_note[self.calculate_cost(previously_calculated_note,
-                                                                              note) - original_distance].append(note)
-                                keys = list(distance_to_prev_note.keys())
-                                if len(keys) > 1 and 0 in keys:
-                                    del distance_to_prev_note[0]  # avoid repeating same note if feasible
-                                best_note_key = max(distance_to_prev_note.keys())  # meh... there's no good default
-                                # choice between max/min
-                                note = random.choice(distance_to_prev_note[best_note_key])
-                                if note == previously_calculated_note:
-                                    continue  # search for another note with higher cost
-                            else:
-                                note = random.choice(list_of_notes)
-                                if note == previously_calculated_note:
-                                    continue  # search for another note with higher cost
-                            src2target[p] = note
-                            previously_calculated_note = note
-                            break
-
-                previous_source_note = p
+    def target_window(self, from_fragment, src2targetdistance):
+        """
+        :return: (minpitch, maxpitch) between which target_pitches looks for the target pitches; every target pitch
+                 ends up in the lowest octave of this window
+        """
+        pitch_midi = {p.midi: p for p in from_fragment}
 
+        # to guarantee a suitable octave, only consider the pitches from the source fragment and target fragment
+        # augmented with some margin (a third)
+        minpitch = music21.interval.Interval("M-3").transposePitch(pitch_midi[min(pitch_midi.keys())])
+        maxpitch = music21.interval.Interval("M3").transposePitch(
+                music21.interval.Interval(src2targetdistance).transposePitch(pitch_midi[max(pitch_midi.keys())]))
+        if self.pitch_range is not None:
+            minpitch, maxpitch = self.range_window(minpitch, maxpitch)
+        return minpitch, maxpitch
+
+    def range_window(self, minpitch, maxpitch):
+        """
+        :return: (minpitch, maxpitch) limited to self.pitch_range, but still spanning an octave so that every scale
+                 degree can be found in it (unchanged if the range itself is smaller than an octave)
+        """
+        low, high = self.pitch_range
+        if high - low < _MODULUS - 1 or (low <= minpitch.midi and maxpitch.midi <= high):
+            return minpitch, maxpitch
+        lowest = max(minpitch.midi, low)
+        highest = min(maxpitch.midi, high)
+        if highest - lowest < _MODULUS - 1:
+            highest = min(high, lowest + _MODULUS - 1)
+            lowest = max(low, highest - _MODULUS + 1)
+        return music21.pitch.Pitch(midi=lowest), music21.pitch.Pitch(midi=highest)
+
+    def reorder(self, from_fragment, target_pitches, reorder_notes=DIRECT_TRANSPOSITION):
+        """
+        :param from_fragment: list of pitches
+        :param target_pitches: the pitches of from_fragment, modally transposed (see target_pitches)
+        :param reorder_notes: name or number of the voice leading engine (see find_engine)
+        :return: list with for every pitch in from_fragment the pitch it moves to
+        """
+        src2target = find_engine(reorder_notes).reorder(self, from_fragment, target_pitches)
         target_pitches_with_accidentals = [src2target[p] for p in from_fragment]
         return target_pitches_with_accidentals
 
+    @staticmethod
+    def ranked_voicelead(from_fragment, target_pitches, rank=0, pitch_range=None):
+        """
+        map the pitches in from_fragment to the target pitch classes using the rank-th most efficient bijective
+        voice leading (as found by bijective_vl), keeping the spelling of the target pitches
+
+        :param from_fragment: list of pitches
+        :param target_pitches: list of pitches (same length as from_fragment)
+        :param rank: 0 for the most efficient voice leading, 1 for the next one, ... (clamped to the number of
+                     available voice leadings)
+        :param pitch_range: (lowest, highest) midi number; a voice that would leave it moves an octave further
+        :return: map of source pitch to target pitch
+        """
+        in_pcs = sorted([p.midi % _MODULUS for p in from_fragment])
+        target_pcs = sorted([p.midi % _MODULUS for p in target_pitches])
+        paths = ranked_bijective_vl(in_pcs, target_pcs, rank)[0][:]
+        pc_to_target = {}
+        for t in target_pitches:
+            pc_to_target.setdefault(t.midi % _MODULUS, t)
+        src2target = {}
+        for srcpitch in from_fragment:
+            for path in paths:  # when we find a path remove it from our list (so we don't duplicate paths)
+                if srcpitch.midi % _MODULUS == path[0]:
+                    paths.remove(path)
+                    midi = fit_midi(srcpitch.midi + path[1], pitch_range)
+                    tp = copy.deepcopy(pc_to_target[midi % _MODULUS])
+                    tp.octave += (midi - tp.midi) // _MODULUS
+                    src2target[srcpitch] = tp
+                    break
+        return src2target
+
+    @staticmethod
+    def kvoice_voicelead(from_fragment, target_pitches, pitch_range=None):
+        """
+        every distinct pitch in from_fragment is a voice; move the voices to the target pitch classes with the most
+        efficient voice leading that reaches every target pitch class (see kvoice.kvoice_vl), so that e.g. a doubled
+        root can split up into the root and seventh of the next chord, keeping the spelling of the target pitches
+
+        :param from_fragment: list of pitches
+        :param target_pitches: list of pitches
+        :param pitch_range: (lowest, highest) midi number; moves that leave it are pruned from the search
+        :return: map of source pitch to target pitch
+        """
+        voices = []
+        for p in from_fragment:
+            if p not in voices:
+                voices.append(p)
+        pc_to_target = {}
+        for t in target_pitches:
+            pc_to_target.setdefault(t.midi % _MODULUS, t)
+        midis = [p.midi for p in voices]
+        found = kvoice_vl(midis, list(pc_to_target.keys()), pitch_range=pitch_range) or \
+            kvoice_vl(midis, list(pc_to_target.keys()))
+        size, paths = found[0]
+        src2target = {}
+        for srcpitch, (midi, path) in zip(voices, paths):
+            tp = copy.deepcopy(pc_to_target[(midi + path) % _MODULUS])
+            tp.octave += (midi + path - tp.midi) // _MODULUS
+            src2target[srcpitch] = fit_to_range(tp, pitch_range)
+        return src2target
+
+    @staticmethod
+    def naive_voicelead(from_fragment, target_pitches, pitch_range=None):
+        """
+        map every pitch in from_fragment to the target pitch class that is closest in semitones (ties are broken by
+        the distance between the note names), keeping the octave of the source pitch.
+        The whole fragment is mapped at once: the targets are converted to table indices once, and every distinct
+        source pitch is scored in a single pass over the targets using precomputed distance tables.
+
+        :param from_fragment: list of pitches
+        :param target_pitches: list of pitches
+        :param pitch_range: (lowest, highest) midi number; a pitch that would leave it moves to another octave
+        :return: map of source pitch to target pitch
+        """
+        targets = [(t.pitchClass, _STEP_TO_INDEX[t.step]) for t in target_pitches]
+        src2target = {}
+        for srcpitch in from_fragment:
+            if srcpitch in src2target:
+                continue
+            st_row = _SEMITONE_DISTANCE[srcpitch.pitchClass]
+            namediff_row = _LETTER_DISTANCE[_STEP_TO_INDEX[srcpitch.step]]
+            best = min(range(len(targets)), key=lambda i: (st_row[targets[i][0]], namediff_row[targets[i][1]], i))
+            tp = copy.deepcopy(target_pitches[best])
+            tp.octave = srcpitch.octave
+            src2target[srcpitch] = fit_to_range(tp, pitch_range)
+        return src2target
+
+    def shiihs_voicelead(self, from_fragment, target_pitches):
+        """
+        algorithm:
+
+        we have pitches in the original or from_fragment, e.g. [C, E, G]
+        we have target pitches, which are the orignal pitches modally transposed in the new key, e.g. [F, A, C]
+
+        we try to find a mapping from pitches in the from_fragment, to pitches in the to_fragment
+        where midi distance between original pitch and new pitch is minimal
+
+        we also try to avoid repeating pitches in time
+        the result in this example should be the mapping:
+        from [C, E, G] => [C, F, A]
+
+        the candidate target pitches (every target pitch, also an octave up and down) are sorted by midi number once;
+        for every source pitch the candidates are then visited outwards from the source pitch, i.e. in order of
+        increasing cost, until a suitable one is found. Every candidate is visited at most once per source pitch,
+        so the search always terminates: if every candidate would repeat the previous note, the cheapest one is used.
+
+        :param from_fragment: list of pitches
+        :param target_pitches: list of pitches (same length as from_fragment)
+        :return: map of source pitch to target pitch
+        """
+        # enlarge the possibilities by transposing the target pitches an octave up and down
+        candidates = []
+        seen = set()
+        for targetpitch in target_pitches:
+            tlower = copy.deepcopy(targetpitch)
+            tlower.octave -= 1
+            tupper = copy.deepcopy(targetpitch)
+            tupper.octave += 1
+            for t in [targetpitch, tlower, tupper]:
+                if t not in seen:
+                    seen.add(t)
+                    candidates.append(t)
+        if self.pitch_range is not None:
+            # prune the candidates the instrument can't play (unless that leaves nothing to choose from)
+            candidates = [t for t in candidates if self.pitch_range[0] <= t.midi <= self.pitch_range[1]] or candidates
+        order = sorted(range(len(candidates)), key=lambda i: candidates[i].midi)
+        midis = [candidates[i].midi for i in order]
+
+        src2target = {}
+        previous_source_note = None
+        previously_calculated_note = None
+        # we need to map every note in the from_fragment to a new note in the resulting fragment
+        for p in from_fragment:
+            # map every note only once
+            if p not in src2target:
+                original_distance = 0
+                if previous_source_note is not None:
+                    # we can take into account original interval to select note
+                    original_distance = self.calculate_cost(previous_source_note, p)
+                note = None
+                fallback = None
+                # start with lowest cost first
+                for level in self.candidates_by_cost(midis, order, p.midi):
+                    list_of_notes = [candidates[i] for i in level]
+                    if fallback is None:
+                        fallback = list_of_notes[0]
+                    if previously_calculated_note is not None:
+                        # if multiple candidate mappings, select the one with most equal interval to src fragment
+                        distance_to_prev_note = defaultdict(list)
+                        for n in list_of_notes:
+                            distance_to_prev_note[self.calculate_cost(previously_calculated_note,
+                                                                      n) - original_distance].append(n)
+                        if len(distance_to_prev_note) > 1 and 0 in distance_to_prev_note:
+                            del distance_to_prev_note[0]  # avoid repeating same note if feasible
+                        best_note_key = max(distance_to_prev_note.keys())  # meh... there's no good default
+                        # choice between max/min
+                        list_of_notes = distance_to_prev_note[best_note_key]
+                    list_of_notes = [n for n in list_of_notes if n != previously_calculated_note]
+                    if list_of_notes:
+                        note = self.rng.choice(list_of_notes)
+                        break
+                    # else: search for another note with higher cost
+                if note is None:
+                    note = fallback
+                src2target[p] = note
+                previously_calculated_note = note
+            previous_source_note = p
+
+        return src2target
+
+    @staticmethod
+    def candidates_by_cost(midis, order, srcmidi):
+        """
+        walk outwards from srcmidi through a sorted list of candidate midi numbers
+        :param midis: sorted list of candidate midi numbers
+        :param order: for every entry in midis, the index of the candidate it belongs to
+        :param srcmidi: midi number of the source pitch
+        :return: generator of lists of candidate indices with equal cost, in order of increasing cost
+        """
+        right = bisect.bisect_left(midis, srcmidi)
+        left = right - 1
+        while left >= 0 or right < len(midis):
+            cost = min(srcmidi - midis[left] if left >= 0 else _VERYLARGENUMBER,
+                       midis[right] - srcmidi if right < len(midis) else _VERYLARGENUMBER)
+            level = []
+            while left >= 0 and srcmidi - midis[left] == cost:
+                level.append(order[left])
+                left -= 1
+            while right < len(midis) and midis[right] - srcmidi == cost:
+                level.append(order[right])
+                right += 1
+            yield sorted(level)
+
     @staticmethod
     def calculate_cost(srcpitch, targetpitch):
         # src2target_semitones = music21.interval.notesToChromatic(srcpitch, targetpitch).semitones % 12
@@ -479,3 +755,136 @@ class VoiceLeader(object):
         #   src2target_diff \
         # + min(src2target_namediff, target2src_namediff) \
         # + min(src2target_semitones,target2src_semitones)
+
+
+ENGINE_ENTRY_POINT_GROUP = "bluegrass.voiceleading"
+
+_ENGINES = OrderedDict()  # engine name -> VoiceLeadingEngine
+_ENGINE_ALIASES = {}  # integer alias -> engine name
+_plugins_loaded = False
+
+
+class VoiceLeadingEngine(object):
+    """
+    a voice leading method that staves can select with voiceLeadingMethod, by name or by its number
+    """
+    def __init__(self, name, reorder, number=None, transposable=False, deterministic=False, ranked=False,
+                 description=""):
+        """
+        holds
+         - name = name to select the engine with, e.g. "kvoice"
+         - reorder = function(voiceleader, from_fragment, target_pitches) that returns a map of every pitch of
+           from_fragment to the pitch it moves to (target_pitches are the pitches of from_fragment, modally
+           transposed); it finds the random generator, voicing and pitch range to use in the VoiceLeader
+         - number = integer alias of the name (None for engines without one)
+         - transposable = True if the result can be transposed along with the problem (see VoiceLeader.calculate)
+         - deterministic = True if the result doesn't depend on the seed
+         - ranked = True if the engine uses the voicing of the VoiceLeader (0 = most efficient)
+         - description = one line description, for listings
+        """
+        self.name = name
+        self.reorder = reorder
+        self.number = number
+        self.transposable = transposable
+        self.deterministic = deterministic
+        self.ranked = ranked
+        self.description = description
+
+    @property
+    def key(self):
+        """
+        :return: how the engine is identified in caches and style packs: its number if it has one, else its name
+        """
+        return self.number if self.number is not None else self.name
+
+
+def register_engine(engine):
+    """
+    make a VoiceLeadingEngine available to the styles (an engine that is registered again replaces the old one)
+    """
+    _ENGINES[engine.name] = engine
+    if engine.number is not None:
+        _ENGINE_ALIASES[engine.number] = engine.name
+
+
+def load_engine_plugins():
+    """
+    register the voice leading engines other packages provide in the "bluegrass.voiceleading" entry point group; an
+    entry point refers to a VoiceLeadingEngine, or to a reorder function (see VoiceLeadingEngine) that is registered
+    under the name of the entry point
+    """
+    global _plugins_loaded
+    if _plugins_loaded:
+        return
+    _plugins_loaded = True
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return
+    try:
+        found = entry_points(group=ENGINE_ENTRY_POINT_GROUP)
+    except TypeError:  # python < 3.10
+        found = entry_points().get(ENGINE_ENTRY_POINT_GROUP, [])
+    for entry_point in found:
+        try:
+            engine = entry_point.load()
+        except Exception as e:
+            print("*** WARNING: couldn't load voice leading engine {0}: {1}".format(entry_point.name, e))
+            continue
+        if not isinstance(engine, VoiceLeadingEngine):
+            engine = VoiceLeadingEngine(entry_point.name, engine, description=entry_point.value)
+        register_engine(engine)
+
+
+def find_engine(method):
+    """
+    :param method: name or number of a voice leading engine, e.g. "kvoice", 5 or "5"; None and 0 mean direct
+                   transposition
+    :return: VoiceLeadingEngine, or None if there is no such engine
+    """
+    if not method:
+        method = DIRECT_TRANSPOSITION
+    if isinstance(method, str) and method.strip().isdigit():
+        method = int(method)
+    name = _ENGINE_ALIASES.get(method, method)
+    if name not in _ENGINES:
+        load_engine_plugins()
+    return _ENGINES.get(name)
+
+
+def engines():
+    """
+    :return: list of every registered VoiceLeadingEngine, in order of registration
+    """
+    load_engine_plugins()
+    return list(_ENGINES.values())
+
+
+def _direct_reorder(voiceleader, from_fragment, target_pitches):
+    return dict(zip(from_fragment, target_pitches))
+
+
+def _tymoczko_reorder(voiceleader, from_fragment, target_pitches):
+    vl = voicelead(from_fragment, target_pitches, top_n=2, rng=voiceleader.rng, pitch_range=voiceleader.pitch_range)
+    return dict(zip(from_fragment, cycle(vl)))
+
+
+register_engine(VoiceLeadingEngine(
+        "direct", _direct_reorder, DIRECT_TRANSPOSITION, transposable=True, deterministic=True,
+        description="transpose every pitch to the same scale degree in the target scale"))
+register_engine(VoiceLeadingEngine(
+        "shiihs", lambda vl, f, t: vl.shiihs_voicelead(f, t), SHIIHS_VOICELEADING,
+        description="nearest candidate per pitch, avoiding repeated pitches"))
+register_engine(VoiceLeadingEngine(
+        "naive", lambda vl, f, t: vl.naive_voicelead(f, t, vl.pitch_range), NAIVE_VOICELEADING, deterministic=True,
+        description="closest target pitch class per pitch, keeping its octave"))
+register_engine(VoiceLeadingEngine(
+        "tymoczko", _tymoczko_reorder, TYMOCZKO_VOICELEADING,
+        description="one of the two most efficient voice leadings (Tymoczko)"))
+register_engine(VoiceLeadingEngine(
+        "progression", lambda vl, f, t: vl.ranked_voicelead(f, t, vl.voicing, vl.pitch_range),
+        PROGRESSION_VOICELEADING, ranked=True,
+        description="ranked bijective voice leadings, chosen per song by a beam search"))
+register_engine(VoiceLeadingEngine(
+        "kvoice", lambda vl, f, t: vl.kvoice_voicelead(f, t, vl.pitch_range), KVOICE_VOICELEADING,
+        deterministic=True, description="most efficient voice leading with a fixed number of voices"))